@@ -0,0 +1,63 @@
+"""Log backend throughput benchmark
+
+This example compares the write throughput of the HDF5 and raw
+memory-mapped log backends used by SpectrumDataLogger.
+
+Synthetic 32k (real data, 16384 bin) spectra are appended to each backend
+one measurement at a time and in batches.  No instrument is required.
+
+"""
+
+import logging
+import shutil
+import tempfile
+import time
+import os
+
+import numpy as np
+
+from pyspectro.applib.datalogger import Hdf5LogFile, make_rows
+from pyspectro.applib.rawlog import RawLogFile
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(relativeCreated)5d %(name)-15s %(levelname)-8s %(message)s")
+
+nbins = 16384
+Nmeasurements = 2048
+
+spectra = np.random.default_rng(0).random((Nmeasurements, nbins))
+rows = make_rows(np.arange(1, Nmeasurements + 1), monotonic_ns=time.monotonic_ns(), utc_ns=time.time_ns())
+
+
+def run(logfile, batch):
+    """Append all measurements to a log file and return the elapsed time"""
+    logfile.create_acquisition(nbins, acq_id=1, chunk_rows=max(1, (1 << 20) // (8 * nbins)))
+    tstart = time.perf_counter()
+    for i0 in range(0, Nmeasurements, batch):
+        i1 = i0 + batch
+        logfile.append(spectra[i0:i1], rows[i0:i1])
+    logfile.close()
+    return time.perf_counter() - tstart
+
+
+tmpdir = tempfile.mkdtemp()
+
+try:
+    for batch in [1, 16, 128]:
+
+        t = run(Hdf5LogFile(os.path.join(tmpdir, "bench_%s.hdf5" % batch)), batch)
+        logger.info(
+            "hdf5 batch {0:4d}: {1:8.0f} spectra/s {2:8.1f} MB/s".format(
+                batch, Nmeasurements / t, spectra.nbytes / t / 1e6
+            )
+        )
+
+        t = run(RawLogFile(os.path.join(tmpdir, "bench_%s.rawlog" % batch), capacity=Nmeasurements), batch)
+        logger.info(
+            "raw  batch {0:4d}: {1:8.0f} spectra/s {2:8.1f} MB/s (float32 on disk)".format(
+                batch, Nmeasurements / t, spectra.nbytes / t / 1e6
+            )
+        )
+
+finally:
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,76 @@
+"""Log preallocation latency benchmark
+
+This example measures the latency of each write to an HDF5 log file,
+with and without disk space reserved for the acquisition (see
+Hdf5LogFile.create_acquisition preallocate_rows and
+SpectrumDataLogger.preallocate_duration).
+
+Synthetic 32k (real data, 16384 bin) spectra are appended one batch at a
+time, as SpectrumDataLogger does.  Latency spikes come from the file system
+allocating blocks as the file grows, so results depend on the file system.
+No instrument is required.
+
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from pyspectro.applib.datalogger import Hdf5LogFile, make_rows
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(relativeCreated)5d %(name)-15s %(levelname)-8s %(message)s")
+
+nbins = 16384
+batch = 4
+Nmeasurements = 8192
+
+#: Directory on the file system to test (defaults to a temporary directory)
+directory = sys.argv[1] if len(sys.argv) > 1 else None
+
+spectra = np.random.default_rng(0).random((batch, nbins))
+rows = make_rows(np.arange(batch))
+
+
+def run(path, preallocate_rows):
+    """Append all measurements and return the latency (seconds) of each write"""
+    logfile = Hdf5LogFile(path)
+    logfile.create_acquisition(
+        nbins, acq_id=1, chunk_rows=max(1, (1 << 20) // (8 * nbins)), preallocate_rows=preallocate_rows
+    )
+    latency = []
+    for i0 in range(0, Nmeasurements, batch):
+        tstart = time.perf_counter()
+        logfile.append(spectra, rows)
+        latency.append(time.perf_counter() - tstart)
+    logfile.close()
+    return np.array(latency)
+
+
+tmpdir = tempfile.mkdtemp(dir=directory)
+
+try:
+    for preallocate_rows in [0, Nmeasurements, 0, Nmeasurements]:
+
+        path = os.path.join(tmpdir, "bench_%s.hdf5" % preallocate_rows)
+        latency = 1e3 * run(path, preallocate_rows)
+        logger.info(
+            "preallocate {0:5d} rows: p50 {1:6.3f} ms, p99 {2:6.3f} ms, p99.9 {3:6.3f} ms, max {4:7.3f} ms,"
+            " file {5:.1f} MB".format(
+                preallocate_rows,
+                np.percentile(latency, 50),
+                np.percentile(latency, 99),
+                np.percentile(latency, 99.9),
+                latency.max(),
+                os.path.getsize(path) / 1e6,
+            )
+        )
+        os.remove(path)
+
+finally:
+    shutil.rmtree(tmpdir)
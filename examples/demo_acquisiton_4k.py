@@ -4,14 +4,13 @@ This example demonstrates continuous acquisition and data processing
 using the threaded acquisition controller
 
 A internal test signal is generated at 100 MHz.
-For each measurement, the peak value and frequency are retrieved.
+For each measurement, the strongest peaks and their frequencies are retrieved.
 
 """
 import logging
 
-import numpy as np
-
 from pyspectro.applib.acq_control import AcquisitionControlInterface
+from pyspectro.applib.processing import PeakDetector, frequency_axis
 from pyspectro.apps import UHSFFTS_4k_complex
 from pyspectro.common.atom_helpers import prettyMembers
 
@@ -42,8 +41,10 @@ logger.info("Required throughput: %s bytes/sec" % bytesPerSecond)
 # Compute frequency bins for later use
 Fs = ffts.sampleRate
 print("Fs={}".format(Fs))
-freq_init = -Fs / 2
-freq_step = Fs / ffts.Nfft
+freqs = frequency_axis(ffts.Nfft, ffts.app.complexData, Fs)
+
+# Find the 3 strongest peaks, at least 8 bins apart
+detector = PeakDetector(len(freqs), k=3, min_spacing=8, freqs=freqs, interpolation="gaussian")
 
 # Enable internal digital CW Tone generator
 # This will bypass external signal input
@@ -77,11 +78,10 @@ for k in range(Nmeasurements):
             # Read data from buffer
             fftdata = acqControl.buffer.fftdata
 
-            # Perform some basic processing (get max value)
-            max_value = np.amax(fftdata)
-            max_idx = np.argmax(fftdata)
-            max_freq = freq_init + freq_step * max_idx
-            logger.info("Max value: {} @ freq {} MHz".format(max_value, max_freq / 1.0e6))
+            # Perform some basic processing (get the strongest peaks)
+            peaks = detector.find(fftdata)
+            for peak in peaks[peaks["index"] >= 0]:
+                logger.info("Peak value: {} @ freq {} MHz".format(peak["height"], peak["frequency"] / 1.0e6))
 
         else:
             logger.warning("Buffer empty")
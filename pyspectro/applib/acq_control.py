@@ -9,7 +9,7 @@
 # -----------------------------------------------------------------------------
 
 
-from atom.api import Atom, Typed, Value, Callable, Float, Int, Str
+from atom.api import Atom, Typed, Value, Callable, Float, Int, Str, Property
 import threading
 import queue
 import time
@@ -57,23 +57,56 @@ class AcquisitionDataBuffer(Atom):
 
     numAverages: int
 
+    fftdata : numpy.array
+        Measurement in FFT bin order.  When the buffer holds raw memory
+        contents (data_ddra, data_ddrb), they are converted the first time
+        fftdata is read, so the conversion is skipped if fftdata is not used.
+
+    data_ddra, data_ddrb : numpy.array
+        Measurement as read from DDR A and DDR B memory
+
+    time_monotonic_ns, time_utc_ns : int
+        Time the measurement was read from the instrument
+        (time.monotonic_ns and time.time_ns)
+
     """
 
     lock = Value(factory=threading.Lock)
     numAverages = Value()
-    fftdata = Value()
+    fftdata = Property()
     stats = Typed(AcquisitionStats)
 
+    data_ddra = Value()
+    data_ddrb = Value()
+
+    time_monotonic_ns = Value()
+    time_utc_ns = Value()
+
+    #: Converts raw memory contents to fftdata
+    converter = Typed(MemoryConverter)
+
     #: TODO: Consider removing these values form buffer if not needed.
     Nfft = Value()
     complexData = Value()
 
+    _fftdata = Value()
+
+    def _get_fftdata(self):
+        if self._fftdata is None and self.data_ddra is not None and self.converter is not None:
+            self._fftdata = self.converter.process(self.data_ddra, self.data_ddrb)
+        return self._fftdata
+
+    def _set_fftdata(self, value):
+        self._fftdata = value
+
     def clear(self):
-        # self.data_ddra   = None
-        # self.data_ddrb   = None
+        self.data_ddra = None
+        self.data_ddrb = None
         self.fftdata = None
         self.numAverages = None
         self.stats = None
+        self.time_monotonic_ns = None
+        self.time_utc_ns = None
 
 
 class AcquisitionControlInterface(Atom):
@@ -150,6 +183,7 @@ class AcquisitionControlInterface(Atom):
 
         self.buffer.Nfft = driver.app.Nfft
         self.buffer.complexData = driver.app.complexData
+        self.buffer.converter = self._converter
 
         #: Set buffer to initially available state
         self.buffer_release.set()
@@ -214,6 +248,8 @@ class AcquisitionControlInterface(Atom):
         if got_buffer_lock:
 
             # logger.debug('Got buffer lock')
+            time_monotonic_ns = time.monotonic_ns()
+            time_utc_ns = time.time_ns()
             try:
                 with self._device.lock:
                     data_ddra = self._device.read_memory(1)
@@ -223,9 +259,14 @@ class AcquisitionControlInterface(Atom):
                 self.buffer.lock.release()
                 # logger.debug('Released buffer lock')
 
-            self.buffer.fftdata = self._converter.process(data_ddra, data_ddrb)
+            #: Conversion to fftdata is deferred until fftdata is read
+            self.buffer.data_ddra = data_ddra
+            self.buffer.data_ddrb = data_ddrb
+            self.buffer.fftdata = None
             self.buffer.numAverages = self._numAverages
             self.buffer.stats = self._stats
+            self.buffer.time_monotonic_ns = time_monotonic_ns
+            self.buffer.time_utc_ns = time_utc_ns
 
             self.dataReady.set()
 
@@ -9,7 +9,7 @@
 # -----------------------------------------------------------------------------
 
 
-from atom.api import Typed, Enum, Bool, Callable, observe, Int
+from atom.api import Typed, Enum, Bool, Callable, observe, Int, List
 
 from pyspectro.applib.acq_control import AcquisitionControlInterface, AcquisitionDataBuffer
 import pyspectro.apps
@@ -19,7 +19,7 @@ from pyspectro.applib.datalogger import SpectrumDataLogger
 
 import threading
 from pyspectro.applib.processor import CommandThread, TimedProcessor, ProcessTask
-from pyspectro.applib.instrument_props import get_instrument_properties_string
+from pyspectro.applib.instrument_props import get_instrument_properties_string, get_log_settings
 
 import logging
 
@@ -49,6 +49,11 @@ class PySpectroCore(CommandThread):
     on_user_data_ready = Callable()  #: Executes whenver data is ready in acquisiton buffer
     on_heartbeat_task = Typed(ProcessTask)  #: Executes on heartbeat
 
+    #: Processing stages (processing.ProcessingStage) updated with every
+    #: measurement by the core thread, before the buffer is released.
+    #: Stages must keep up with the measurement rate.
+    stages = List()
+
     #: Outgoing thread events
     connect_event = Typed(EventClass, ())
     disconnect_event = Typed(EventClass, ())
@@ -229,6 +234,10 @@ class PySpectroCore(CommandThread):
 
                     elif cmd == "start":
                         self._state = "acq_start"
+                        if self.enable_data_logging:
+                            #: Read the settings before the acquisition starts
+                            with self.device.lock:
+                                self._log.settings = get_log_settings(self.device)
                         self._acq.send_command("start")
                         if self.enable_data_logging:
                             self._log.send_command("start")
@@ -269,6 +278,10 @@ class PySpectroCore(CommandThread):
                         self._log.store_done.wait()
                         self._log.store_done.clear()
 
+                    #: Update processing stages
+                    for stage in list(self.stages):
+                        stage.update_from_buffer(self._acq.buffer)
+
                     if self.user_data_request.is_set():
                         #: Copy to user data block
                         #: Don't try hard at all.  If either are busy
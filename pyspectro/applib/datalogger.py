@@ -9,12 +9,18 @@
 # -----------------------------------------------------------------------------
 
 
+import glob
 import threading
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import os
+import sqlite3
 import numpy as np
-from atom.api import Atom, Str, Value, Enum, Int, Typed, List, Bool
+from atom.api import Atom, Str, Value, Enum, Int, Typed, List, Bool, Float, Dict
 from .acq_control import AcquisitionDataBuffer
+from ..drivers.Spectrometer import MemoryConverter
+from .logcompression import calibrate_compression_process, compression_options, load_plugins
 from .processor import CommandThread
 
 try:
@@ -43,12 +49,784 @@ else:
     EventClass = threading._Event
 
 
+#: Suffix shared by all log files
+LOG_FILE_SUFFIX = "-pyspectro_acq_data.hdf5"
+
+#: Per-measurement record of the rows table
+ROW_DTYPE = np.dtype(
+    [
+        ("monotonic_ns", "<i8"),  #: time.monotonic_ns when the measurement was read
+        ("utc_ns", "<i8"),  #: time.time_ns when the measurement was read
+        ("msrmt_num", "<i4"),  #: hardware measurement count
+        ("flags", "<u4"),  #: ROW_FLAG_* bits
+    ]
+)
+
+#: Row flags: events since the previous logged measurement
+ROW_FLAG_DROPPED = 0x1  #: measurements were dropped by the instrument
+ROW_FLAG_BLOCKED = 0x2  #: measurements were not read because the buffer was busy
+ROW_FLAG_OVERFLOW = 0x4  #: ADC overflow
+ROW_FLAG_MEMORY_ERROR = 0x8  #: instrument memory error
+
+
+def make_rows(msrmt_num, monotonic_ns=0, utc_ns=0, flags=0):
+    """Build a rows table (ROW_DTYPE) from its fields
+
+    Used to convert logs written before the rows table was introduced,
+    which have no timestamps.
+    """
+    msrmt_num = np.asarray(msrmt_num)
+    rows = np.empty(msrmt_num.shape, dtype=ROW_DTYPE)
+    rows["monotonic_ns"] = monotonic_ns
+    rows["utc_ns"] = utc_ns
+    rows["msrmt_num"] = msrmt_num
+    rows["flags"] = flags
+    return rows
+
+
+def _time_ns(t):
+    """Convert a time (time.time seconds or datetime) to time.time_ns"""
+    if hasattr(t, "timestamp"):
+        t = t.timestamp()
+    return int(round(t * 1e9))
+
+
+def log_file_name(session, sequence, suffix=LOG_FILE_SUFFIX):
+    """Return the name of a log file
+
+    Files written by one logger session share the session timestamp and
+    are numbered in the order they were created, e.g.
+    20210315_142501_0003-pyspectro_acq_data.hdf5
+
+    Parameters
+    ----------
+    session : str
+        Session timestamp (%Y%m%d_%H%M%S)
+
+    sequence : int
+        File sequence number within the session
+
+    suffix : str
+        File name suffix
+
+    """
+    return "{0}_{1:04d}{2}".format(session, sequence, suffix)
+
+
+def list_log_files(directory=None, session=None):
+    """Return the log files in a directory, in the order they were written
+
+    Parameters
+    ----------
+    directory : str
+        Log file directory.  Defaults to the pyspectro home directory.
+
+    session : str
+        If given, only return the files of this logger session
+
+    """
+    pattern = "{0}_*{1}".format(session, LOG_FILE_SUFFIX) if session else "*" + LOG_FILE_SUFFIX
+    return sorted(glob.glob(os.path.join(directory or PYHOME, pattern)))
+
+
+class LogReducer(Atom):
+    """Reduce measurements before they are logged
+
+    Measurements are grouped in blocks of `factor` consecutive spectra,
+    and one spectrum is stored per block:
+
+        none     : every measurement is stored
+        decimate : the first measurement of each block is stored
+        mean     : the block average is stored
+        max      : the block maximum (max-hold) is stored
+
+    If bin ranges are given, only those bins are kept.  Bins are selected
+    first, and the reductions are computed in place in preallocated arrays,
+    so no memory is allocated per measurement.
+
+    """
+
+    #: Reduction mode
+    mode = Enum("none", "decimate", "mean", "max")
+
+    #: Number of measurements per stored measurement
+    factor = Int(1)
+
+    #: Bin ranges to keep [(start, stop), ...], or None for all bins
+    bin_ranges = Value()
+
+    #: Indices of the stored bins, or None for all bins
+    bin_index = Value()
+
+    #: Number of bins per stored measurement
+    nbins = Int()
+
+    #: Number of measurements in the current block
+    _n = Int(0)
+
+    _acc = Value()
+    _sel = Value()
+
+    def __init__(self, nbins, mode="none", factor=1, bin_ranges=None):
+        """Initialize the reducer
+
+        Parameters
+        ----------
+        nbins : int
+            Number of bins per measurement
+
+        mode : str
+            Reduction mode
+
+        factor : int
+            Number of measurements per stored measurement
+
+        bin_ranges : list of (start, stop)
+            Bin ranges to keep.  None or an empty list keeps all bins.
+
+        """
+        super(LogReducer, self).__init__(mode=mode, factor=max(1, factor))
+        if bin_ranges:
+            ranges = np.array(bin_ranges, dtype=np.int64).reshape(-1, 2)
+            if np.any(ranges[:, 0] < 0) or np.any(ranges[:, 1] > nbins) or np.any(ranges[:, 0] >= ranges[:, 1]):
+                raise ValueError("Invalid bin ranges {0} for {1} bins".format(bin_ranges, nbins))
+            self.bin_ranges = ranges
+            self.bin_index = np.concatenate([np.arange(a, b) for a, b in ranges])
+            self.nbins = len(self.bin_index)
+            self._sel = np.empty(self.nbins)
+        else:
+            self.nbins = nbins
+        self._acc = np.empty(self.nbins)
+
+    def attrs(self):
+        """Attributes describing the reduction, stored with the acquisition"""
+        result = {"reduction": self.mode, "reduction_factor": self.factor}
+        if self.bin_ranges is not None:
+            result["bin_ranges"] = self.bin_ranges
+        return result
+
+    def reset(self):
+        """Discard the current block"""
+        self._n = 0
+
+    def add(self, spectrum, out):
+        """Add a measurement
+
+        Parameters
+        ----------
+        spectrum : numpy.array
+            Measurement (all bins)
+
+        out : numpy.array
+            Row (nbins) that receives the stored measurement
+
+        Returns
+        -------
+        stored : bool
+            True if a measurement was written to out
+        """
+        x = spectrum
+        if self.bin_index is not None:
+            np.take(spectrum, self.bin_index, out=self._sel)
+            x = self._sel
+
+        if self.mode == "none" or self.factor == 1:
+            out[:] = x
+            return True
+
+        first = self._n == 0
+        self._n += 1
+        last = self._n == self.factor
+        if last:
+            self._n = 0
+
+        if self.mode == "decimate":
+            if first:
+                out[:] = x
+            return first
+
+        if first:
+            self._acc[:] = x
+        elif self.mode == "mean":
+            np.add(self._acc, x, out=self._acc)
+        else:
+            np.maximum(self._acc, x, out=self._acc)
+
+        if not last:
+            return False
+
+        if self.mode == "mean":
+            np.multiply(self._acc, 1.0 / self.factor, out=out)
+        else:
+            out[:] = self._acc
+        return True
+
+
+class LogPyramid(Atom):
+    """Multi-resolution pyramid of an acquisition
+
+    The pyramid is stored in the subgroup "pyramid" of an acquisition
+    group.  Level n (1 <= n <= levels) holds the datasets
+
+        mean : (count // time_factor**n, nbins // freq_factor**n)
+        min  : same shape as mean
+        max  : same shape as mean
+
+    where each row reduces time_factor rows (and each bin freq_factor bins)
+    of the level below.  Level 0 is the acquisition itself.  The cumulative
+    factors are stored as level attributes time_factor and freq_factor.
+
+    The pyramid is built incrementally as measurements are appended.  Rows
+    that do not yet fill a block are carried over to the next append, so
+    each measurement is reduced once per level.  Incomplete blocks at the
+    end of the acquisition are not stored.
+
+    """
+
+    #: Number of levels
+    levels = Int(4)
+
+    #: Number of rows of a level reduced into one row of the next level
+    time_factor = Int(4)
+
+    #: Number of bins of a level reduced into one bin of the next level
+    freq_factor = Int(1)
+
+    #: Datasets (mean, min, max) of each level
+    _dsets = List()
+
+    #: Rows (mean, min, max) carried over to the next append, for each level
+    _carry = List()
+
+    #: Number of rows carried over for each level
+    _ncarry = List()
+
+    def __init__(self, levels=4, time_factor=4, freq_factor=1):
+        super(LogPyramid, self).__init__(
+            levels=levels, time_factor=max(2, time_factor), freq_factor=max(1, freq_factor)
+        )
+
+    def create(self, group, nbins, dtype="float64", chunk_rows=1):
+        """Create the pyramid datasets in an acquisition group
+
+        Levels with no frequency bins left are not created.  The chunks of
+        each level hold the reductions of chunk_rows acquisition rows.
+        """
+        pgroup = group.create_group("pyramid")
+        pgroup.attrs["time_factor"] = self.time_factor
+        pgroup.attrs["freq_factor"] = self.freq_factor
+
+        self._dsets = []
+        self._carry = []
+        self._ncarry = []
+        for level in range(1, self.levels + 1):
+            in_bins = nbins
+            nbins //= self.freq_factor
+            if nbins == 0:
+                break
+
+            lgroup = pgroup.create_group("level{0}".format(level))
+            lgroup.attrs["time_factor"] = self.time_factor**level
+            lgroup.attrs["freq_factor"] = self.freq_factor**level
+            level_rows = max(1, chunk_rows // self.time_factor**level)
+            self._dsets.append(
+                tuple(
+                    lgroup.create_dataset(
+                        name, (0, nbins), maxshape=(None, nbins), chunks=(level_rows, nbins), dtype=dtype
+                    )
+                    for name in ("mean", "min", "max")
+                )
+            )
+            self._carry.append(np.empty((3, self.time_factor - 1, in_bins), dtype=dtype))
+            self._ncarry.append(0)
+
+        pgroup.attrs["levels"] = len(self._dsets)
+
+    def _reduce(self, x, func):
+        """Reduce blocks of rows (and bins) of x with func (np.mean, np.min or np.max)"""
+        m = len(x) // self.time_factor
+        x = func(x.reshape(m, self.time_factor, -1), axis=1)
+        if self.freq_factor > 1:
+            nbins = x.shape[1] // self.freq_factor
+            x = func(x[:, : nbins * self.freq_factor].reshape(m, nbins, self.freq_factor), axis=2)
+        return x
+
+    def append(self, data):
+        """Add a batch of measurements (n, nbins) to the pyramid"""
+        stats = (data, data, data)
+        funcs = (np.mean, np.min, np.max)
+
+        for level, dsets in enumerate(self._dsets):
+            carry = self._carry[level]
+            nc = self._ncarry[level]
+            if nc:
+                stats = [np.concatenate([carry[i, :nc], x]) for i, x in enumerate(stats)]
+
+            n = len(stats[0])
+            nfull = n - n % self.time_factor
+            self._ncarry[level] = n - nfull
+            for i, x in enumerate(stats):
+                carry[i, : n - nfull] = x[nfull:]
+
+            if nfull == 0:
+                break
+
+            stats = [self._reduce(x[:nfull], func) for x, func in zip(stats, funcs)]
+
+            i0 = len(dsets[0])
+            i1 = i0 + len(stats[0])
+            for dset, x in zip(dsets, stats):
+                dset.resize(i1, axis=0)
+                dset[i0:i1] = x
+
+    def flush(self):
+        """Flush the pyramid datasets (SWMR mode)"""
+        for dsets in self._dsets:
+            for dset in dsets:
+                dset.flush()
+
+
+class LogRotationPolicy(Atom):
+    """Log file rotation policy
+
+    A new file is started when any of the enabled limits is reached.
+    A limit of zero is disabled.
+
+    Size and duration limits are checked each time measurements are written,
+    so an acquisition may be continued in a new file.  The acquisition limit
+    is checked when an acquisition is started.
+
+    """
+
+    #: Maximum file size (bytes)
+    max_bytes = Int(0)
+
+    #: Maximum time (seconds) since the file was created
+    max_duration = Float(0.0)
+
+    #: Maximum number of acquisitions per file
+    max_acquisitions = Int(1)
+
+    def file_full(self, nbytes, duration):
+        """Return True if a file with this size and age should be rotated"""
+        if self.max_bytes and nbytes >= self.max_bytes:
+            return True
+        if self.max_duration and duration >= self.max_duration:
+            return True
+        return False
+
+    def acquisitions_full(self, n_acq):
+        """Return True if a file holding n_acq acquisitions should be rotated"""
+        return bool(self.max_acquisitions) and n_acq >= self.max_acquisitions
+
+
+class Hdf5LogFile(Atom):
+    """A spectrum log file in HDF5 format
+
+    Each acquisition (or segment of an acquisition that was continued
+    from a previous file) is stored in a group named acq00000001,
+    acq00000002, ... holding the datasets
+
+        fftdata      : (count, nbins) float64
+        rows         : (count,) ROW_DTYPE (timestamps, hardware measurement
+                       count and flags of each measurement)
+        row_index    : ROW_DTYPE copy of every stride-th row of rows
+                       (the first row of each rows chunk), with the
+                       attribute stride.  It is small enough to be read at
+                       once and lets the reader find a measurement number
+                       or time with a binary search and one chunk read.
+
+    Acquisitions logged in DDR memory order hold, instead of fftdata,
+
+        ddrdata      : (count, 2, nbins/2) float32, the contents of DDR A
+                       and DDR B memory
+
+    and record the group attributes layout = "ddr", Nfft and complexData
+    so that the reader can convert them to FFT bin order.
+
+    File attributes:
+
+        n_acq    : number of acquisition groups in the file
+        session  : logger session timestamp
+        sequence : file sequence number within the session
+        complete : set when the file has been closed by the logger
+        swmr     : file was written in single-writer/multiple-reader mode
+
+    Group attributes:
+
+        count       : number of measurements written
+        stop_time   : time (time.time) the last measurements were written
+        acq_id      : acquisition number within the logger session
+        segment     : index of this part of the acquisition (0 unless the
+                      acquisition was continued from a previous file)
+        compression : compression filter of the spectra (see logcompression),
+                      if they are compressed
+        auto_compression : filter chosen by the compression calibration of
+                      SpectrumDataLogger (compression = "auto"), if it
+                      finished while the group was written
+
+    SpectrumDataLogger also records start_time, numAverages and its
+    settings (see SpectrumDataLogger.settings) as group attributes.
+    Settings that do not change during an acquisition are only stored
+    once, as attributes.  Logs written by earlier versions hold per-row
+    num_averages and msrmt_num datasets instead of rows.
+
+    An acquisition may also hold a multi-resolution pyramid (see
+    LogPyramid) in the subgroup pyramid.
+
+    Acquisitions logged with a LogReducer also record reduction,
+    reduction_factor and (if only some bins are stored) bin_ranges.
+
+    Disk space for the expected measurements of an acquisition can be
+    reserved when it is created (see create_acquisition).  The datasets
+    then grow into space that the file system has already allocated, which
+    avoids the latency of allocating file system blocks while logging.
+    The unused part of the reservation is released when the file is
+    closed.
+
+    In SWMR mode, HDF5 does not allow objects or attributes to be created
+    once readers may be attached.  A SWMR file therefore holds a single
+    acquisition, the measurement count is given by the dataset length while
+    the file is written, and a one-element dataset writer_done is set when
+    the writer closes the file.  The count and complete attributes, and
+    those set with set_attrs, are written after the file has been closed.
+
+    """
+
+    #: Full path of the file
+    path = Str()
+
+    #: Number of acquisition groups in the file
+    n_acq = Int(0)
+
+    #: Time (time.monotonic) the file was created
+    created = Float()
+
+    #: Number of measurements in the current group
+    count = Int(0)
+
+    #: Time (time.time) the last measurements were appended
+    stop_time = Float()
+
+    #: Name of the current acquisition group
+    acq_name = property(lambda self: "acq{0:08d}".format(self.n_acq))
+
+    #: Single-writer/multiple-reader mode
+    swmr = Bool()
+
+    #: True if another acquisition can be added to the file
+    accepts_acquisition = property(lambda self: not (self.swmr and self.n_acq))
+
+    #: Number of measurements that can still be appended to the current acquisition
+    free_rows = property(lambda self: sys.maxsize)
+
+    _file = Value()
+    _dset_writer_done = Value()
+    _group = Value()
+    _dset_data = Value()
+    _dset_rows = Value()
+    _dset_index = Value()
+    _index_stride = Int()
+
+    #: Space beyond the data has been reserved and must be released on close
+    _reserved = Bool()
+    _pyramid = Typed(LogPyramid)
+
+    #: SWMR mode: attributes set with set_attrs, by group name, written on close
+    _late_attrs = Dict()
+
+    def __init__(self, path, session="", sequence=0, swmr=False):
+        """Create a log file
+
+        Parameters
+        ----------
+        path : str
+            Path of the file.  An existing file will not be overwritten.
+
+        session : str
+            Logger session timestamp
+
+        sequence : int
+            File sequence number within the session
+
+        swmr : bool
+            Write the file in single-writer/multiple-reader mode
+
+        """
+        self.path = path
+        self.swmr = swmr
+        self.created = time.monotonic()
+        if swmr:
+            self._file = h5py.File(path, "w-", libver="latest")
+            self._dset_writer_done = self._file.create_dataset("writer_done", (1,), dtype="int8")
+        else:
+            self._file = h5py.File(path, "w-")
+        self._file.attrs["n_acq"] = 0
+        self._file.attrs["session"] = session
+        self._file.attrs["sequence"] = sequence
+        self._file.attrs["complete"] = False
+        self._file.attrs["swmr"] = swmr
+
+    @property
+    def nbytes(self):
+        """Current size of the file in bytes"""
+        return self._file.id.get_filesize()
+
+    def create_acquisition(
+        self,
+        nbins,
+        acq_id,
+        segment=0,
+        chunk_rows=1,
+        dtype="float64",
+        layout=None,
+        attrs=None,
+        pyramid=None,
+        compression=None,
+        preallocate_rows=0,
+    ):
+        """Create the group and datasets for a new acquisition
+
+        Datasets are chunked along the measurement axis and extended
+        as measurements are appended.
+
+        Parameters
+        ----------
+        nbins : int
+            Number of FFT bins per measurement
+
+        acq_id : int
+            Acquisition number within the logger session
+
+        segment : int
+            Index of this part of the acquisition
+
+        chunk_rows : int
+            Number of measurements per HDF5 chunk
+
+        dtype : str
+            Data type of fftdata
+
+        layout : dict
+            None for measurements in FFT bin order.  For measurements in DDR
+            memory order, a dict with the application's Nfft and complexData.
+
+        attrs : dict
+            Additional group attributes
+
+        pyramid : LogPyramid
+            Builds a multi-resolution pyramid of the acquisition.  A new
+            LogPyramid is required for each acquisition.  Not supported for
+            measurements in DDR memory order.
+
+        compression : str
+            Compression filter of the spectra (see logcompression), e.g.
+            "gzip" or "lzf", combined with a shuffle filter.  None stores
+            the spectra uncompressed.
+
+        preallocate_rows : int
+            Number of measurements for which disk space is reserved.  The
+            reservation is a hint: more measurements can be appended, and
+            unused space is released when the file is closed.
+
+        """
+        if not self.accepts_acquisition:
+            raise RuntimeError("Cannot add an acquisition to SWMR file %s" % self.path)
+
+        self.n_acq += 1
+        self.count = 0
+
+        groupname = self.acq_name
+        self._group = self._file.create_group(groupname)
+
+        filters = compression_options(compression)
+        if layout is None:
+            self._dset_data = self._group.create_dataset(
+                "fftdata", (0, nbins), maxshape=(None, nbins), chunks=(chunk_rows, nbins), dtype=dtype, **filters
+            )
+        else:
+            shape = (2, nbins // 2)
+            self._dset_data = self._group.create_dataset(
+                "ddrdata",
+                (0,) + shape,
+                maxshape=(None,) + shape,
+                chunks=(chunk_rows,) + shape,
+                dtype="float32",
+                **filters
+            )
+            self._group.attrs["layout"] = "ddr"
+            self._group.attrs["Nfft"] = layout["Nfft"]
+            self._group.attrs["complexData"] = layout["complexData"]
+        self._dset_rows = self._group.create_dataset(
+            "rows", (0,), maxshape=(None,), chunks=(max(chunk_rows, 256),), dtype=ROW_DTYPE
+        )
+        self._dset_index = self._group.create_dataset(
+            "row_index", (0,), maxshape=(None,), chunks=(256,), dtype=ROW_DTYPE
+        )
+        self._index_stride = self._dset_rows.chunks[0]
+        self._dset_index.attrs["stride"] = self._index_stride
+
+        if not self.swmr:
+            self._group.attrs["count"] = 0
+        self._group.attrs["acq_id"] = acq_id
+        self._group.attrs["segment"] = segment
+        if compression not in (None, "", "none"):
+            self._group.attrs["compression"] = compression
+        for key, value in (attrs or {}).items():
+            self._group.attrs[key] = value
+        self._file.attrs["n_acq"] = self.n_acq
+
+        self._pyramid = pyramid
+        if pyramid is not None:
+            if layout is not None:
+                raise ValueError("A pyramid cannot be built from measurements in DDR memory order")
+            pyramid.create(self._group, nbins, dtype, chunk_rows)
+
+        if preallocate_rows > 0:
+            row_bytes = self._dset_data.dtype.itemsize * int(np.prod(self._dset_data.shape[1:]))
+            row_bytes += self._dset_rows.dtype.itemsize
+            if pyramid is not None:
+                #: Pyramid levels add at most 3 * sum(1 / time_factor ** level) rows
+                row_bytes += 3 * self._dset_data.dtype.itemsize * nbins // max(1, pyramid.time_factor - 1)
+            self._reserve(preallocate_rows * row_bytes)
+
+        if self.swmr:
+            #: Readers may attach from here on
+            self._file.swmr_mode = True
+
+        logger.debug("Created group %s in %s" % (groupname, self.path))
+
+    def append(self, data, rows, stop_time=None):
+        """Append a batch of measurements to the current acquisition
+
+        data holds the spectra and rows the ROW_DTYPE records of the
+        measurements.  Each dataset is written with one hyperslab.  The measurement count
+        is updated afterwards and the file is flushed, so that the count
+        stored on disk is always recoverable after a crash.  In SWMR mode
+        the datasets are flushed so that readers see the new rows.
+
+        stop_time is the time (time.time) of the measurements, if they were
+        not taken now (e.g. when copying them from another log).
+        """
+        n = len(rows)
+        i0 = self.count
+        i1 = i0 + n
+
+        self._dset_data.resize(i1, axis=0)
+        self._dset_rows.resize(i1, axis=0)
+
+        self._dset_data[i0:i1] = data
+        self._dset_rows[i0:i1] = rows
+        self._update_index(rows, i0, i1)
+        self.stop_time = time.time() if stop_time is None else stop_time
+
+        if self._pyramid is not None:
+            self._pyramid.append(data)
+
+        if self.swmr:
+            self._dset_data.flush()
+            self._dset_rows.flush()
+            self._dset_index.flush()
+            if self._pyramid is not None:
+                self._pyramid.flush()
+        else:
+            #: Store measurement count
+            self._group.attrs["count"] = i1
+            self._group.attrs["stop_time"] = self.stop_time
+            self._file.flush()
+
+        self.count = i1
+
+    def set_attrs(self, attrs):
+        """Set attributes of the current acquisition group
+
+        In SWMR mode the attributes are written when the file is closed.
+        """
+        if self.swmr:
+            self._late_attrs.setdefault(self.acq_name, {}).update(attrs)
+        else:
+            self._group.attrs.update(attrs)
+            self._file.flush()
+
+    def _reserve(self, nbytes):
+        """Reserve nbytes of disk space after the end of the file
+
+        HDF5 is not told about the reservation, so it does not truncate the
+        file when it is flushed; chunks are still allocated at the end of
+        HDF5's address space, which now lies in the reserved space.
+        """
+        fd = self._file.id.get_vfd_handle()
+        end = os.fstat(fd).st_size
+        try:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, end, nbytes)
+            else:
+                os.ftruncate(fd, end + nbytes)
+        except OSError as e:
+            logger.warning("Could not reserve %s bytes in %s: %s" % (nbytes, self.path, e))
+            return
+        self._reserved = True
+
+    def _update_index(self, rows, i0, i1):
+        """Append the rows i0 ... i1 - 1 that start a stride to row_index"""
+        stride = self._index_stride
+        first = -(-i0 // stride) * stride
+        if first >= i1:
+            return
+        entries = np.asarray(rows)[first - i0 : i1 - i0 : stride]
+        j0 = first // stride
+        self._dset_index.resize(j0 + len(entries), axis=0)
+        self._dset_index[j0:] = entries
+
+    def close(self):
+        """Mark the file complete and close it"""
+        if self._file is None:
+            return
+
+        if self.swmr:
+            self._dset_writer_done[0] = 1
+            self._dset_writer_done.flush()
+            self._file.close()
+            self._file = None
+            #: Attributes cannot be modified in SWMR mode
+            try:
+                with h5py.File(self.path, "r+") as f:
+                    for key in f:
+                        if key.startswith("acq"):
+                            f[key].attrs["count"] = len(f[key]["rows"])
+                            f[key].attrs["stop_time"] = self.stop_time
+                            f[key].attrs.update(self._late_attrs.get(key, {}))
+                    f.attrs["complete"] = True
+            except (OSError, KeyError) as e:
+                logger.warning("Could not finalize %s: %s" % (self.path, e))
+        else:
+            self._file.attrs["complete"] = True
+            self._file.close()
+            self._file = None
+            if self._reserved:
+                #: HDF5 truncates a file that is larger than its data when it is closed
+                try:
+                    h5py.File(self.path, "r+").close()
+                except OSError as e:
+                    logger.warning("Could not release reserved space in %s: %s" % (self.path, e))
+
+        logger.debug("Closed %s" % self.path)
+
+
 class SpectrumDataLogger(CommandThread):
     """Spectrum Data Logger
 
     This thread logs instrument data.
 
-    A new file is created for each acquisition.
+    Files are written to the logger directory and named by session
+    (see log_file_name).  A file holds one or more acquisitions, and a new
+    file is started according to the rotation policy.  Rotated files are
+    closed by a background thread so that logging is not delayed.
+
+    Measurements are staged in memory and written to file in batches
+    (one hyperslab write per dataset).  The measurement count stored in the
+    file is only updated after a batch has been written and flushed, so it
+    never refers to rows that are not on disk.
 
     Properties:
     -----------
@@ -57,7 +835,129 @@ class SpectrumDataLogger(CommandThread):
 
         The maximum number of measurements recorded per acquisition
         in continuous mode. Measurements beyond this number
-        will not be recorded
+        will not be recorded.  Set to zero for no limit.
+
+    flush_rows : int
+
+        The number of measurements staged in memory before they are
+        written to file.
+
+    flush_interval : float
+
+        The maximum time (in seconds) that a staged measurement waits
+        before it is written to file.
+
+    directory : str
+
+        Directory where log files are written.
+
+    rotation : LogRotationPolicy
+
+        Limits on file size, file duration and acquisitions per file.
+
+    backend : str
+
+        "hdf5" writes HDF5 files (Hdf5LogFile).  "raw" writes float32
+        spectra to preallocated memory-mapped files (rawlog.RawLogFile),
+        for the highest measurement rates.  Raw logs can be converted to
+        HDF5 with rawlog.convert_rawlog_to_hdf5.
+
+    raw_capacity : int
+
+        Number of measurements preallocated per acquisition in raw log
+        files.  A new file is started when an acquisition fills it.
+
+    swmr : bool
+
+        Write files in HDF5 single-writer/multiple-reader mode, so that
+        other processes can follow them with SpectrumDataReader.follow().
+        Rows become visible to readers each time staged measurements are
+        written (see flush_rows and flush_interval).  Each acquisition is
+        written to its own file.
+
+    reduction : str
+
+        Reduce the logged measurement rate (see LogReducer): "none",
+        "decimate" (every Nth measurement), "mean" (block averages) or
+        "max" (block max-hold).  Incomplete blocks at the end of an
+        acquisition are not stored.  The stored msrmt_num is that of the
+        last measurement in the block (decimate: the stored measurement).
+
+    reduction_factor : int
+
+        Number of measurements per stored measurement.
+
+    bin_ranges : list
+
+        Bin ranges [(start, stop), ...] to store.  An empty list stores all
+        bins.
+
+    store_ddr_data : bool
+
+        Store measurements as read from DDR A and DDR B memory, without
+        converting them to FFT bin order.  This keeps the conversion off
+        the acquisition host during logging; SpectrumDataReader converts
+        the measurements when they are read.  The memory contents are
+        stored as float32 (all current applications are floating point).
+        Reductions and bin ranges are not applied to DDR-order data.
+
+    settings : dict
+
+        Instrument settings stored as attributes of each acquisition, set by
+        PySpectroCore when an acquisition is started (see
+        instrument_props.get_log_settings).
+
+    catalog : bool
+
+        Record each acquisition in the SQLite catalog (see logcatalog)
+        each time measurements are written to file.
+
+    catalog_path : str
+
+        Path of the catalog.  Defaults to logcatalog.CATALOG_NAME in the
+        logger directory.
+
+    pyramid_levels : int
+
+        Number of levels of the multi-resolution pyramid written with each
+        acquisition (see LogPyramid).  0 disables the pyramid.  Pyramids
+        are only written by the hdf5 backend, and not for measurements in
+        DDR memory order.
+
+    pyramid_time_factor : int
+
+        Number of measurements reduced into one row of the next level.
+
+    pyramid_freq_factor : int
+
+        Number of bins reduced into one bin of the next level.
+
+    compression : str
+
+        Compression filter of the logged spectra (hdf5 backend, see
+        logcompression): "" (none), "lzf", "gzip", or a filter of the
+        hdf5plugin package.  "auto" calibrates the available filters on
+        the first batch of measurements written in each acquisition, and
+        chooses the filter with the best compression ratio that keeps up
+        with the measured rate.  The calibration runs in a separate process
+        (see calibrate_compression_process) so that logging does not wait
+        for it; meanwhile the acquisition is written with the filter chosen
+        by the previous calibration ("lzf" at first).  The choice is
+        recorded in the auto_compression attribute of the group written
+        when it finishes.  If it differs from that group's filter, the
+        acquisition continues in a new segment with the chosen filter (in
+        the same file, or in the next file if the file does not accept
+        another group).  The compression attribute of each group records
+        the filter of its spectra.
+
+    preallocate_duration : float
+
+        Reserve disk space (hdf5 backend) for this many seconds of
+        measurements when an acquisition is created, at the measurement
+        rate given by settings (SampleRate / (Nfft * numAverages)) and the
+        reduction factor, limited by max_measurements_per_acq and the
+        rotation policy.  Unused space is released when the file is closed.
+        0 disables preallocation.
 
     """
 
@@ -67,6 +967,88 @@ class SpectrumDataLogger(CommandThread):
     #: Maximum number of measurements per dataset
     max_measurements_per_acq = Int(100)
 
+    #: Number of measurements staged in memory before writing to file
+    flush_rows = Int(16)
+
+    #: Maximum time (seconds) a staged measurement waits before writing to file
+    flush_interval = Float(1.0)
+
+    #: Log file directory
+    directory = Str()
+
+    #: Log file rotation policy
+    rotation = Typed(LogRotationPolicy, ())
+
+    #: Write files in single-writer/multiple-reader mode
+    swmr = Bool(False)
+
+    #: Log file format
+    backend = Enum("hdf5", "raw")
+
+    #: Measurements preallocated per acquisition in raw log files
+    raw_capacity = Int(4096)
+
+    #: Store measurements in DDR memory order
+    store_ddr_data = Bool(False)
+
+    #: Logged measurement rate reduction
+    reduction = Enum("none", "decimate", "mean", "max")
+
+    #: Number of measurements per stored measurement
+    reduction_factor = Int(1)
+
+    #: Bin ranges to store [(start, stop), ...]
+    bin_ranges = List()
+
+    #: Reduces measurements before they are staged
+    _reducer = Typed(LogReducer)
+
+    #: Instrument settings stored with each acquisition
+    settings = Dict()
+
+    #: Record acquisitions in the log catalog
+    catalog = Bool(False)
+
+    #: Path of the log catalog
+    catalog_path = Str()
+
+    #: Log catalog (opened by the logger thread)
+    _catalog = Value()
+
+    #: Attributes of the current acquisition group
+    _group_attrs = Dict()
+
+    #: Multi-resolution pyramid levels (0: no pyramid)
+    pyramid_levels = Int(0)
+
+    #: Pyramid reduction factor in time
+    pyramid_time_factor = Int(4)
+
+    #: Pyramid reduction factor in frequency
+    pyramid_freq_factor = Int(1)
+
+    #: Compression filter of the logged spectra ("auto": calibrate on live data)
+    compression = Str()
+
+    #: Compression filter of the groups created next
+    _compression = Str()
+
+    #: Compression filter chosen by the last calibration ("auto")
+    _auto_compression = Str("lzf")
+
+    #: Waits for the compression calibration process, and the pending calibration
+    _calibrator = Typed(ThreadPoolExecutor)
+    _calibration = Value()
+
+    #: The current acquisition calibrates compression at its first flush
+    _calibration_due = Bool()
+
+    #: Duration (seconds) of measurements for which disk space is reserved
+    preallocate_duration = Float(0.0)
+
+    #: Session timestamp used to name log files
+    session = Str()
+
     #: An event that can be used when storing to data files is complete
     store_done = Typed(EventClass, ())
 
@@ -76,25 +1058,54 @@ class SpectrumDataLogger(CommandThread):
 
     _state = Enum("idle", "prepare", "ready", "running", "storing")
 
-    _file = Value()
+    #: Current log file (Hdf5LogFile or RawLogFile)
+    _logfile = Value()
+
+    #: Number of files created in this session
+    _sequence = Int(0)
 
+    #: Acquisition number within this session
     _groupid = Int(0)
 
-    _group = Value()
+    #: Index of the current part of the acquisition (incremented on rotation)
+    _segment = Int(0)
 
-    _dset_fftdata = Value()
-    _dset_num_averages = Value()
-    _dset_msrmt_num = Value()
+    #: Closes rotated files in the background
+    _finalizer = Typed(ThreadPoolExecutor)
+
+    #: Number of measurements accepted in the current acquisition
     _current_idx = Int(0)
 
-    def __init__(self, Nfft, complexData, acq_buf):
+    #: Staging buffers, flushed to file as a single hyperslab
+    _stage_data = Value()
+    _stage_rows = Value()
+    _stage_count = Int(0)
+
+    #: Acquisition statistics counters at the previous logged measurement
+    _counters = Value()
+
+    #: Time (time.monotonic) at which the oldest staged measurement was stored
+    _stage_time = Float()
+
+    def __init__(self, Nfft, complexData, acq_buf, **kwargs):
         """Initialize the SpectrumDataLogger thread
 
         Parameters
         ----------
+        Nfft : int
+            FFT Length
+
+        complexData : bool
+            True: FFT of complex data (Nfft bins per measurement)
+            False: FFT of real data (Nfft/2 bins per measurement)
+
         acq_buf : AcquisitionDataBuffer
             Acquisiton Data Buffer
         """
+        kwargs.setdefault("directory", PYHOME)
+        super(SpectrumDataLogger, self).__init__(**kwargs)
+        self.Nfft = Nfft
+        self.complexData = complexData
         self._acq_buf = acq_buf
 
     def terminate(self):
@@ -102,64 +1113,364 @@ class SpectrumDataLogger(CommandThread):
         self.send_command("terminate")
         super(SpectrumDataLogger, self).terminate()
 
-    def _main_loop(self):
-        """Connection state machine controller"""
+    def _nbins(self):
+        """Number of frequency bins per measurement"""
+        return self.Nfft if self.complexData else self.Nfft // 2
 
-        #: Main Loop
+    def _stored_bins(self):
+        """Number of frequency bins per stored measurement"""
+        return self._reducer.nbins if self._reducer is not None else self._nbins()
+
+    def _chunk_rows(self):
+        """Number of measurements per HDF5 chunk (approximately 1 MiB)"""
+        return max(1, (1 << 20) // (self._stage_data.itemsize * self._stored_bins()))
+
+    def _layout(self):
+        """Layout of stored measurements (see Hdf5LogFile.create_acquisition)"""
+        if self.store_ddr_data:
+            return {"Nfft": self.Nfft, "complexData": self.complexData}
+        return None
+
+    def _open_file(self):
+        """Create the next log file in this session"""
+        if not self.session:
+            self.session = time.strftime("%Y%m%d_%H%M%S")
+
+        if self.backend == "raw":
+            from .rawlog import RawLogFile, RAW_LOG_SUFFIX
+
+            suffix = RAW_LOG_SUFFIX
+        else:
+            suffix = LOG_FILE_SUFFIX
+
+        #: Skip names already in use (e.g. by another session started in the same second)
         while True:
+            self._sequence += 1
+            path = os.path.join(self.directory, log_file_name(self.session, self._sequence, suffix))
+            if not os.path.exists(path):
+                break
+
+        if self.backend == "raw":
+            capacity = self.raw_capacity
+            if self.max_measurements_per_acq:
+                capacity = min(capacity, self.max_measurements_per_acq)
+            self._logfile = RawLogFile(path, self.session, self._sequence, capacity)
+        else:
+            self._logfile = Hdf5LogFile(path, self.session, self._sequence, self.swmr)
+        logger.info("Logging to %s" % path)
+
+    def _close_file(self):
+        """Close the current log file in the background"""
+        if self._logfile is not None:
+            if self._finalizer is None:
+                self._finalizer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="LogFinalize")
+            self._finalizer.submit(self._logfile.close)
+            self._logfile = None
+
+    def _create_group(self):
+        """Create a group in the current file for the current acquisition"""
+        attrs = dict(self.settings)
+        attrs.update(Nfft=self.Nfft, complexData=self.complexData, start_time=time.time())
+        if "numAverages" not in attrs and self._acq_buf.numAverages is not None:
+            attrs["numAverages"] = self._acq_buf.numAverages
+        if self._reducer is not None:
+            attrs.update(self._reducer.attrs())
+        self._group_attrs = attrs
+
+        kwargs = {}
+        if self.pyramid_levels and self.backend == "hdf5" and not self.store_ddr_data:
+            kwargs["pyramid"] = LogPyramid(self.pyramid_levels, self.pyramid_time_factor, self.pyramid_freq_factor)
+        if self._compression and self.backend == "hdf5":
+            kwargs["compression"] = self._compression
+        if self.preallocate_duration > 0 and self.backend == "hdf5":
+            kwargs["preallocate_rows"] = self._preallocate_rows(attrs)
+
+        self._logfile.create_acquisition(
+            self._stored_bins(),
+            self._groupid,
+            self._segment,
+            self._chunk_rows(),
+            layout=self._layout(),
+            attrs=attrs,
+            **kwargs
+        )
+
+    def _preallocate_rows(self, attrs):
+        """Number of measurements for which disk space is reserved"""
+        try:
+            rate = float(attrs["SampleRate"]) / (self.Nfft * int(attrs["numAverages"]))
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            logger.warning("The measurement rate is unknown; no disk space is preallocated")
+            return 0
+
+        duration = self.preallocate_duration
+        if self.rotation.max_duration:
+            duration = min(duration, self.rotation.max_duration)
+        rows = int(np.ceil(duration * rate / max(1, self.reduction_factor if self._reducer is not None else 1)))
+
+        if self.max_measurements_per_acq:
+            rows = min(rows, self.max_measurements_per_acq - self._current_idx)
+        if self.rotation.max_bytes:
+            rows = min(rows, self.rotation.max_bytes // (self._stage_data[0].nbytes))
+        return max(0, rows)
+
+    def _start_acquisition(self):
+        """Open or rotate the log file and prepare for a new acquisition"""
+        if self._logfile is not None:
+            lf = self._logfile
+            if self._file_done(lf) or self.rotation.file_full(lf.nbytes, time.monotonic() - lf.created):
+                self._close_file()
+
+        self._reducer = None
+        if self.store_ddr_data:
+            if self.reduction != "none" or self.bin_ranges:
+                logger.warning("Reductions are not applied to measurements logged in DDR order")
+        elif self.reduction != "none" or self.bin_ranges:
+            self._reducer = LogReducer(self._nbins(), self.reduction, self.reduction_factor, self.bin_ranges)
+
+        if self.pyramid_levels and (self.backend != "hdf5" or self.store_ddr_data):
+            logger.warning("Pyramids are only written by the hdf5 backend for measurements in FFT bin order")
+        if self.compression and self.backend != "hdf5":
+            logger.warning("Compression is only applied by the hdf5 backend")
+        self._compression = self._auto_compression if self.compression == "auto" else self.compression
+
+        #: Staging buffers for batched writes
+        K = max(1, self.flush_rows)
+        if self.store_ddr_data:
+            self._stage_data = np.empty((K, 2, self._nbins() // 2), dtype="float32")
+        else:
+            self._stage_data = np.empty((K, self._stored_bins()), dtype="float64")
+        self._stage_rows = np.zeros((K,), dtype=ROW_DTYPE)
+        self._stage_count = 0
+        self._current_idx = 0
+        self._counters = (0, 0, 0, 0)
+
+        if self._logfile is None:
+            self._open_file()
+
+        self._groupid += 1
+        self._segment = 0
+        self._calibration_due = self.compression == "auto" and self.backend == "hdf5"
+        self._create_group()
+
+        logger.debug("Prepared new acquisition %s" % self._groupid)
+
+    def _file_done(self, lf):
+        """Return True if no more acquisitions will be added to a log file"""
+        return self.rotation.acquisitions_full(lf.n_acq) or not lf.accepts_acquisition
+
+    def _stop_acquisition(self):
+        """Write staged measurements and end the current acquisition"""
+        self._flush()
+        if self._calibration is not None:
+            #: Wait for the calibration, to record its choice with the acquisition
+            self._update_compression()
+        if self._logfile is not None and self._file_done(self._logfile):
+            self._close_file()
+
+    def _stage_measurement(self):
+        """Copy the acquisition buffer into the next staging row
+
+        The acquisition buffer lock must be held by the caller.
+        """
+        k = self._stage_count
+
+        if self.store_ddr_data:
+            self._stage_data[k, 0, :] = self._acq_buf.data_ddra
+            self._stage_data[k, 1, :] = self._acq_buf.data_ddrb
+        elif self._reducer is not None:
+            if not self._reducer.add(self._acq_buf.fftdata, self._stage_data[k]):
+                #: Measurement was absorbed into the current block
+                return
+        else:
+            self._stage_data[k, :] = self._acq_buf.fftdata
+
+        if k == 0:
+            self._stage_time = time.monotonic()
+
+        #: Flag events counted since the previous logged measurement
+        stats = self._acq_buf.stats
+        counters = (stats.Nmsr_drop, stats.Nmsr_blocked, stats.overflow, stats.memoryError)
+        bits = (ROW_FLAG_DROPPED, ROW_FLAG_BLOCKED, ROW_FLAG_OVERFLOW, ROW_FLAG_MEMORY_ERROR)
+        flags = 0
+        for bit, new, old in zip(bits, counters, self._counters):
+            if new != old:
+                flags |= bit
+        self._counters = counters
+
+        self._stage_rows[k] = (
+            self._acq_buf.time_monotonic_ns or 0,
+            self._acq_buf.time_utc_ns or 0,
+            stats.Nmsr_total,
+            flags,
+        )
+
+        self._stage_count += 1
+        self._current_idx += 1
+
+    def _logger_full(self):
+        """Return True if the measurement limit for this acquisition has been reached"""
+        N = self.max_measurements_per_acq
+        return bool(N) and self._current_idx >= N
+
+    def _flush_due(self):
+        """Return True if the staged measurements should be written to file"""
+        if self._stage_count == 0:
+            return False
+        if self._stage_count >= self.flush_rows:
+            return True
+        return time.monotonic() - self._stage_time >= self.flush_interval
+
+    def _flush_timeout(self):
+        """Time to wait for a command before the staged measurements are due
+
+        Returns None (wait indefinitely) when nothing is staged.
+        """
+        if self._stage_count == 0:
+            return None
+        return max(0.0, self._stage_time + self.flush_interval - time.monotonic())
 
-            if self._state == "idle":
+    def _flush(self):
+        """Write staged measurements to file
 
-                #: Thread remains idle if h5py is not available
-                if use_h5py:
-                    self._state = "prepare"
+        If the file is full or has reached its size or duration limit
+        afterwards, it is closed and the acquisition is continued in a new
+        file on the next write.
+        """
+        n = self._stage_count
+        i = 0
 
-            elif self._state == "prepare":
+        if self._calibration is not None and self._calibration.done():
+            self._update_compression(switch=n > 0)
+        if self._calibration_due and n:
+            self._calibrate_compression()
+            self._calibration_due = False
 
-                #: Prepare for a new acquisition
-                #: Create file to hold acquisiton data
-                timestr = time.strftime("%Y%m%d_%H%M%S")
-                fname = "%s-pyspectro_acq_data.hdf5" % timestr
-                fullfile = os.path.join(PYHOME, fname)
-                self._file = h5py.File(fullfile, "w")
+        while i < n:
 
-                N = self.max_measurements_per_acq
+            if self._logfile is None:
+                #: Continue the acquisition in a new file
+                self._open_file()
+                self._segment += 1
+                self._create_group()
 
-                #: Create a group for each acquisition
-                self._groupid += 1
+            lf = self._logfile
+            m = min(n - i, lf.free_rows)
 
-                groupname = "acq{0:08d}".format(self._groupid)
+            logger.debug("Writing data idx %s to %s" % (lf.count, lf.count + m - 1))
 
-                self._group = self._file.create_group(groupname)
+            lf.append(self._stage_data[i : i + m], self._stage_rows[i : i + m])
+            i += m
 
-                if self.complexData:
-                    self._dset_fftdata = self._group.create_dataset("fftdata", (N, self.Nfft), dtype="float64")
-                else:
-                    self._dset_fftdata = self._group.create_dataset("fftdata", (N, self.Nfft // 2), dtype="float64")
+            if self.catalog:
+                self._update_catalog(lf)
 
-                self._dset_num_averages = self._group.create_dataset("num_averages", (N,), dtype="int32")
-                self._dset_msrmt_num = self._group.create_dataset("msrmt_num", (N,), dtype="int32")
-                # self._dset_voltageRange  = self._group.create_dataset("msrmt_num",    (N,),      dtype='int32')
+            if lf.free_rows == 0 or self.rotation.file_full(lf.nbytes, time.monotonic() - lf.created):
+                self._close_file()
 
-                self._state = "ready"
-                logger.debug("Prepared new group %s" % self._groupid)
+        self._stage_count = 0
+
+    def _calibrate_compression(self):
+        """Start choosing the compression filter from the staged measurements
+
+        The calibration runs in a separate process on a copy of the staged
+        measurements.  The measurement rate is taken from the timestamps of
+        the staged rows.
+        """
+        n = self._stage_count
+        elapsed = 1e-9 * (int(self._stage_rows["monotonic_ns"][n - 1]) - int(self._stage_rows["monotonic_ns"][0]))
+        if elapsed <= 0:
+            elapsed = time.monotonic() - self._stage_time
+        rate = (n - 1) / elapsed if n > 1 and elapsed > 0 else None
+
+        if self._calibrator is None:
+            self._calibrator = ThreadPoolExecutor(max_workers=1, thread_name_prefix="LogCompression")
+        self._calibration = self._calibrator.submit(calibrate_compression_process, self._stage_data[:n].copy(), rate)
+
+    def _update_compression(self, switch=False):
+        """Use the filter chosen by the calibration for the next groups
+
+        Waits for the calibration to finish.  The choice is recorded in the
+        auto_compression attribute of the current group.  If switch is True
+        and the choice differs from the filter of the current group, the
+        acquisition continues in a new segment with the chosen filter.
+        """
+        try:
+            name, _ = self._calibration.result()
+        except Exception as e:
+            logger.warning("Compression calibration failed: %s" % e)
+            return
+        finally:
+            self._calibration = None
+
+        logger.info("Compression filter: %s" % name)
+        current = self._compression
+        self._auto_compression = "" if name == "none" else name
+        self._compression = self._auto_compression
+
+        lf = self._logfile
+        if lf is None:
+            return
+        lf.set_attrs({"auto_compression": name})
+        if switch and self._compression != current and lf.count:
+            if self._file_done(lf):
+                #: The next write continues the acquisition in a new file
+                self._close_file()
+            else:
+                self._segment += 1
+                self._create_group()
+
+    def _update_catalog(self, lf):
+        """Record the current acquisition in the log catalog"""
+        from .logcatalog import CATALOG_NAME, LogCatalog, catalog_entry
+
+        attrs = dict(self._group_attrs, acq_id=self._groupid, segment=self._segment, stop_time=lf.stop_time)
+        entry = catalog_entry(lf.path, lf.acq_name, self.session, attrs, lf.count, attrs.get("numAverages"))
+
+        try:
+            if self._catalog is None:
+                self._catalog = LogCatalog(self.catalog_path or os.path.join(self.directory, CATALOG_NAME))
+            self._catalog.update(entry)
+        except sqlite3.Error as e:
+            logger.warning("Could not update log catalog: %s" % e)
+
+    def _main_loop(self):
+        """Connection state machine controller"""
+
+        #: Main Loop
+        while True:
+
+            if self._state == "idle":
+
+                #: Thread remains idle if h5py is not available
+                if use_h5py:
+                    self._state = "ready"
+                elif self._get_cmd(None) == "terminate":
+                    break
 
             elif self._state == "ready":
 
                 #: Wait for command
-                cmd = self._command.get()
+                cmd = self._get_cmd(None)
 
-                # cmd = self._get_cmd()
                 if cmd == "start":
 
-                    self._state = "running"
+                    self._state = "prepare"
 
                 elif cmd == "terminate":
                     break
 
+            elif self._state == "prepare":
+
+                #: Prepare for a new acquisition
+                self._start_acquisition()
+
+                self._state = "running"
+
             elif self._state == "running":
 
-                cmd = self._get_cmd()
+                #: Wait for a command, or until staged measurements are due
+                cmd = self._get_cmd(self._flush_timeout())
 
                 if cmd == "store":
 
@@ -167,65 +1478,869 @@ class SpectrumDataLogger(CommandThread):
 
                 elif cmd == "stop":
 
-                    #: Acquisiton is complete.  Close and flush file.  Get ready for another.
-                    self._file.flush()
-                    self._file.close()
+                    #: Acquisiton is complete.  Get ready for another.
+                    self._stop_acquisition()
 
-                    self._state = "prepare"
+                    self._state = "ready"
+
+                elif cmd == "terminate":
+
+                    self._stop_acquisition()
+                    break
+
+                elif self._flush_due():
+
+                    self._flush()
 
             elif self._state == "storing":
 
-                if self._current_idx < self.max_measurements_per_acq:
+                if not self._logger_full():
 
                     with self._acq_buf.lock:
 
                         logger.debug("Storing data idx %s" % self._current_idx)
 
-                        #: TODO: Some stats only need to be stored once per group.
-                        self._dset_fftdata[self._current_idx, :] = self._acq_buf.fftdata
-                        self._dset_num_averages[self._current_idx] = self._acq_buf.numAverages
-                        self._dset_msrmt_num[self._current_idx] = self._acq_buf.stats.Nmsr_total
-                        # self._dset_voltageRange[self._current_idx] =  self._acq_buf.voltageRange
-
-                        # Increment idx for next measurement
-                        self._current_idx += 1
-                        # Store measurement count
-                        self._group.attrs["count"] = self._current_idx
-                        #: Set acquisition count (will always be one in this case)
-                        self._file.attrs["n_acq"] = self._groupid
+                        self._stage_measurement()
 
                 else:
                     logger.debug("Logger full, ignoring store command")
 
                 #: Produce store_done event (even if logging ended)
+                #: The buffer has been copied, so it can be released before writing.
                 self.store_done.set()
 
+                if self._flush_due():
+                    self._flush()
+
                 self._state = "running"
 
         #: Exiting main loop
-        #: Close and delete file that was prepared but not used
-        self._file.flush()
-        self._file.close()
-        os.remove(fullfile)
+        #: Close the current file and wait for all files to be closed
+        self._close_file()
+        if self._finalizer is not None:
+            self._finalizer.shutdown(wait=True)
+            self._finalizer = None
+        if self._calibrator is not None:
+            self._calibrator.shutdown(wait=True)
+            self._calibrator = None
+        if self._catalog is not None:
+            self._catalog.close()
+            self._catalog = None
 
         self._terminate.clear()
 
 
+class LogBlockCache(Atom):
+    """LRU cache of decoded blocks of logged rows
+
+    Reads of contiguous rows through a LogDataset with a cache are served
+    from blocks of about block_bytes (aligned to HDF5 chunks) that are
+    kept decoded (decompressed, and converted to FFT bin order) in memory.
+    The least recently used blocks are dropped when the cache exceeds
+    max_bytes.
+
+    When consecutive blocks of a dataset are read, the next block in the
+    same direction is read ahead by a background thread, so that
+    scrolling through a log does not wait for the file.
+
+    A cache can be shared by several datasets and readers, e.g.
+
+        reader = SpectrumDataReader(path, cache=LogBlockCache(max_bytes=512 << 20))
+
+    """
+
+    #: Maximum size (bytes) of the cached blocks
+    max_bytes = Int(256 << 20)
+
+    #: Approximate size (bytes) of a block
+    block_bytes = Int(1 << 20)
+
+    #: Read the next block ahead in the scroll direction
+    prefetch = Bool(True)
+
+    #: Number of block reads served from the cache (or from a pending prefetch)
+    hits = Int()
+
+    #: Number of block reads from file
+    misses = Int()
+
+    #: Number of blocks read ahead
+    prefetched = Int()
+
+    #: Size (bytes) of the cached blocks
+    nbytes = Int()
+
+    #: Fraction of block reads served from the cache
+    hit_rate = property(lambda self: self.hits / max(1, self.hits + self.misses))
+
+    _blocks = Typed(OrderedDict, ())
+    _pending = Dict()
+    _last = Dict()
+    _lock = Value(factory=threading.Lock)
+    _executor = Value()
+
+    def read(self, view, start, stop, cols=()):
+        """Read rows start ... stop - 1 of a LogDataset through the cache"""
+        rows = view.chunk_rows(self.block_bytes)
+        parts = []
+        for block in range(start // rows, -(-stop // rows)):
+            b0 = block * rows
+            data = self._get(view, block, rows)
+            parts.append(data[max(start - b0, 0) : stop - b0])
+
+        if not parts:
+            return view._read(slice(0, 0), cols)
+        data = np.concatenate(parts) if len(parts) > 1 else parts[0].copy()
+        return data[(slice(None),) + tuple(cols)] if cols else data
+
+    def _get(self, view, block, rows):
+        """Return a decoded block, reading it if it is not cached"""
+        b0 = block * rows
+        key = (view, block, min(b0 + rows, view.count) - b0)
+
+        with self._lock:
+            data = self._blocks.get(key)
+            pending = self._pending.get(key)
+            if data is not None:
+                self._blocks.move_to_end(key)
+            if data is not None or pending is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._read_ahead(view, block, rows)
+
+        if data is None:
+            data = pending.result() if pending is not None else None
+        if data is None:
+            data = view._read(slice(b0, b0 + key[2]), ())
+            self._store(key, data)
+        return data
+
+    def _read_ahead(self, view, block, rows):
+        """Schedule a read of the next block in the scroll direction (lock held)"""
+        last = self._last.get(view)
+        self._last[view] = block
+        if not self.prefetch or last is None or abs(block - last) != 1:
+            return
+
+        ahead = 2 * block - last
+        b0 = ahead * rows
+        if ahead < 0 or b0 >= view.count:
+            return
+        key = (view, ahead, min(b0 + rows, view.count) - b0)
+        if key in self._blocks or key in self._pending:
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="LogBlockCache")
+        self._pending[key] = self._executor.submit(self._load, key, b0)
+
+    def _load(self, key, b0):
+        """Read a block ahead (background thread)"""
+        try:
+            data = key[0]._read(slice(b0, b0 + key[2]), ())
+        except Exception as e:
+            logger.debug("Could not read ahead: %s" % e)
+            data = None
+        else:
+            if key[0].cache is self:
+                self._store(key, data)
+                self.prefetched += 1
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+        return data
+
+    def _store(self, key, data):
+        """Insert a block and drop the least recently used blocks"""
+        with self._lock:
+            if key in self._blocks:
+                return
+            self._blocks[key] = data
+            self.nbytes += data.nbytes
+            while self.nbytes > self.max_bytes and len(self._blocks) > 1:
+                _, dropped = self._blocks.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+
+    def discard(self, view):
+        """Drop the cached blocks of a dataset"""
+        with self._lock:
+            for key in [key for key in self._blocks if key[0] is view]:
+                self.nbytes -= self._blocks.pop(key).nbytes
+            self._last.pop(view, None)
+
+    def clear(self):
+        """Drop all cached blocks"""
+        with self._lock:
+            self._blocks.clear()
+            self._last.clear()
+            self.nbytes = 0
+
+    def close(self):
+        """Drop all cached blocks and stop the read-ahead thread"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.clear()
+
+
+class LogDataset(Atom):
+    """A lazy, read-only view of a logged dataset
+
+    Only the first `count` rows of the underlying HDF5 dataset are visible.
+    Data is read from file when the view is indexed, so opening a log does
+    not load any measurements.  Row and column slices are passed to HDF5
+    as a single hyperslab selection.
+
+    Supports numpy-style indexing (integers, slices, integer arrays and
+    boolean masks along the first axis), len(), shape, dtype, conversion
+    with numpy.asarray() and chunked iteration with iter_chunks().
+
+    """
+
+    #: Number of visible rows
+    count = Int()
+
+    #: LogBlockCache used for reads of contiguous rows, or None
+    cache = Value()
+
+    _dset = Value()
+
+    shape = property(lambda self: (self.count,) + tuple(self._dset.shape[1:]))
+    dtype = property(lambda self: self._dset.dtype)
+    ndim = property(lambda self: self._dset.ndim)
+    size = property(lambda self: int(np.prod(self.shape)))
+
+    def __init__(self, dset, count=None):
+        """Initialize the view
+
+        Parameters
+        ----------
+        dset : h5py.Dataset
+            Dataset with measurements along the first axis
+
+        count : int
+            Number of valid rows.  Defaults to the length of the dataset.
+
+        """
+        self._dset = dset
+        self.count = len(dset) if count is None else min(int(count), len(dset))
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "<{0} shape={1} dtype={2}>".format(self.__class__.__name__, self.shape, self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        result = self[:]
+        return result if dtype is None else result.astype(dtype, copy=False)
+
+    def refresh(self):
+        """Update the row count of a dataset that is being written in SWMR mode"""
+        self._dset.refresh()
+        self.count = len(self._dset)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if key and key[0] is Ellipsis:
+            key = (slice(None),) * (self.ndim - len(key) + 1) + key[1:]
+        if not key:
+            key = (slice(None),)
+
+        rows, cols = key[0], key[1:]
+        n = self.count
+
+        if isinstance(rows, (int, np.integer)):
+            idx = int(rows) + n if rows < 0 else int(rows)
+            if not 0 <= idx < n:
+                raise IndexError("index {0} is out of bounds for axis 0 with size {1}".format(rows, n))
+            if self.cache is not None:
+                return self.cache.read(self, idx, idx + 1, cols)[0]
+            return self._read(slice(idx, idx + 1), cols)[0]
+
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(n)
+            if step == 1 and self.cache is not None:
+                return self.cache.read(self, start, max(start, stop), cols)
+            if step > 0:
+                return self._read(slice(start, max(start, stop), step), cols)
+            #: HDF5 selections must be increasing; read forwards and reverse
+            idx = np.arange(start, stop, step)
+            if len(idx) == 0:
+                return self._read(slice(0, 0), cols)
+            return self._read(slice(idx[-1], idx[0] + 1, -step), cols)[::-1]
+
+        #: Integer array or boolean mask
+        idx = np.asarray(rows)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        idx = np.where(idx < 0, idx + n, idx)
+        if idx.size and (idx.min() < 0 or idx.max() >= n):
+            raise IndexError("index out of bounds for axis 0 with size {0}".format(n))
+        uniq, inverse = np.unique(idx, return_inverse=True)
+        inverse = inverse.reshape(idx.shape)
+        if self._simple(cols):
+            return self._read(uniq, cols)[inverse]
+        #: Combined row and column arrays use numpy (pointwise) semantics
+        return self._read(uniq, ())[(inverse,) + tuple(cols)]
+
+    @staticmethod
+    def _simple(cols):
+        """Return True if a column selection can be passed to HDF5"""
+        return all(isinstance(c, (slice, int, np.integer)) for c in cols)
+
+    def _read(self, rows, cols):
+        """Read rows (a slice with positive step, or sorted unique indices)
+
+        Column selections made of slices and integers are passed to HDF5,
+        anything else is applied after reading.
+        """
+        if self._simple(cols):
+            if isinstance(rows, np.ndarray) and len(rows) == 0:
+                rows = slice(0, 0)
+            return self._dset[(rows,) + tuple(cols)]
+        return self._read(rows, ())[(slice(None),) + tuple(cols)]
+
+    def chunk_rows(self, nbytes=8 << 20):
+        """Default number of rows per block for iter_chunks (about nbytes, 8 MiB)"""
+        chunks = getattr(self._dset, "chunks", None)
+        row_bytes = int(np.prod(self._dset.shape[1:])) * self.dtype.itemsize
+        rows = max(1, nbytes // max(1, row_bytes))
+        if chunks:
+            #: Align blocks to HDF5 chunk boundaries
+            rows = max(chunks[0], rows // chunks[0] * chunks[0])
+        return rows
+
+    def iter_chunks(self, rows=None, start=0, stop=None):
+        """Iterate over blocks of rows
+
+        Parameters
+        ----------
+        rows : int
+            Number of rows per block.  Defaults to chunk_rows().
+
+        start, stop : int
+            Range of rows to iterate over
+
+        Yields
+        ------
+        block : numpy.ndarray
+            Array with up to `rows` rows
+        """
+        rows = rows or self.chunk_rows()
+        stop = self.count if stop is None else min(stop, self.count)
+        for i0 in range(start, stop, rows):
+            yield self[i0 : min(i0 + rows, stop)]
+
+
+class FieldLogDataset(LogDataset):
+    """A lazy view of one field of a compound dataset (e.g. rows)"""
+
+    _field = Str()
+
+    shape = property(lambda self: (self.count,))
+    dtype = property(lambda self: self._dset.dtype[self._field])
+    ndim = property(lambda self: 1)
+
+    def __init__(self, dset, field, count=None):
+        super(FieldLogDataset, self).__init__(dset, count)
+        self._field = field
+
+    def _read(self, rows, cols):
+        if isinstance(rows, np.ndarray) and len(rows) == 0:
+            rows = slice(0, 0)
+        if isinstance(self._dset, np.ndarray):
+            return self._dset[self._field][rows][(slice(None),) + tuple(cols)]
+        return self._dset.fields(self._field)[rows][(slice(None),) + tuple(cols)]
+
+
+class ConstantLogDataset(LogDataset):
+    """A view of a per-measurement value that is stored once, as an attribute"""
+
+    _value = Value()
+
+    shape = property(lambda self: (self.count,))
+    dtype = property(lambda self: self._value.dtype)
+    ndim = property(lambda self: 1)
+
+    def __init__(self, value, count):
+        self._value = np.asarray(value)
+        self.count = count
+
+    def refresh(self):
+        pass
+
+    def chunk_rows(self, nbytes=8 << 20):
+        return max(1, self.count)
+
+    def _read(self, rows, cols):
+        n = len(range(*rows.indices(self.count))) if isinstance(rows, slice) else len(rows)
+        return np.full(n, self._value)[(slice(None),) + tuple(cols)]
+
+
+#: Memory converters shared by readers, keyed by (Nfft, complexData)
+_converters = {}
+
+
+def _get_converter(Nfft, complexData):
+    """Return a (cached) MemoryConverter for an application layout"""
+    key = (int(Nfft), bool(complexData))
+    if key not in _converters:
+        _converters[key] = MemoryConverter(*key)
+    return _converters[key]
+
+
+class DdrLogDataset(LogDataset):
+    """A lazy view of measurements logged in DDR memory order
+
+    The underlying dataset holds (count, 2, nbins/2) memory contents.  Rows
+    are converted to FFT bin order (float64) with a vectorized gather when
+    they are read.
+    """
+
+    _converter = Typed(MemoryConverter)
+
+    shape = property(lambda self: (self.count, 2 * self._dset.shape[2]))
+    dtype = property(lambda self: np.dtype(np.float64))
+    ndim = property(lambda self: 2)
+
+    def __init__(self, dset, count, converter):
+        super(DdrLogDataset, self).__init__(dset, count)
+        self._converter = converter
+
+    def _read(self, rows, cols):
+        if isinstance(rows, np.ndarray) and len(rows) == 0:
+            rows = slice(0, 0)
+        raw = self._dset[rows]
+        result = self._converter.process(raw[:, 0, :], raw[:, 1, :])
+        return result[(slice(None),) + tuple(cols)]
+
+    def chunk_rows(self, nbytes=8 << 20):
+        chunks = getattr(self._dset, "chunks", None)
+        row_bytes = 8 * self.shape[1]
+        rows = max(1, nbytes // row_bytes)
+        if chunks:
+            rows = max(chunks[0], rows // chunks[0] * chunks[0])
+        return rows
+
+
+def _fft_view(dset, count, attrs):
+    """Return a lazy FFT-order view of a logged dataset"""
+    if attrs.get("layout", "fft") == "ddr":
+        return DdrLogDataset(dset, count, _get_converter(attrs["Nfft"], attrs["complexData"]))
+    return LogDataset(dset, count)
+
+
+class LogPyramidLevel(Atom):
+    """One level of the multi-resolution pyramid of an acquisition
+
+    Row i of a level reduces the acquisition rows
+    i * time_factor ... (i + 1) * time_factor - 1.
+
+    """
+
+    #: Level number (1 is the finest pyramid level)
+    level = Int()
+
+    #: Number of acquisition rows per row of this level
+    time_factor = Int(1)
+
+    #: Number of acquisition bins per bin of this level
+    freq_factor = Int(1)
+
+    #: Block mean, min and max (rows, nbins // freq_factor)
+    mean = Typed(LogDataset)
+    min = Typed(LogDataset)
+    max = Typed(LogDataset)
+
+    def __init__(self, group, level):
+        """Initialize from a pyramid level group"""
+        self.level = level
+        self.time_factor = int(group.attrs["time_factor"])
+        self.freq_factor = int(group.attrs["freq_factor"])
+        dsets = [group[name] for name in ("mean", "min", "max")]
+        count = min(len(dset) for dset in dsets)
+        self.mean, self.min, self.max = [LogDataset(dset, count) for dset in dsets]
+
+    def __len__(self):
+        return self.mean.count
+
+    def refresh(self, msrmnt_count):
+        """Update the row count (SWMR), limited to complete blocks of the acquisition"""
+        views = (self.mean, self.min, self.max)
+        for view in views:
+            view.refresh()
+        count = min([view.count for view in views] + [msrmnt_count // self.time_factor])
+        for view in views:
+            view.count = count
+
+
+class LogAcquisition(Atom):
+    """One acquisition in a spectrum log file
+
+    Behaves as a lazy (msrmnt_count, nbins) array of spectra: it can be
+    sliced by rows and columns, iterated in chunks with iter_chunks() and
+    converted with numpy.asarray().  Data is only read when requested.
+    Measurements logged in DDR memory order are converted to FFT bin
+    order as they are read.
+
+    The rows table holds the timestamps, hardware measurement number and
+    flags (ROW_FLAG_*) of each measurement, also available as separate
+    views.  Logs written before the rows table was introduced have no
+    timestamps (rows, time_monotonic_ns, time_utc_ns and flags are None).
+
+    find_msrmt() and find_time() locate a measurement by hardware
+    measurement number or by time with binary searches of the row index,
+    and read_range() reads the spectra of a time interval.
+
+    For compatibility with earlier versions of the reader, the fields
+    name, msrmnt_count, fftdata, num_averages, msrmnt_idx, acq_id and
+    segment can also be accessed as items, e.g. acq["fftdata"].
+
+    """
+
+    #: Group name, e.g. acq00000001
+    name = Str()
+
+    #: Number of measurements
+    msrmnt_count = Int()
+
+    #: Acquisition number within the logger session
+    acq_id = Int()
+
+    #: Index of this part of an acquisition that was continued across files
+    segment = Int()
+
+    #: Spectra (msrmnt_count, nbins)
+    fftdata = Typed(LogDataset)
+
+    #: Number of averages of each measurement
+    num_averages = Typed(LogDataset)
+
+    #: Hardware measurement number of each measurement
+    msrmnt_idx = Typed(LogDataset)
+
+    #: Rows table (ROW_DTYPE records)
+    rows = Typed(LogDataset)
+
+    #: Time (time.monotonic_ns) each measurement was read
+    time_monotonic_ns = Typed(LogDataset)
+
+    #: Time (time.time_ns) each measurement was read
+    time_utc_ns = Typed(LogDataset)
+
+    #: ROW_FLAG_* bits of each measurement
+    flags = Typed(LogDataset)
+
+    #: Multi-resolution pyramid levels (LogPyramidLevel), finest first
+    pyramid = List()
+
+    _group = Value()
+
+    #: Search keys of the rows fields {field: (stride, keys)}
+    _index = Dict()
+
+    _fields = ("name", "msrmnt_count", "fftdata", "num_averages", "msrmnt_idx", "acq_id", "segment")
+
+    attrs = property(lambda self: self._group.attrs)
+    shape = property(lambda self: self.fftdata.shape)
+
+    #: Indices of the stored frequency bins, or None if all bins were stored
+    bin_index = property(
+        lambda self: (
+            np.concatenate([np.arange(a, b) for a, b in np.reshape(self.attrs["bin_ranges"], (-1, 2))])
+            if "bin_ranges" in self.attrs
+            else None
+        )
+    )
+    dtype = property(lambda self: self.fftdata.dtype)
+    ndim = property(lambda self: self.fftdata.ndim)
+
+    def __init__(self, group):
+        """Initialize from an acquisition group
+
+        The measurement count is taken from the group's count attribute,
+        or from the dataset length if the attribute is missing.
+        """
+        self._group = group
+        self.name = group.name.split("/")[-1]
+
+        #: Measurements logged in DDR memory order are converted when read
+        fftdata = group["ddrdata"] if "ddrdata" in group else group["fftdata"]
+        count = int(group.attrs.get("count", len(fftdata)))
+
+        self.fftdata = _fft_view(fftdata, count, group.attrs)
+        self.msrmnt_count = self.fftdata.count
+        if "rows" in group:
+            self._set_rows(group["rows"], count, group.attrs)
+        else:
+            self.num_averages = LogDataset(group["num_averages"], count)
+            self.msrmnt_idx = LogDataset(group["msrmt_num"], count)
+        self.acq_id = int(group.attrs.get("acq_id", 0))
+        self.segment = int(group.attrs.get("segment", 0))
+
+        if "pyramid" in group:
+            pgroup = group["pyramid"]
+            self.pyramid = [
+                LogPyramidLevel(pgroup["level{0}".format(n)], n) for n in range(1, int(pgroup.attrs["levels"]) + 1)
+            ]
+
+    def _set_rows(self, rows, count, attrs):
+        """Create the views of a rows table"""
+        self.rows = LogDataset(rows, count)
+        self.msrmnt_idx = FieldLogDataset(rows, "msrmt_num", count)
+        self.time_monotonic_ns = FieldLogDataset(rows, "monotonic_ns", count)
+        self.time_utc_ns = FieldLogDataset(rows, "utc_ns", count)
+        self.flags = FieldLogDataset(rows, "flags", count)
+        self.num_averages = ConstantLogDataset(np.int32(attrs.get("numAverages", 0)), count)
+
+    def set_cache(self, cache):
+        """Read the spectra and pyramid levels through a LogBlockCache (None: no cache)"""
+        for view in self._cached_views():
+            if view.cache is not None:
+                view.cache.discard(view)
+            view.cache = cache
+
+    def _cached_views(self):
+        """Views read through the block cache"""
+        return [self.fftdata] + [getattr(level, name) for level in self.pyramid for name in ("mean", "min", "max")]
+
+    def _views(self):
+        """Per-measurement views of the acquisition"""
+        views = (self.fftdata, self.rows, self.num_averages, self.msrmnt_idx)
+        views += (self.time_monotonic_ns, self.time_utc_ns, self.flags)
+        return [view for view in views if view is not None]
+
+    def __len__(self):
+        return self.msrmnt_count
+
+    def __repr__(self):
+        return "<{0} {1} shape={2}>".format(self.__class__.__name__, self.name, self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.fftdata.__array__(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        return self.fftdata[key]
+
+    def keys(self):
+        return list(self._fields)
+
+    def refresh(self):
+        """Update the measurement count of an acquisition being written in SWMR mode
+
+        The file must have been opened with SpectrumDataReader(file, swmr=True).
+        """
+        views = self._views()
+        for view in views:
+            view.refresh()
+
+        #: Datasets are extended one after another; use the rows present in all of them
+        count = min(view.count for view in views if not isinstance(view, ConstantLogDataset))
+        for view in views:
+            view.count = count
+        self.msrmnt_count = count
+
+        for level in self.pyramid:
+            level.refresh(count)
+
+        #: Reload the row index with the new rows
+        self._index = {}
+        if "row_index" in self._group:
+            self._group["row_index"].refresh()
+
+    def _index_keys(self, field):
+        """Return (stride, keys): keys[j] is the field of row j * stride"""
+        if field not in self._index:
+            group = self._group
+            if group is not None and "row_index" in group:
+                dset = group["row_index"]
+                self._index[field] = (int(dset.attrs["stride"]), dset.fields(field)[:])
+            else:
+                #: Raw logs (memory maps) and logs without a row index are searched directly
+                self._index[field] = (1, self._field_view(field)[:])
+        return self._index[field]
+
+    def _field_view(self, field):
+        """View of a sorted rows field"""
+        view = self.msrmnt_idx if field == "msrmt_num" else self.time_utc_ns
+        if view is None:
+            raise ValueError("Acquisition {0} has no timestamps".format(self.name))
+        return view
+
+    def _search(self, field, value):
+        """Return the first row whose field is >= value
+
+        The row index is searched first, then the block of rows between two
+        index entries is read (one hyperslab) and searched.
+        """
+        view = self._field_view(field)
+        n = self.msrmnt_count
+        stride, keys = self._index_keys(field)
+        keys = keys[: -(-n // stride)]
+
+        j = int(np.searchsorted(keys, value, side="left")) - 1
+        if j < 0:
+            return 0
+        if stride == 1:
+            return j + 1
+
+        #: The index may lag the rows of a file being written (SWMR)
+        i0 = j * stride
+        i1 = n if j == len(keys) - 1 else min(i0 + stride, n)
+        return i0 + int(np.searchsorted(view[i0:i1], value, side="left"))
+
+    def find_msrmt(self, msrmt_num):
+        """Return the row of a hardware measurement number
+
+        Measurement numbers increase along the acquisition, so the row is
+        found with a binary search.  Raises KeyError if the measurement was
+        not logged.
+        """
+        i = self._search("msrmt_num", msrmt_num)
+        if i >= self.msrmnt_count or self.msrmnt_idx[i] != msrmt_num:
+            raise KeyError(msrmt_num)
+        return i
+
+    def find_time(self, t):
+        """Return the first row read at or after time t
+
+        Parameters
+        ----------
+        t : float or datetime.datetime
+            Time (time.time seconds or datetime)
+
+        Returns
+        -------
+        row : int
+            Row of the first measurement with time_utc_ns >= t, or
+            msrmnt_count if all measurements were read before t
+        """
+        return self._search("utc_ns", _time_ns(t))
+
+    def time_slice(self, t0=None, t1=None):
+        """Return the slice of rows read in the interval [t0, t1)
+
+        t0 and t1 are time.time seconds or datetime.  None leaves the
+        interval open.  The slice can be used to index fftdata, rows and
+        the other per-measurement views.
+        """
+        start = 0 if t0 is None else self.find_time(t0)
+        stop = self.msrmnt_count if t1 is None else self.find_time(t1)
+        return slice(start, max(start, stop))
+
+    def read_range(self, t0=None, t1=None):
+        """Read the spectra of the measurements read in the interval [t0, t1)
+
+        The rows are located with binary searches and read with a single
+        hyperslab selection.
+        """
+        return self.fftdata[self.time_slice(t0, t1)]
+
+    def overview(self, start=0, stop=None, max_rows=2048):
+        """Read a range of measurements at the coarsest useful resolution
+
+        The finest pyramid level that returns at most max_rows rows for the
+        range is read (the acquisition itself if it is small enough, or the
+        coarsest level if no level is).
+
+        Parameters
+        ----------
+        start, stop : int
+            Range of measurements (acquisition rows)
+
+        max_rows : int
+            Maximum number of rows to return
+
+        Returns
+        -------
+        result : dict
+            level       : pyramid level read (0: the acquisition)
+            time_factor : measurements per returned row
+            freq_factor : bins per returned bin
+            rows        : first measurement of each returned row
+            mean        : block mean (rows, bins)
+            min         : block minimum
+            max         : block maximum
+        """
+        start, stop, _ = slice(start, stop).indices(self.msrmnt_count)
+
+        if stop - start <= max_rows or not self.pyramid:
+            data = self.fftdata[start:stop]
+            return {
+                "level": 0,
+                "time_factor": 1,
+                "freq_factor": 1,
+                "rows": np.arange(start, stop),
+                "mean": data,
+                "min": data,
+                "max": data,
+            }
+
+        for level in self.pyramid:
+            if (stop - start) // level.time_factor <= max_rows:
+                break
+
+        #: Blocks that overlap the range
+        tf = level.time_factor
+        i0 = start // tf
+        i1 = min(len(level), -(-stop // tf))
+        return {
+            "level": level.level,
+            "time_factor": tf,
+            "freq_factor": level.freq_factor,
+            "rows": np.arange(i0, i1) * tf,
+            "mean": level.mean[i0:i1],
+            "min": level.min[i0:i1],
+            "max": level.max[i0:i1],
+        }
+
+    def iter_chunks(self, rows=None, start=0, stop=None):
+        """Iterate over blocks of spectra (see LogDataset.iter_chunks)"""
+        return self.fftdata.iter_chunks(rows, start, stop)
+
+
 class SpectrumDataReader(Atom):
     """Spectrum log file reader
 
     Read a spectrom log file in HDF5 File format
 
+    Opening a file only reads its structure.  Each acquisition is a
+    LogAcquisition, which reads measurements on demand.  The reader can be
+    used as a context manager to close the file:
+
+        with SpectrumDataReader(path) as reader:
+            for acq in reader.acquisitions:
+                for block in acq.iter_chunks():
+                    ...
+
+    A file that is being written in SWMR mode can be opened with swmr=True
+    and followed with follow().
+
+    Readers used for browsing can keep decoded blocks of spectra in a
+    LogBlockCache (see the cache parameter).
+
     """
 
-    #: Number of acquisitions
+    #: List of acquisitions (LogAcquisition)
     acquisitions = property(lambda self: self._acquisitions)
 
+    #: Block cache (LogBlockCache) of the spectra, or None
+    cache = Value()
+
     _filepath = Str()
     _file = Value()
     _acquisitions = List()
+    _swmr = Bool()
 
-    def __init__(self, file):
+    def __init__(self, file, swmr=False, cache=None):
         """Initialize the reader
 
         Parameters
@@ -233,34 +2348,153 @@ class SpectrumDataReader(Atom):
         file: str
             Path of file to read
 
+        swmr: bool
+            Open the file as a single-writer/multiple-reader reader, so
+            that a file being written by SpectrumDataLogger can be followed.
+
+        cache: LogBlockCache or int
+            Cache of decoded blocks of spectra (and pyramid levels) for
+            repeated reads, e.g. when browsing a log interactively.  An int
+            creates a LogBlockCache with this byte budget.  None reads
+            from file each time.
+
         """
         self._filepath = file
-        self._file = h5py.File(file, "r")
-        n_acq = self._file.attrs["n_acq"]
+        self._swmr = swmr
+
+        #: Files may have been compressed with filters of the hdf5plugin package
+        load_plugins()
+
+        if swmr:
+            self._file = h5py.File(file, "r", libver="latest", swmr=True)
+        else:
+            self._file = h5py.File(file, "r")
 
         logger.debug("Opened file {0}".format(self._filepath))
 
         #: Sort by acquisiton name (integer order), e.g. acq00000001
-        keys = sorted(self._file.keys())
+        keys = sorted(k for k in self._file.keys() if k.startswith("acq"))
+
+        #: n_acq may be missing if the writer did not close the file
+        n_acq = self._file.attrs.get("n_acq", len(keys))
+
+        self._acquisitions = [LogAcquisition(self._file[key]) for key in keys[0:n_acq]]
+
+        if cache is not None:
+            self.cache = LogBlockCache(max_bytes=cache) if isinstance(cache, int) else cache
+            for acquisition in self._acquisitions:
+                acquisition.set_cache(self.cache)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, dtype, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._acquisitions)
+
+    def __getitem__(self, idx):
+        return self._acquisitions[idx]
+
+    def close(self):
+        """Close the file"""
+        if self._file is not None:
+            for acquisition in self._acquisitions:
+                acquisition.set_cache(None)
+            self._file.close()
+            self._file = None
+            self._acquisitions = []
+
+    def writer_done(self):
+        """Return True if the writer has closed the file
+
+        Files that were not written in SWMR mode are always complete.
+        """
+        dset = self._file.get("writer_done")
+        if dset is None:
+            return True
+        if self._swmr:
+            dset.refresh()
+        return bool(dset[0])
+
+    def find_time(self, t):
+        """Locate the first measurement read at or after time t
+
+        Parameters
+        ----------
+        t : float or datetime.datetime
+            Time (time.time seconds or datetime)
+
+        Returns
+        -------
+        location : (int, int) or None
+            Index of the acquisition and row of the measurement, or None if
+            all measurements were read before t
+        """
+        for k, acquisition in enumerate(self._acquisitions):
+            if acquisition.time_utc_ns is None:
+                continue
+            row = acquisition.find_time(t)
+            if row < acquisition.msrmnt_count:
+                return k, row
+        return None
+
+    def follow(self, acq=-1, start=0, poll_interval=0.25, timeout=None):
+        """Yield new spectra as they are written to the file
+
+        Only the dataset extent is polled, so the file is not reopened.
+        The generator ends when the writer closes the file, or when no new
+        measurements have been written for `timeout` seconds.
+
+        Parameters
+        ----------
+        acq : int
+            Index of the acquisition to follow
+
+        start : int
+            First measurement to yield
+
+        poll_interval : float
+            Time (seconds) between checks for new measurements
+
+        timeout : float
+            Time (seconds) without new measurements after which to stop.
+            None waits until the writer closes the file.
+
+        Yields
+        ------
+        block : numpy.ndarray
+            (n, nbins) array of spectra written since the previous block
+
+        """
+        if not self._swmr:
+            raise RuntimeError("Open the reader with swmr=True to follow a file")
+
+        acquisition = self._acquisitions[acq]
+        pos = start
+        last = time.monotonic()
+
+        while True:
+            #: Check before refreshing so that the last rows are not missed
+            finished = self.writer_done()
 
-        acquisitions = []
-        for key in keys[0:n_acq]:
-            acqgroup = self._file[key]
+            acquisition.refresh()
+            count = len(acquisition)
 
-            fftdata = acqgroup["fftdata"]
-            nrec, fftdiv2 = np.shape(fftdata)
-            count = acqgroup.attrs["count"]  #: Measurement count
+            if count > pos:
+                yield acquisition[pos:count]
+                pos = count
+                last = time.monotonic()
 
-            acq_result = {}
-            acq_result["name"] = key
-            acq_result["msrmnt_count"] = count
-            acq_result["fftdata"] = fftdata[0:count, :]  #: Trim to size
-            acq_result["num_averages"] = acqgroup["num_averages"]
-            acq_result["msrmnt_idx"] = acqgroup["msrmt_num"]
+            elif finished:
+                return
 
-            acquisitions.append(acq_result)
+            elif timeout is not None and time.monotonic() - last >= timeout:
+                return
 
-        self._acquisitions = acquisitions
+            else:
+                time.sleep(poll_interval)
 
 
 if __name__ == "__main__":
@@ -81,6 +81,35 @@ def get_slow_properties(device):
     return result
 
 
+def get_log_settings(device):
+    """Get the settings recorded with logged acquisitions
+
+    These settings do not change during an acquisition and are stored once
+    per acquisition by SpectrumDataLogger (see SpectrumDataLogger.settings).
+
+    Parameters
+    -----------
+    device : pyspectro.driver.Spectrometer
+
+    Returns
+    -------
+    result : dict
+        Dictionary of HDF5 attribute compatible values
+    """
+
+    result = {}
+
+    result["SampleRate"] = device.sampleRate
+    result["downsample_ratio"] = device.downsample_ratio
+    result["numAverages"] = device.numAverages
+    result["VoltageRange"] = device.instrument.Channels["Channel1"].Range
+    result["disablePolyphase"] = bool(device.disablePolyphase)
+    result["bitfile"] = device.bitfile
+    result["SerialNumber"] = device.instrument.InstrumentInfo.SerialNumberString
+
+    return result
+
+
 def get_instrument_properties(device):
     """Get instrument data
 
@@ -0,0 +1,370 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, DSPlogic, Inc.  All Rights Reserved.
+#
+# RESTRICTED RIGHTS
+# Use of this software is permitted only with a software license agreement.
+#
+# Details of the software license agreement are in the file LICENSE.txt,
+# distributed with this software.
+# -----------------------------------------------------------------------------
+
+"""SQLite catalog of logged acquisitions
+
+The catalog holds one row per acquisition segment (a group in an HDF5 log
+or an acquisition in a raw log) with the metadata needed to find logged
+data without opening the log files:
+
+    file          : full path of the log file
+    grp           : acquisition group name (acq00000001, ...)
+    acq_id        : acquisition number within the logger session
+    segment       : index of this part of the acquisition
+    session       : logger session timestamp
+    start_time    : time (time.time) the acquisition segment was started
+    stop_time     : time (time.time) the last measurements were written
+    rows          : number of measurements
+    nfft          : FFT size
+    complex_data  : 1 for FFT of complex data
+    num_averages  : number of averages per measurement
+    sample_rate   : sample rate (Hz)
+    serial        : instrument serial number
+
+SpectrumDataLogger updates the catalog each time it flushes measurements
+(see SpectrumDataLogger.catalog).  rebuild_catalog scans existing log
+files in parallel and replaces the catalog contents:
+
+    python -m pyspectro.applib.logcatalog [directory]
+
+Example query:
+
+    with LogCatalog() as catalog:
+        rows = catalog.find(t0=datetime(2021, 6, 1), t1=datetime(2021, 6, 2), serial="MY00090383", num_averages=8192)
+
+"""
+
+import datetime
+import glob
+import logging
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from atom.api import Atom, Str, Value
+
+from .datalogger import PYHOME, list_log_files
+
+logger = logging.getLogger(__name__)
+
+#: Default catalog file name (in the log directory)
+CATALOG_NAME = "pyspectro_catalog.sqlite"
+
+#: Catalog columns
+CATALOG_COLUMNS = (
+    "file",
+    "grp",
+    "acq_id",
+    "segment",
+    "session",
+    "start_time",
+    "stop_time",
+    "rows",
+    "nfft",
+    "complex_data",
+    "num_averages",
+    "sample_rate",
+    "serial",
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS acquisitions (
+    file TEXT NOT NULL,
+    grp TEXT NOT NULL,
+    acq_id INTEGER,
+    segment INTEGER,
+    session TEXT,
+    start_time REAL,
+    stop_time REAL,
+    rows INTEGER,
+    nfft INTEGER,
+    complex_data INTEGER,
+    num_averages INTEGER,
+    sample_rate REAL,
+    serial TEXT,
+    PRIMARY KEY (file, grp)
+);
+CREATE INDEX IF NOT EXISTS acquisitions_time ON acquisitions (start_time, stop_time);
+CREATE INDEX IF NOT EXISTS acquisitions_serial ON acquisitions (serial, start_time);
+CREATE INDEX IF NOT EXISTS acquisitions_num_averages ON acquisitions (num_averages, start_time);
+"""
+
+
+def _timestamp(t):
+    """Convert a datetime to time.time() seconds"""
+    if isinstance(t, datetime.datetime):
+        return t.timestamp()
+    return t
+
+
+def _attr(value):
+    """Convert an HDF5 attribute to a plain Python value
+
+    Array attributes (e.g. bin_ranges) become lists.
+    """
+    if hasattr(value, "item"):
+        value = value.item() if np.ndim(value) == 0 else value.tolist()
+    if isinstance(value, bytes):
+        value = value.decode()
+    return value
+
+
+def scan_log_file(path):
+    """Read the catalog entries of a log file
+
+    Parameters
+    ----------
+    path : str
+        Path of an HDF5 log file or raw log directory
+
+    Returns
+    -------
+    entries : list of dict
+        One entry (with the CATALOG_COLUMNS keys) per acquisition segment
+    """
+    entries = []
+
+    if os.path.isdir(path):
+        from .rawlog import RawLogReader
+
+        with RawLogReader(path) as reader:
+            session = reader.header.get("session", "")
+            for acq in reader.acquisitions:
+                attrs = acq.attrs
+                entries.append(catalog_entry(path, acq.name, session, attrs, len(acq), attrs.get("numAverages")))
+        return entries
+
+    import h5py
+
+    with h5py.File(path, "r") as f:
+        session = _attr(f.attrs.get("session", ""))
+        for name in f:
+            if not name.startswith("acq"):
+                continue
+            group = f[name]
+            attrs = {key: _attr(value) for key, value in group.attrs.items()}
+            rows = attrs.get("count", len(group["rows"] if "rows" in group else group["msrmt_num"]))
+            num_averages = attrs.get("numAverages")
+            if num_averages is None and rows and "num_averages" in group:
+                num_averages = int(group["num_averages"][0])
+            entries.append(catalog_entry(path, name, session, attrs, rows, num_averages))
+
+    return entries
+
+
+def catalog_entry(path, name, session, attrs, rows, num_averages):
+    """Build a catalog entry
+
+    Parameters
+    ----------
+    path : str
+        Path of the log file
+
+    name : str
+        Acquisition group name
+
+    session : str
+        Logger session timestamp
+
+    attrs : dict
+        Acquisition attributes (HDF5 group attributes or raw log header entry)
+
+    rows : int
+        Number of measurements
+
+    num_averages : int
+        Number of averages per measurement
+
+    """
+    return {
+        "file": os.path.abspath(path),
+        "grp": name,
+        "acq_id": attrs.get("acq_id"),
+        "segment": attrs.get("segment", 0),
+        "session": session,
+        "start_time": attrs.get("start_time"),
+        "stop_time": attrs.get("stop_time", attrs.get("start_time")),
+        "rows": int(rows),
+        "nfft": attrs.get("Nfft"),
+        "complex_data": None if attrs.get("complexData") is None else int(attrs.get("complexData")),
+        "num_averages": num_averages,
+        "sample_rate": attrs.get("SampleRate"),
+        "serial": attrs.get("SerialNumber"),
+    }
+
+
+class LogCatalog(Atom):
+    """SQLite catalog of logged acquisitions
+
+    The database is opened in write-ahead-log mode, so that queries are not
+    blocked while the logger writes.  A LogCatalog must be used by the
+    thread that created it.
+
+    """
+
+    #: Path of the catalog database
+    path = Str()
+
+    _conn = Value()
+
+    def __init__(self, path=None):
+        """Open (or create) a catalog
+
+        Parameters
+        ----------
+        path : str
+            Path of the catalog database.  Defaults to CATALOG_NAME in PYHOME.
+
+        """
+        self.path = path or os.path.join(PYHOME, CATALOG_NAME)
+        self._conn = sqlite3.connect(self.path, timeout=10.0)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, dtype, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM acquisitions").fetchone()[0]
+
+    def close(self):
+        """Close the database"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def update(self, entries, clear=False):
+        """Insert or replace catalog entries
+
+        Parameters
+        ----------
+        entries : dict or list of dict
+            Entries with the CATALOG_COLUMNS keys
+
+        clear : bool
+            Remove all other entries in the same transaction
+
+        """
+        if isinstance(entries, dict):
+            entries = [entries]
+        sql = "INSERT OR REPLACE INTO acquisitions ({0}) VALUES ({1})".format(
+            ", ".join(CATALOG_COLUMNS), ", ".join(":" + c for c in CATALOG_COLUMNS)
+        )
+        with self._conn:
+            if clear:
+                self._conn.execute("DELETE FROM acquisitions")
+            self._conn.executemany(sql, entries)
+
+    def remove(self, file):
+        """Remove the entries of a log file"""
+        with self._conn:
+            self._conn.execute("DELETE FROM acquisitions WHERE file = ?", (os.path.abspath(file),))
+
+    def clear(self):
+        """Remove all entries"""
+        with self._conn:
+            self._conn.execute("DELETE FROM acquisitions")
+
+    def find(self, t0=None, t1=None, **kwargs):
+        """Find acquisition segments
+
+        Parameters
+        ----------
+        t0, t1 : float or datetime.datetime
+            Only return segments that overlap the interval [t0, t1]
+            (time.time seconds or datetime)
+
+        kwargs :
+            Column values to match, e.g. serial="MY00090383", num_averages=8192
+
+        Returns
+        -------
+        entries : list of dict
+            Matching entries ordered by start time
+        """
+        where = []
+        params = []
+        if t0 is not None:
+            where.append("stop_time >= ?")
+            params.append(_timestamp(t0))
+        if t1 is not None:
+            where.append("start_time <= ?")
+            params.append(_timestamp(t1))
+        for key, value in kwargs.items():
+            if key not in CATALOG_COLUMNS:
+                raise ValueError("Unknown catalog column {0}".format(key))
+            where.append("{0} = ?".format(key))
+            params.append(os.path.abspath(value) if key == "file" else value)
+
+        sql = "SELECT * FROM acquisitions"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY start_time, file, grp"
+
+        return [dict(row) for row in self._conn.execute(sql, params)]
+
+
+def rebuild_catalog(directory=None, path=None, max_workers=None):
+    """Rebuild a catalog from the log files in a directory
+
+    Log files are scanned in parallel by a process pool.  Files that cannot
+    be read are skipped with a warning.
+
+    Parameters
+    ----------
+    directory : str
+        Log directory.  Defaults to PYHOME.
+
+    path : str
+        Path of the catalog.  Defaults to CATALOG_NAME in the log directory.
+
+    max_workers : int
+        Number of processes.  Defaults to the number of CPUs.
+
+    Returns
+    -------
+    n : int
+        Number of catalog entries
+    """
+    from .rawlog import RAW_LOG_SUFFIX
+
+    directory = directory or PYHOME
+    path = path or os.path.join(directory, CATALOG_NAME)
+    files = list_log_files(directory) + sorted(glob.glob(os.path.join(directory, "*" + RAW_LOG_SUFFIX)))
+
+    entries = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [(f, pool.submit(scan_log_file, f)) for f in files]
+        for f, future in futures:
+            try:
+                entries.extend(future.result())
+            except Exception as e:
+                logger.warning("Could not scan %s: %s" % (f, e))
+
+    with LogCatalog(path) as catalog:
+        catalog.update(entries, clear=True)
+
+    logger.info("Cataloged %s acquisitions from %s files in %s" % (len(entries), len(files), path))
+    return len(entries)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    #: Rebuild the catalog of the directory given on the command line
+    rebuild_catalog(sys.argv[1] if len(sys.argv) > 1 else None)
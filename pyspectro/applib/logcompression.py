@@ -0,0 +1,279 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, DSPlogic, Inc.  All Rights Reserved.
+#
+# RESTRICTED RIGHTS
+# Use of this software is permitted only with a software license agreement.
+#
+# Details of the software license agreement are in the file LICENSE.txt,
+# distributed with this software.
+# -----------------------------------------------------------------------------
+
+"""Compression filters for HDF5 spectrum logs
+
+Spectra are noisy floating point values, which compress poorly unless
+the bytes of the values are regrouped first.  Every filter here is
+therefore combined with a shuffle filter (the HDF5 byte shuffle, or the
+shuffle built into blosc and bitshuffle).
+
+Filters:
+
+    lzf         : shuffle + LZF (built into h5py, fast)
+    gzip        : shuffle + deflate (built into HDF5, best supported)
+    blosc-lz4   : blosc with byte shuffle and LZ4
+    blosc-zstd  : blosc with byte shuffle and Zstandard
+    lz4         : shuffle + LZ4
+    zstd        : shuffle + Zstandard
+    bitshuffle  : bit shuffle + LZ4
+
+The filters after gzip require the hdf5plugin package, both to write and to
+read the files.  available_compressions() lists the filters that can be
+used.
+
+calibrate_compression() writes a sample of measurements with each filter
+into an in-memory HDF5 file and measures the compression ratio and write
+throughput.  It chooses the filter with the best ratio among the filters
+that keep up with the measurement rate (see SpectrumDataLogger.compression
+= "auto").  calibrate_compression_process() runs it in a separate Python
+process, so that its HDF5 writes do not hold the h5py lock of the caller's
+process (e.g. while a logger is writing).
+
+"""
+
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import h5py
+
+    use_h5py = True
+except ImportError:
+    use_h5py = False
+
+logger = logging.getLogger(__name__)
+
+#: Compression filters, in order of preference for equal results
+COMPRESSION_FILTERS = ("lzf", "gzip", "blosc-lz4", "blosc-zstd", "lz4", "zstd", "bitshuffle")
+
+
+def load_plugins():
+    """Register the filters of the hdf5plugin package, if it is installed
+
+    Returns the hdf5plugin module, or None.
+    """
+    try:
+        import hdf5plugin
+    except ImportError:
+        return None
+    return hdf5plugin
+
+
+def _builtin_available(name):
+    """Return True if a filter built into h5py is available"""
+    ids = {"lzf": getattr(h5py.h5z, "FILTER_LZF", 32000), "gzip": h5py.h5z.FILTER_DEFLATE}
+    return bool(h5py.h5z.filter_avail(ids[name]))
+
+
+def available_compressions():
+    """Return the names of the filters that can be used (see COMPRESSION_FILTERS)"""
+    if not use_h5py:
+        return []
+    names = [name for name in ("lzf", "gzip") if _builtin_available(name)]
+    if load_plugins() is not None:
+        names += [name for name in COMPRESSION_FILTERS if name not in names]
+    return names
+
+
+def compression_options(name):
+    """Return the h5py create_dataset arguments of a filter
+
+    Parameters
+    ----------
+    name : str
+        Filter name (see COMPRESSION_FILTERS).  None, "" or "none" stores
+        the data uncompressed.
+
+    Returns
+    -------
+    kwargs : dict
+        compression, compression_opts and shuffle arguments
+    """
+    if name in (None, "", "none"):
+        return {}
+    if name in ("lzf", "gzip"):
+        return {"compression": name, "shuffle": True}
+    if name not in COMPRESSION_FILTERS:
+        raise ValueError("Unknown compression filter {0}".format(name))
+
+    hdf5plugin = load_plugins()
+    if hdf5plugin is None:
+        raise ValueError("The {0} compression filter requires the hdf5plugin package".format(name))
+
+    if name == "blosc-lz4":
+        return dict(hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if name == "blosc-zstd":
+        return dict(hdf5plugin.Blosc(cname="zstd", clevel=3, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if name == "lz4":
+        return dict(hdf5plugin.LZ4(), shuffle=True)
+    if name == "zstd":
+        return dict(hdf5plugin.Zstd(), shuffle=True)
+    return dict(hdf5plugin.Bitshuffle())
+
+
+def measure_compression(sample, name, repeat=3):
+    """Measure the compression ratio and write throughput of a filter
+
+    The sample is written (as a single chunk) to an in-memory HDF5 file,
+    so the measurement does not include disk time.
+
+    Parameters
+    ----------
+    sample : numpy.ndarray
+        Measurements (rows, ...) to compress
+
+    name : str
+        Filter name, or "none"
+
+    repeat : int
+        Number of writes.  The fastest one is used.
+
+    Returns
+    -------
+    result : dict
+        name     : filter name
+        ratio    : uncompressed size / compressed size
+        mb_per_s : write throughput (uncompressed MB per second)
+    """
+    sample = np.ascontiguousarray(sample)
+    options = compression_options(name)
+    elapsed = np.inf
+    for k in range(repeat):
+        with h5py.File("calibration%s" % k, "w", driver="core", backing_store=False) as f:
+            dset = f.create_dataset("data", sample.shape, chunks=sample.shape, dtype=sample.dtype, **options)
+            tstart = time.perf_counter()
+            dset[...] = sample
+            f.flush()
+            elapsed = min(elapsed, time.perf_counter() - tstart)
+            stored = dset.id.get_storage_size()
+
+    return {
+        "name": name,
+        "ratio": sample.nbytes / max(1, stored),
+        "mb_per_s": sample.nbytes / 1e6 / max(elapsed, 1e-9),
+    }
+
+
+def calibrate_compression(sample, rate=None, candidates=None, margin=2.0):
+    """Choose a compression filter for a measurement rate
+
+    Parameters
+    ----------
+    sample : numpy.ndarray
+        Measurements (rows, ...) representative of the data to be logged
+
+    rate : float
+        Measurements per second to be logged.  None chooses the best
+        compression ratio regardless of throughput.
+
+    candidates : list of str
+        Filters to measure.  Defaults to available_compressions().
+
+    margin : float
+        Required throughput, as a multiple of the logged data rate (the
+        filter shares the logger thread with file writes)
+
+    Returns
+    -------
+    name : str
+        The filter with the best compression ratio among those that write
+        at least margin * rate measurements per second, or the fastest
+        filter if none does.  "none" if compression does not help.
+
+    results : list of dict
+        Measurements of each filter (see measure_compression), including
+        "none"
+    """
+    sample = np.asarray(sample)
+    candidates = available_compressions() if candidates is None else list(candidates)
+
+    results = [measure_compression(sample, "none")]
+    for name in candidates:
+        try:
+            results.append(measure_compression(sample, name))
+        except (ValueError, OSError) as e:
+            logger.warning("Could not measure compression filter %s: %s" % (name, e))
+
+    required = 0.0
+    if rate:
+        required = margin * rate * sample[0].nbytes / 1e6
+
+    fast = [r for r in results if r["mb_per_s"] >= required]
+    if fast:
+        best = max(fast, key=lambda r: (round(r["ratio"], 2), r["mb_per_s"]))
+    else:
+        best = max(results, key=lambda r: r["mb_per_s"])
+
+    for r in results:
+        logger.info(
+            "Compression {0:>10s}: ratio {1:5.2f}, {2:8.1f} MB/s{3}".format(
+                r["name"], r["ratio"], r["mb_per_s"], " (chosen)" if r is best else ""
+            )
+        )
+    logger.info("Required throughput %.1f MB/s" % required)
+    return best["name"], results
+
+
+def calibrate_compression_process(sample, rate=None, timeout=60.0):
+    """Run calibrate_compression in a separate Python process
+
+    The sample is passed through a temporary .npy file, and the results are
+    read back as JSON.  The calling thread waits for the process, without
+    holding the GIL or the h5py lock.
+
+    Parameters
+    ----------
+    sample : numpy.ndarray
+        Measurements (rows, ...) representative of the data to be logged
+
+    rate : float
+        Measurements per second to be logged (see calibrate_compression)
+
+    timeout : float
+        Seconds to wait for the process
+
+    Returns
+    -------
+    name, results :
+        See calibrate_compression
+    """
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([root] + [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+
+    with tempfile.TemporaryDirectory(prefix="pyspectro_calibration") as tmpdir:
+        path = os.path.join(tmpdir, "sample.npy")
+        np.save(path, np.asarray(sample))
+        args = [sys.executable, "-m", __name__, path, "" if rate is None else repr(float(rate))]
+        proc = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, timeout=timeout)
+
+    if proc.returncode != 0:
+        raise RuntimeError("Compression calibration failed: %s" % proc.stderr.decode(errors="replace").strip())
+    output = json.loads(proc.stdout.decode())
+    return output["name"], output["results"]
+
+
+def _main(argv):
+    """Calibrate the sample in file argv[1] for rate argv[2] (see calibrate_compression_process)"""
+    sample = np.load(argv[1])
+    name, results = calibrate_compression(sample, float(argv[2]) if argv[2] else None)
+    json.dump({"name": name, "results": results}, sys.stdout)
+
+
+if __name__ == "__main__":
+    _main(sys.argv)
@@ -0,0 +1,351 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, DSPlogic, Inc.  All Rights Reserved.
+#
+# RESTRICTED RIGHTS
+# Use of this software is permitted only with a software license agreement.
+#
+# Details of the software license agreement are in the file LICENSE.txt,
+# distributed with this software.
+# -----------------------------------------------------------------------------
+
+"""Merge and compact HDF5 spectrum logs
+
+Log rotation, crashes and short runs leave many small log files.  This
+module merges the files of each logger session into large files with
+large chunks:
+
+    pyspectro-logmerge SOURCE_DIR DEST_DIR [--target-mb 1024] [--dtype float32]
+                       [--compression gzip] [--workers 4] [--delete-inputs]
+
+The files of a session are grouped, in sequence order, into jobs of about
+target-mb megabytes.  Each job writes one output file, and jobs run in a
+process pool.  Segments of an acquisition that was continued across input
+files are joined into a single acquisition group.  Pyramids (see
+datalogger.LogPyramid) are rebuilt in the output, and files written
+before the rows table was introduced are converted to it (without
+timestamps).
+
+Outputs are written to a temporary name and renamed when complete, and
+completed jobs are recorded in a journal (MERGE_JOURNAL_NAME) in the
+destination directory.  An interrupted merge is resumed by running the
+same command again: inputs of completed jobs are skipped, and the other
+inputs are merged into outputs numbered after the completed ones.  Catalogs (see logcatalog) must be rebuilt for the
+destination directory afterwards.
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .datalogger import LOG_FILE_SUFFIX, Hdf5LogFile, LogPyramid, list_log_files, log_file_name, make_rows
+from .logcompression import COMPRESSION_FILTERS, load_plugins
+
+logger = logging.getLogger(__name__)
+
+#: Journal of completed merge jobs (in the destination directory)
+MERGE_JOURNAL_NAME = "pyspectro_merge_journal.json"
+
+#: Group attributes that are recomputed when acquisitions are merged
+_DERIVED_ATTRS = ("count", "stop_time", "acq_id", "segment", "layout", "compression")
+
+_NAME_PATTERN = re.compile(r"^(.*)_(\d+)" + re.escape(LOG_FILE_SUFFIX) + "$")
+
+
+def _session_of(path):
+    """Session of a log file, from its name (see log_file_name)"""
+    m = _NAME_PATTERN.match(os.path.basename(path))
+    return (m.group(1), int(m.group(2))) if m else (os.path.basename(path), 0)
+
+
+def plan_merge(files, dest, target_bytes, last_sequence=None):
+    """Group log files into merge jobs
+
+    Parameters
+    ----------
+    files : list of str
+        Input log files
+
+    dest : str
+        Destination directory
+
+    target_bytes : int
+        Approximate input size of each job
+
+    last_sequence : dict
+        Last output sequence number already used by each session
+
+    Returns
+    -------
+    jobs : list of (output, inputs)
+        Output path and input paths (in sequence order) of each job
+    """
+    sessions = {}
+    for f in files:
+        session, sequence = _session_of(f)
+        sessions.setdefault(session, []).append((sequence, f))
+
+    jobs = []
+    for session in sorted(sessions):
+        groups = [[]]
+        size = 0
+        for _, f in sorted(sessions[session]):
+            if groups[-1] and size >= target_bytes:
+                groups.append([])
+                size = 0
+            groups[-1].append(f)
+            size += os.path.getsize(f)
+
+        #: Outputs are numbered within the session
+        first = (last_sequence or {}).get(session, 0) + 1
+        for k, inputs in enumerate(groups):
+            jobs.append((os.path.join(dest, log_file_name(session, first + k)), inputs))
+
+    return jobs
+
+
+def merge_files(inputs, output, dtype=None, compression=None, chunk_bytes=4 << 20):
+    """Merge log files into one file
+
+    Parameters
+    ----------
+    inputs : list of str
+        Input log files, in sequence order
+
+    output : str
+        Output file.  It is written to output + ".tmp" and renamed when
+        complete.
+
+    dtype : str
+        Data type of the output spectra (e.g. "float32").  None keeps the
+        input data type.  Measurements in DDR memory order stay float32.
+
+    compression : str
+        Compression filter of the output spectra (see logcompression)
+
+    chunk_bytes : int
+        Approximate size of the output chunks, also used as the copy block size
+
+    Returns
+    -------
+    nbytes : int
+        Total size of the input files
+    """
+    import h5py
+
+    #: Inputs may have been compressed with filters of the hdf5plugin package
+    load_plugins()
+
+    tmp = output + ".tmp"
+    if os.path.exists(tmp):
+        #: Left over from an interrupted merge
+        os.remove(tmp)
+
+    session, sequence = _session_of(output)
+    out = Hdf5LogFile(tmp, session, sequence)
+    last = None
+
+    try:
+        for path in inputs:
+            with h5py.File(path, "r") as f:
+                for name in sorted(k for k in f if k.startswith("acq")):
+                    group = f[name]
+                    attrs = dict(group.attrs)
+                    ddr = attrs.get("layout") == "ddr"
+                    data = group["ddrdata"] if ddr else group["fftdata"]
+                    legacy = "rows" not in group
+                    count = int(attrs.get("count", len(group["msrmt_num"] if legacy else group["rows"])))
+                    if legacy and count:
+                        attrs.setdefault("numAverages", int(group["num_averages"][0]))
+                    nbins = 2 * data.shape[2] if ddr else data.shape[1]
+                    out_dtype = "float32" if ddr else (dtype or data.dtype)
+
+                    key = (int(attrs.get("acq_id", 0)), nbins, ddr, str(out_dtype))
+                    continued = last is not None and key == last[0] and int(attrs.get("segment", 0)) == last[1] + 1
+
+                    if not continued:
+                        layout = {"Nfft": attrs["Nfft"], "complexData": attrs["complexData"]} if ddr else None
+                        pyramid = None
+                        if "pyramid" in group:
+                            pattrs = group["pyramid"].attrs
+                            pyramid = LogPyramid(
+                                int(pattrs["levels"]), int(pattrs["time_factor"]), int(pattrs["freq_factor"])
+                            )
+                        row_bytes = np.dtype(out_dtype).itemsize * nbins
+                        out.create_acquisition(
+                            nbins,
+                            key[0],
+                            int(attrs.get("segment", 0)),
+                            max(1, chunk_bytes // row_bytes),
+                            out_dtype,
+                            layout=layout,
+                            attrs={k: v for k, v in attrs.items() if k not in _DERIVED_ATTRS},
+                            pyramid=pyramid,
+                            compression=compression,
+                        )
+                    last = (key, int(attrs.get("segment", 0)))
+
+                    stop_time = attrs.get("stop_time")
+                    rows = max(1, chunk_bytes // (data.dtype.itemsize * nbins))
+                    for i0 in range(0, count, rows):
+                        i1 = min(i0 + rows, count)
+                        table = make_rows(group["msrmt_num"][i0:i1]) if legacy else group["rows"][i0:i1]
+                        out.append(np.asarray(data[i0:i1], dtype=out_dtype), table, stop_time=stop_time)
+    finally:
+        out.close()
+
+    os.replace(tmp, output)
+    return sum(os.path.getsize(f) for f in inputs)
+
+
+def _run_job(output, inputs, dtype, compression):
+    """Process pool entry point: merge one job and time it"""
+    tstart = time.perf_counter()
+    nbytes = merge_files(inputs, output, dtype, compression)
+    return nbytes, time.perf_counter() - tstart
+
+
+def _read_journal(dest):
+    """Completed jobs {output name: [absolute input paths]}"""
+    try:
+        with open(os.path.join(dest, MERGE_JOURNAL_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_journal(dest, journal):
+    """Atomically replace the journal"""
+    fullfile = os.path.join(dest, MERGE_JOURNAL_NAME)
+    with open(fullfile + ".tmp", "w") as f:
+        json.dump(journal, f, indent=1)
+    os.replace(fullfile + ".tmp", fullfile)
+
+
+def merge_logs(
+    source, dest, target_mb=1024, dtype=None, compression=None, max_workers=None, delete_inputs=False, files=None
+):
+    """Merge the log files in a directory
+
+    Parameters
+    ----------
+    source : str
+        Directory of the input log files
+
+    dest : str
+        Destination directory (must differ from source)
+
+    target_mb : float
+        Approximate input size (MB) of each output file
+
+    dtype : str
+        Data type of the output spectra.  None keeps the input data type.
+
+    compression : str
+        Compression filter of the output spectra (see logcompression)
+
+    max_workers : int
+        Number of processes.  Defaults to the number of CPUs.
+
+    delete_inputs : bool
+        Delete input files once their output has been completed
+
+    files : list of str
+        Input files.  Defaults to all log files in source.
+
+    Returns
+    -------
+    mb_per_s : float
+        Overall throughput (input MB per second) of the jobs run
+    """
+    if os.path.abspath(source) == os.path.abspath(dest):
+        raise ValueError("The destination directory must differ from the source directory")
+    os.makedirs(dest, exist_ok=True)
+
+    files = list_log_files(source) if files is None else files
+    files = [os.path.abspath(f) for f in files]
+
+    #: Skip the inputs of completed jobs
+    journal = _read_journal(dest)
+    done = set(f for inputs in journal.values() for f in inputs)
+    last_sequence = {}
+    for name in journal:
+        session, sequence = _session_of(name)
+        last_sequence[session] = max(last_sequence.get(session, 0), sequence)
+
+    pending = [f for f in files if f not in done]
+    jobs = plan_merge(pending, dest, int(target_mb * 1e6), last_sequence)
+    logger.info(
+        "Merging %s files in %s jobs (%s files already merged)" % (len(pending), len(jobs), len(files) - len(pending))
+    )
+
+    total = 0
+    failed = 0
+    tstart = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            (output, inputs, pool.submit(_run_job, output, inputs, dtype, compression)) for output, inputs in jobs
+        ]
+        for output, inputs, future in futures:
+            try:
+                nbytes, elapsed = future.result()
+            except Exception as e:
+                logger.error("Could not merge %s: %s" % (output, e))
+                failed += 1
+                continue
+            total += nbytes
+
+            journal[os.path.basename(output)] = inputs
+            _write_journal(dest, journal)
+            if delete_inputs:
+                for f in inputs:
+                    os.remove(f)
+
+            logger.info(
+                "Wrote {0} from {1} files: {2:.1f} MB, {3:.1f} MB/s".format(
+                    output, len(inputs), nbytes / 1e6, nbytes / 1e6 / max(elapsed, 1e-9)
+                )
+            )
+
+    elapsed = time.perf_counter() - tstart
+    mb_per_s = total / 1e6 / max(elapsed, 1e-9)
+    logger.info("Merged {0:.1f} MB in {1:.1f} s: {2:.1f} MB/s".format(total / 1e6, elapsed, mb_per_s))
+
+    if failed:
+        raise RuntimeError("%s merge jobs failed.  Run the merge again to retry them." % failed)
+    return mb_per_s
+
+
+def main(argv=None):
+    """Command line interface"""
+    parser = argparse.ArgumentParser(description="Merge and compact pyspectro HDF5 log files")
+    parser.add_argument("source", help="directory of the input log files")
+    parser.add_argument("dest", help="destination directory")
+    parser.add_argument("--target-mb", type=float, default=1024, help="input MB per output file (default 1024)")
+    parser.add_argument("--dtype", choices=["float32", "float64"], help="output spectrum data type")
+    parser.add_argument("--compression", choices=COMPRESSION_FILTERS, help="output compression filter")
+    parser.add_argument("--workers", type=int, help="number of processes (default: number of CPUs)")
+    parser.add_argument("--delete-inputs", action="store_true", help="delete input files after merging")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(relativeCreated)5d %(levelname)-8s %(message)s")
+
+    merge_logs(
+        args.source,
+        args.dest,
+        target_mb=args.target_mb,
+        dtype=args.dtype,
+        compression=args.compression,
+        max_workers=args.workers,
+        delete_inputs=args.delete_inputs,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,26 @@
 # distributed with this software.
 # -----------------------------------------------------------------------------
 
+import logging
+import os
+import threading
 
 import numpy as np
+from atom.api import Atom, Bool, Dict, Enum, Float, Int, List, Str, Typed, Value, observe
+
+logger = logging.getLogger(__name__)
+
+
+def frequency_axis(Nfft, complexData, sampleRate):
+    """Return the frequency (Hz) of each FFT bin of a measurement
+
+    Measurements of complex data hold Nfft bins from -sampleRate/2 to
+    sampleRate/2 (zero frequency at bin Nfft/2).  Measurements of real data
+    hold Nfft/2 bins from 0 to sampleRate/2.
+    """
+    if complexData:
+        return sampleRate * (np.arange(Nfft) - Nfft / 2.0) / float(Nfft)
+    return sampleRate * np.arange(Nfft // 2) / float(Nfft)
 
 
 def convert_raw_to_fs(fft_raw, numAverages, complexData):
@@ -74,10 +92,8 @@ def convert_raw_to_fs(fft_raw, numAverages, complexData):
     #: Mean square power:
     fft_fs = fft_raw / scale
 
-    #     #: Apply correction from manual calibration
-    #     correction_db = 0.0
-    #     #correction_db = -0.43
-    #     correction = 10.0**(correction_db/20.0)
+    #: Frequency-response correction from calibration files is applied by
+    #: SpectrumConverter (see response_correction)
 
     return fft_fs
 
@@ -104,3 +120,1952 @@ def convert_fs_to_dBm(fft_fs, complexData=True, vRange=1.0):
         gain_dbm_to_dbfs += 6.02
 
     return convert_fs_to_dbfs(fft_fs, complexData) + gain_dbm_to_dbfs
+
+
+#: Directory of frequency-response calibration files (see response_correction)
+CALIBRATION_DIR = os.path.join(os.path.expanduser("~"), "pyspectro", "calibration")
+
+
+def response_file_name(Nfft, complexData, sampleRate):
+    """Return the name of the frequency-response calibration file of an app and sample rate
+
+    For example response_32768_real_2000MHz.csv
+    """
+    return "response_{0}_{1}_{2:g}MHz.csv".format(int(Nfft), "complex" if complexData else "real", sampleRate / 1.0e6)
+
+
+def load_response(path):
+    """Load a frequency-response calibration file
+
+    The file is a comma-separated text file with two columns, the frequency
+    (Hz, in increasing order) and the correction (dB) to add to the measured
+    power at that frequency.  Lines starting with # are comments.
+
+    Returns
+    -------
+    freqs, correction_db : numpy.ndarray
+    """
+    table = np.loadtxt(path, delimiter=",", comments="#", ndmin=2)
+    if table.shape[1] != 2 or len(table) == 0:
+        raise ValueError("{0}: expected two columns, frequency (Hz) and correction (dB)".format(path))
+    freqs, correction_db = table[:, 0], table[:, 1]
+    if np.any(np.diff(freqs) <= 0):
+        raise ValueError("{0}: frequencies must be increasing".format(path))
+    return freqs, correction_db
+
+
+_responses = {}
+_responses_lock = threading.Lock()
+
+
+def response_correction(Nfft, complexData, sampleRate, directory=None):
+    """Return the cached frequency-response correction of an app and sample rate
+
+    The calibration file (see response_file_name and load_response) is
+    interpolated linearly in dB onto the frequency axis of the app, once.
+    Bins outside the calibrated range use the correction of the nearest
+    calibrated frequency.
+
+    Parameters
+    ----------
+    Nfft, complexData :
+        App configuration
+
+    sampleRate : float
+        Effective sample rate (Hz)
+
+    directory : str
+        Directory of the calibration files.  Defaults to CALIBRATION_DIR.
+
+    Returns
+    -------
+    correction : numpy.ndarray or None
+        Per-bin power multiplier (read-only), or None if there is no
+        calibration file
+    """
+    path = os.path.join(directory or CALIBRATION_DIR, response_file_name(Nfft, complexData, sampleRate))
+    with _responses_lock:
+        if path not in _responses:
+            correction = None
+            if os.path.exists(path):
+                freqs, correction_db = load_response(path)
+                bins = frequency_axis(Nfft, complexData, sampleRate)
+                correction = 10.0 ** (np.interp(bins, freqs, correction_db) / 10.0)
+                correction.flags.writeable = False
+                logger.info("Loaded frequency-response correction %s" % path)
+            _responses[path] = correction
+        return _responses[path]
+
+
+def clear_calibration_cache():
+    """Discard the cached frequency-response corrections and converters (after calibration files change)"""
+    with _responses_lock:
+        _responses.clear()
+    with _converters_lock:
+        _converters.clear()
+
+
+class SpectrumConverter(Atom):
+    """Conversion of raw measurements to FS, dB-FS or dBm
+
+    Equivalent to convert_raw_to_fs followed by convert_fs_to_dbfs or
+    convert_fs_to_dBm, with the scale factors computed once.  The result is
+    computed in place in the output array, without temporary arrays:
+
+        FS    : raw * (1/scale)
+        dB-FS : 10*log10(raw * (1/scale) [* 2 for real data])
+        dBm   : dB-FS + 6.99 dB [+ 6.02 dB for the 2 V range]
+
+    A frequency-response correction (per-bin power multiplier, see
+    response_correction) is folded into the multiplier, so it costs no
+    extra pass over the data.
+
+    Converters are cached; use get_converter() rather than creating them
+    for each measurement.
+
+    Example:
+
+        convert = get_converter(Nfft, complexData, numAverages, vRange, "dBm")
+        out = convert.empty()
+        convert(acqbuffer.fftdata, out=out)
+
+    """
+
+    #: FFT size
+    Nfft = Int()
+
+    #: Complex (Nfft bins) or real data (Nfft/2 bins)
+    complexData = Bool()
+
+    #: Number of FFTs averaged per measurement
+    numAverages = Int()
+
+    #: Voltage range (V)
+    vRange = Float(1.0)
+
+    #: Output units
+    units = Enum("dBm", "dB-FS", "FS")
+
+    #: Output data type (float32 or float64)
+    dtype = Value()
+
+    #: Number of bins per spectrum
+    nbins = Int()
+
+    #: Multiplier applied to raw values before the logarithm, and dB offset after it
+    factor = Float()
+    offset = Float()
+
+    #: Per-bin frequency-response correction (power multiplier), or None
+    correction = Value()
+
+    #: factor, times the correction if there is one
+    _gain = Value()
+
+    def __init__(self, Nfft, complexData, numAverages, vRange=1.0, units="dBm", dtype=np.float64, correction=None):
+        super(SpectrumConverter, self).__init__(
+            Nfft=int(Nfft),
+            complexData=bool(complexData),
+            numAverages=int(numAverages),
+            vRange=float(vRange),
+            units=units,
+            dtype=np.dtype(dtype),
+        )
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError("Output dtype must be float32 or float64")
+
+        self.nbins = self.Nfft if self.complexData else self.Nfft // 2
+        if correction is not None:
+            correction = np.asarray(correction, dtype=np.float64)
+            if correction.shape != (self.nbins,):
+                raise ValueError("Expected a correction of {0} bins, got {1}".format(self.nbins, correction.shape))
+            self.correction = correction
+
+        #: Same scale as convert_raw_to_fs
+        scale = np.square(np.double(self.Nfft)) * np.double(self.numAverages)
+        if not self.complexData:
+            scale /= 2.0
+        self.factor = 1.0 / scale
+
+        if self.units != "FS":
+            #: Real data compensates for the difference in full scale (see convert_fs_to_dbfs)
+            if not self.complexData:
+                self.factor *= 2.0
+            if self.units == "dBm":
+                self.offset = 6.99 + (6.02 if self.vRange == 2.0 else 0.0)
+
+        self._gain = self.factor if self.correction is None else self.factor * self.correction
+
+    def empty(self, N=None):
+        """Return an output array for a spectrum (N=None) or N spectra"""
+        shape = (self.nbins,) if N is None else (N, self.nbins)
+        return np.empty(shape, self.dtype)
+
+    def __call__(self, raw, out=None):
+        """Convert a raw spectrum (nbins,) or spectra (N, nbins)
+
+        Parameters
+        ----------
+        raw : numpy.ndarray
+            Raw measurement(s)
+
+        out : numpy.ndarray
+            Output array of the same shape (see empty).  Allocated if None.
+
+        Returns
+        -------
+        out : numpy.ndarray
+        """
+        raw = np.asarray(raw)
+        if raw.shape[-1] != self.nbins:
+            raise ValueError("Expected {0} bins, got {1}".format(self.nbins, raw.shape[-1]))
+        if out is None:
+            out = np.empty(raw.shape, self.dtype)
+        elif out.shape != raw.shape:
+            raise ValueError("Output shape {0} does not match input shape {1}".format(out.shape, raw.shape))
+
+        np.multiply(raw, self._gain, out=out, casting="unsafe")
+        if self.units != "FS":
+            np.log10(out, out=out)
+            out *= 10.0
+            if self.offset:
+                out += self.offset
+        return out
+
+
+_converters = {}
+_converters_lock = threading.Lock()
+
+
+def get_converter(
+    Nfft, complexData, numAverages, vRange=1.0, units="dBm", dtype=np.float64, sampleRate=None, directory=None
+):
+    """Return the cached SpectrumConverter of a configuration
+
+    If the sample rate is given, the frequency-response correction of the
+    app and sample rate (see response_correction) is applied, if there is a
+    calibration file for them in directory (default CALIBRATION_DIR).
+    """
+    key = (int(Nfft), bool(complexData), int(numAverages), float(vRange), units, np.dtype(dtype))
+    rate_key = (sampleRate and float(sampleRate), directory)
+    with _converters_lock:
+        converter = _converters.get(key + rate_key)
+    if converter is None:
+        correction = None
+        if sampleRate:
+            correction = response_correction(Nfft, complexData, sampleRate, directory)
+        converter = SpectrumConverter(*key, correction=correction)
+        with _converters_lock:
+            if len(_converters) >= 64:
+                _converters.clear()
+            converter = _converters.setdefault(key + rate_key, converter)
+    return converter
+
+
+_rebin_tables = {}
+_rebin_tables_lock = threading.Lock()
+
+
+def rebin_edges(nin, nout):
+    """Return the cached bin edge table of a rebinning
+
+    Output bin j reduces the input bins edges[j] <= i < edges[j + 1], with
+    edges[j] = floor(j * nin / nout).  Every output bin holds
+    floor(nin / nout) or ceil(nin / nout) input bins.
+
+    Returns
+    -------
+    edges : numpy.ndarray
+        (nout + 1,) int64, read-only
+
+    counts : numpy.ndarray
+        (nout,) float64 number of input bins of each output bin, read-only
+    """
+    nin, nout = int(nin), int(nout)
+    if not 0 < nout <= nin:
+        raise ValueError("Cannot rebin {0} bins to {1} bins".format(nin, nout))
+
+    key = (nin, nout)
+    with _rebin_tables_lock:
+        table = _rebin_tables.get(key)
+        if table is None:
+            if len(_rebin_tables) >= 64:
+                _rebin_tables.clear()
+            edges = np.arange(nout + 1, dtype=np.int64) * nin // nout
+            counts = np.diff(edges).astype(np.float64)
+            edges.flags.writeable = False
+            counts.flags.writeable = False
+            table = _rebin_tables[key] = (edges, counts)
+        return table
+
+
+def rebin(data, nout, mode="mean", out=None):
+    """Reduce the bins of spectra to nout bins
+
+    Modes:
+
+        mean   : average of the input bins
+        max    : maximum of the input bins (narrow spurs are preserved)
+        min    : minimum of the input bins
+        minmax : (min, max) pairs, in an output of shape (..., nout, 2).
+                 For display, out.reshape(..., 2 * nout) plotted against
+                 the output frequencies repeated twice draws the envelope.
+
+    The reduction uses the cached edge table of rebin_edges with
+    ufunc.reduceat.  If nout divides the number of bins by a small factor
+    (up to 4), where reduceat is slow, the spectra are instead reshaped to
+    (..., nout, factor) and the factor columns are combined.
+    Both work on a spectrum (nbins,) or on spectra (N, nbins) at once.
+    The frequency axis is rebinned with mode "mean".
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Spectra (..., nbins), in linear units for mode "mean"
+
+    nout : int
+        Number of output bins (at most nbins)
+
+    mode : str
+        "mean", "max", "min" or "minmax"
+
+    out : numpy.ndarray
+        Output array (..., nout), or (..., nout, 2) for mode "minmax".
+        Allocated if None, with the dtype of data (float64 for the mean of
+        integer data).
+
+    Returns
+    -------
+    out : numpy.ndarray
+    """
+    data = np.asarray(data)
+    if mode not in ("mean", "max", "min", "minmax"):
+        raise ValueError("Unknown rebinning mode {0}".format(mode))
+    nin = data.shape[-1]
+    edges, counts = rebin_edges(nin, nout)
+
+    shape = data.shape[:-1] + ((nout, 2) if mode == "minmax" else (nout,))
+    if out is None:
+        dtype = data.dtype
+        if mode == "mean" and dtype.kind != "f":
+            dtype = np.dtype(np.float64)
+        out = np.empty(shape, dtype)
+    elif out.shape != shape:
+        raise ValueError("Output shape {0} does not match {1}".format(out.shape, shape))
+
+    if mode == "minmax":
+        outputs = ((np.minimum, out[..., 0]), (np.maximum, out[..., 1]))
+    else:
+        ufunc = {"mean": np.add, "max": np.maximum, "min": np.minimum}[mode]
+        outputs = ((ufunc, out),)
+
+    factor = nin // nout
+    if nin % nout == 0 and factor <= 4:
+        #: Combine the strided columns of the blocks, vectorized over all output bins
+        blocks = data.reshape(data.shape[:-1] + (nout, factor))
+        for ufunc, result in outputs:
+            np.copyto(result, blocks[..., 0], casting="unsafe")
+            for k in range(1, factor):
+                ufunc(result, blocks[..., k], out=result, casting="unsafe")
+        if mode == "mean":
+            out *= 1.0 / factor
+    else:
+        for ufunc, result in outputs:
+            if result.dtype == data.dtype and result.flags.c_contiguous:
+                ufunc.reduceat(data, edges[:-1], axis=-1, out=result)
+            else:
+                #: reduceat copies the initial contents of buffered outputs, which are not initialized
+                result[...] = ufunc.reduceat(data, edges[:-1], axis=-1)
+        if mode == "mean":
+            out /= counts
+    return out
+
+
+def unpack_flags(flags, nbins):
+    """Return flags as a bool array (..., nbins)
+
+    flags is a bool array, or bits packed along the last axis with
+    numpy.packbits (big bit order), as produced by RFIFlagger.
+    """
+    flags = np.asarray(flags)
+    if flags.dtype == np.bool_:
+        return flags
+    return np.unpackbits(flags, axis=-1, count=nbins).view(np.bool_)
+
+
+class ProcessingStage(Atom):
+    """Base class of streaming processing stages
+
+    A stage is updated with spectra in measurement order, either one
+    spectrum (nbins,) or a block of spectra (N, nbins) at a time, and keeps
+    its results in preallocated arrays that are updated in place.
+
+    A stage can be attached to the live acquisition (see
+    PySpectroCore.stages, or call update_from_buffer with an
+    AcquisitionDataBuffer), or run over a logged acquisition with
+    update_from_log.  The stage lock is held while the stage is updated;
+    other threads should hold it while they read the results.
+
+    Stages that accept flags (see RFIFlagger) exclude the flagged bins of
+    each spectrum from their results.
+
+    """
+
+    #: Held while the stage is updated
+    lock = Value(factory=threading.Lock)
+
+    #: The stage can exclude flagged bins
+    accepts_flags = False
+
+    def update(self, data, flags=None):
+        """Update the stage with a spectrum (nbins,) or a block of spectra (N, nbins)
+
+        flags marks bins to exclude, as a bool array of the shape of data or
+        as bits packed along the last axis (see unpack_flags).
+        """
+        data = np.asarray(data)
+        block = data[np.newaxis] if data.ndim == 1 else data
+        with self.lock:
+            if flags is None:
+                return self._update(block)
+            if not self.accepts_flags:
+                raise ValueError("{0} cannot exclude flagged bins".format(type(self).__name__))
+            return self._update(block, unpack_flags(flags, block.shape[-1]).reshape(block.shape))
+
+    def update_from_buffer(self, buffer):
+        """Update the stage with the measurement in an AcquisitionDataBuffer
+
+        The buffer lock is held while the measurement is processed.
+        """
+        with buffer.lock:
+            fftdata = buffer.fftdata
+            if fftdata is not None:
+                return self.update(fftdata)
+
+    def update_from_log(self, acquisition, start=0, stop=None, rows=None):
+        """Update the stage with the spectra of a logged acquisition
+
+        Parameters
+        ----------
+        acquisition : datalogger.LogAcquisition
+            Acquisition (or any object with an iter_chunks method)
+
+        start, stop : int
+            Range of measurements
+
+        rows : int
+            Number of spectra per block (see LogDataset.iter_chunks)
+
+        """
+        for block in acquisition.iter_chunks(rows, start, stop):
+            self.update(block)
+
+    def reset(self):
+        """Discard the spectra processed so far"""
+        raise NotImplementedError
+
+    def _update(self, block):
+        """Process a block of spectra (N, nbins), with the lock held"""
+        raise NotImplementedError
+
+
+class SpectrumStats(ProcessingStage):
+    """Streaming per-bin statistics of spectra
+
+    Updates the per-bin mean, minimum, maximum and variance with each
+    spectrum, in place, using preallocated arrays:
+
+        cumulative  : all spectra since the last reset (Welford's algorithm)
+        sliding     : the last `length` spectra.  The mean and variance
+                      are updated by adding the new spectrum and removing
+                      the oldest one; the minimum and maximum use the van
+                      Herk/Gil-Werman algorithm (block prefix and suffix
+                      extrema), which costs O(1) per bin and spectrum.
+        exponential : exponentially weighted mean and variance with
+                      weight `alpha` for the newest spectrum.  The minimum
+                      and maximum hold all spectra since the last reset.
+
+    Flagged bins (see ProcessingStage.update and RFIFlagger) are excluded,
+    so the number of spectra in the statistics of each bin (counts) may
+    differ from count.  Bins without spectra are NaN.
+
+    Example, with a logged acquisition:
+
+        stats = SpectrumStats(acq.shape[1], "sliding", length=100)
+        stats.update_from_log(acq)
+        noise = np.sqrt(stats.variance())
+
+    """
+
+    accepts_flags = True
+
+    #: Number of bins per spectrum
+    nbins = Int()
+
+    #: Window of the statistics
+    window = Enum("cumulative", "sliding", "exponential")
+
+    #: Number of spectra in the sliding window
+    length = Int()
+
+    #: Weight of the newest spectrum in the exponential window
+    alpha = Float(0.1)
+
+    #: Number of spectra in the statistics (at most length for the sliding window)
+    count = Int()
+
+    #: Number of spectra processed since the last reset
+    total = Int()
+
+    #: Per-bin mean, minimum and maximum (float64 arrays, updated in place)
+    mean = Value()
+    min = Value()
+    max = Value()
+
+    #: Number of spectra in the statistics of each bin (int64 array)
+    counts = Value()
+
+    #: Flags have been given since the last reset
+    _flagged = Bool()
+
+    #: Sliding window: bins of the ring that are not flagged
+    _ring_valid = Value()
+
+    #: Sum of squared deviations (cumulative, sliding) or variance (exponential)
+    _m2 = Value()
+
+    #: Scratch arrays
+    _d = Value()
+    _s = Value()
+    _t = Value()
+
+    #: Sliding window: ring of the last spectra, and block prefix and suffix extrema
+    _ring = Value()
+    _prefix_min = Value()
+    _prefix_max = Value()
+    _suffix_min = Value()
+    _suffix_max = Value()
+
+    def __init__(self, nbins, window="cumulative", length=0, alpha=0.1):
+        """Initialize the statistics
+
+        Parameters
+        ----------
+        nbins : int
+            Number of bins per spectrum
+
+        window : str
+            "cumulative", "sliding" or "exponential"
+
+        length : int
+            Number of spectra in the sliding window
+
+        alpha : float
+            Weight (0, 1] of the newest spectrum in the exponential window
+
+        """
+        self.nbins = nbins
+        self.window = window
+        self.length = length
+        self.alpha = alpha
+
+        if window == "sliding" and length < 1:
+            raise ValueError("The sliding window requires length >= 1")
+        if window == "exponential" and not 0.0 < alpha <= 1.0:
+            raise ValueError("alpha must be in (0, 1]")
+
+        self.mean, self.min, self.max, self._m2, self._d, self._s, self._t = np.empty((7, nbins))
+        self.counts = np.empty(nbins, dtype=np.int64)
+        if window == "sliding":
+            self._ring = np.empty((length, nbins))
+            self._suffix_min = np.empty((length, nbins))
+            self._suffix_max = np.empty((length, nbins))
+            self._prefix_min, self._prefix_max = np.empty((2, nbins))
+        self.reset()
+
+    def reset(self):
+        """Discard the spectra processed so far"""
+        self.count = 0
+        self.total = 0
+        self.counts.fill(0)
+        self._flagged = False
+        self._ring_valid = None
+        for array in (self.mean, self.min, self.max, self._m2):
+            array.fill(np.nan)
+
+    def variance(self, ddof=0, out=None):
+        """Return the per-bin variance
+
+        Parameters
+        ----------
+        ddof : int
+            Delta degrees of freedom (cumulative and sliding windows)
+
+        out : numpy.ndarray
+            Array for the result
+        """
+        if self.window == "exponential":
+            if out is None:
+                return self._m2.copy()
+            out[...] = self._m2
+            return out
+        return np.divide(self._m2, np.maximum(self.counts - ddof, 1), out=out)
+
+    def std(self, ddof=0):
+        """Return the per-bin standard deviation"""
+        return np.sqrt(self.variance(ddof))
+
+    def _update(self, block, flags=None):
+        if block.shape[-1] != self.nbins:
+            raise ValueError("Expected spectra of {0} bins, got {1}".format(self.nbins, block.shape[-1]))
+        add = {"cumulative": self._add, "sliding": self._slide, "exponential": self._add_exponential}[self.window]
+
+        if flags is not None and not self._flagged:
+            #: From here on, every bin of every spectrum is checked
+            self._flagged = True
+            if self.window == "sliding":
+                self._ring_valid = np.ones((self.length, self.nbins), dtype=np.bool_)
+        if not self._flagged:
+            for x in block:
+                add(x)
+                self.total += 1
+            return
+
+        valid = np.ones(block.shape, dtype=np.bool_)
+        if flags is not None:
+            np.logical_not(flags, out=valid)
+        for x, v in zip(block, valid):
+            add(x, v)
+            self.total += 1
+
+    def _add(self, x, v=None):
+        """Welford update with one more spectrum (v: bins that are not flagged)"""
+        mean, m2, d, s, t, n = self.mean, self._m2, self._d, self._s, self._t, self.counts
+        self.count += 1
+        if v is not None:
+            np.add(n, v, out=n)
+            np.subtract(x, mean, out=d)
+            np.divide(d, n, out=s, where=v)
+            np.add(mean, s, out=mean, where=v)
+            np.subtract(x, mean, out=t)
+            np.multiply(d, t, out=t)
+            np.add(m2, t, out=m2, where=v)
+
+            #: First spectrum of a bin
+            first = v & (n == 1)
+            np.copyto(mean, x, where=first)
+            np.copyto(m2, 0.0, where=first)
+        elif self.count == 1:
+            n += 1
+            mean[:] = x
+            m2.fill(0.0)
+        else:
+            n += 1
+            np.subtract(x, mean, out=d)
+            np.divide(d, self.count, out=s)
+            np.add(mean, s, out=mean)
+            np.subtract(x, mean, out=t)
+            np.multiply(d, t, out=t)
+            np.add(m2, t, out=m2)
+
+        if self.window == "cumulative":
+            self._hold(x, v)
+
+    def _remove(self, x, v):
+        """Inverse Welford update removing a spectrum (v: bins that were not flagged)"""
+        mean, m2, d, s, t, n = self.mean, self._m2, self._d, self._s, self._t, self.counts
+        self.count -= 1
+        np.subtract(n, v, out=n)
+        w = v & (n > 0)
+        np.subtract(x, mean, out=d)
+        np.divide(d, n, out=s, where=w)
+        np.subtract(mean, s, out=mean, where=w)
+        np.subtract(x, mean, out=t)
+        np.multiply(d, t, out=t)
+        np.subtract(m2, t, out=m2, where=w)
+        np.maximum(m2, 0.0, out=m2)
+
+        #: Last spectrum of a bin
+        empty = v & (n == 0)
+        np.copyto(mean, np.nan, where=empty)
+        np.copyto(m2, np.nan, where=empty)
+
+    def _hold(self, x, v=None):
+        """Update the minimum and maximum of all spectra since the reset"""
+        if v is not None:
+            #: fmin and fmax ignore the NaN of bins without spectra
+            np.fmin(self.min, x, out=self.min, where=v)
+            np.fmax(self.max, x, out=self.max, where=v)
+        elif self.total == 0:
+            self.min[:] = x
+            self.max[:] = x
+        else:
+            np.minimum(self.min, x, out=self.min)
+            np.maximum(self.max, x, out=self.max)
+
+    def _slide(self, x, v=None):
+        """Add a spectrum to the sliding window, removing the oldest one"""
+        N = self.length
+        k = self.total % N
+        ring = self._ring
+
+        if v is not None:
+            if self.count == N:
+                self._remove(ring[k], self._ring_valid[k])
+            self._add(x, v)
+            self._ring_valid[k] = v
+        elif self.count < N:
+            self._add(x)
+        else:
+            #: Replace the oldest spectrum (ring[k]) with x
+            mean, m2, d, s, t = self.mean, self._m2, self._d, self._s, self._t
+            old = ring[k]
+            np.subtract(x, old, out=d)
+            np.add(x, old, out=t)
+            np.subtract(t, mean, out=t)
+            np.divide(d, N, out=s)
+            np.add(mean, s, out=mean)
+            np.subtract(t, mean, out=t)
+            np.multiply(d, t, out=t)
+            np.add(m2, t, out=m2)
+            np.maximum(m2, 0.0, out=m2)
+        ring[k] = x
+
+        #: Flagged bins do not count in the extrema
+        xmin = xmax = x
+        if v is not None:
+            xmin = np.where(v, x, np.inf)
+            xmax = np.where(v, x, -np.inf)
+
+        #: Extrema of the current block (ring slots 0 ... k)
+        if k == 0:
+            self._prefix_min[:] = xmin
+            self._prefix_max[:] = xmax
+        else:
+            np.minimum(self._prefix_min, xmin, out=self._prefix_min)
+            np.maximum(self._prefix_max, xmax, out=self._prefix_max)
+
+        if self.total >= N and k < N - 1:
+            #: The window also holds slots k + 1 ... N - 1 of the previous block
+            np.minimum(self._suffix_min[k + 1], self._prefix_min, out=self.min)
+            np.maximum(self._suffix_max[k + 1], self._prefix_max, out=self.max)
+        else:
+            self.min[:] = self._prefix_min
+            self.max[:] = self._prefix_max
+
+        if v is not None:
+            #: Bins flagged throughout the window
+            np.copyto(self.min, np.nan, where=self.counts == 0)
+            np.copyto(self.max, np.nan, where=self.counts == 0)
+
+        if k == N - 1:
+            #: Block complete: suffix extrema of its slots, for the next block
+            if self._ring_valid is None:
+                np.minimum.accumulate(ring[::-1], axis=0, out=self._suffix_min[::-1])
+                np.maximum.accumulate(ring[::-1], axis=0, out=self._suffix_max[::-1])
+            else:
+                valid = self._ring_valid[::-1]
+                np.minimum.accumulate(np.where(valid, ring[::-1], np.inf), axis=0, out=self._suffix_min[::-1])
+                np.maximum.accumulate(np.where(valid, ring[::-1], -np.inf), axis=0, out=self._suffix_max[::-1])
+
+    def _add_exponential(self, x, v=None):
+        """Exponentially weighted update (v: bins that are not flagged)"""
+        mean, var, d, s, t, n = self.mean, self._m2, self._d, self._s, self._t, self.counts
+        if v is not None:
+            np.add(n, v, out=n)
+            np.subtract(x, mean, out=d)
+            np.multiply(d, self.alpha, out=s)
+            np.add(mean, s, out=mean, where=v)
+            np.multiply(d, s, out=t)
+            np.add(var, t, out=var, where=v)
+            np.multiply(var, 1.0 - self.alpha, out=var, where=v)
+
+            #: First spectrum of a bin
+            first = v & (n == 1)
+            np.copyto(mean, x, where=first)
+            np.copyto(var, 0.0, where=first)
+        elif self.count == 0:
+            n += 1
+            mean[:] = x
+            var.fill(0.0)
+        else:
+            n += 1
+            np.subtract(x, mean, out=d)
+            np.multiply(d, self.alpha, out=s)
+            np.add(mean, s, out=mean)
+            np.multiply(d, s, out=t)
+            np.add(var, t, out=var)
+            np.multiply(var, 1.0 - self.alpha, out=var)
+        self.count += 1
+        self._hold(x, v)
+
+
+#: Peaks found by PeakDetector (index -1 and NaN fields: no peak)
+PEAK_DTYPE = np.dtype(
+    [
+        ("index", "<i4"),
+        ("bin", "<f8"),
+        ("frequency", "<f8"),
+        ("height", "<f8"),
+        ("prominence", "<f8"),
+    ]
+)
+
+
+class PeakDetector(ProcessingStage):
+    """Vectorized detector of the strongest peaks of spectra
+
+    Finds up to k peaks per spectrum, strongest first, for a single
+    spectrum or a block of spectra at once:
+
+        1. Local maxima are the candidates (the first and last bins are
+           not peaks).
+        2. The highest candidates are kept, and their prominence (height
+           above the higher of the two bases, as in scipy.signal) is
+           measured within wlen bins on each side.
+        3. Candidates below min_prominence are rejected, and candidates
+           closer than min_spacing bins to a higher accepted peak are
+           suppressed. Spectra left with fewer than k peaks repeat steps 2-3
+           with twice as many candidates, until k peaks are accepted or no
+           candidates remain.
+        4. The position and height of each peak are refined by fitting a
+           parabola to the peak bin and its neighbors ("parabolic"), or to
+           their logarithm ("gaussian", suited to power spectra with a
+           smooth window), and converted to frequency with the frequency
+           axis (see frequency_axis).
+
+    All steps operate on whole (N, candidates) arrays; only the spacing
+    test loops, over the candidates of all spectra at once.
+
+    Example, with the app configuration of a Spectrometer:
+
+        freqs = frequency_axis(ffts.Nfft, ffts.app.complexData, ffts.sampleRate)
+        detector = PeakDetector(len(freqs), k=5, min_prominence=1e-6, freqs=freqs)
+        peaks = detector.find(fftdata)
+        peaks["frequency"], peaks["height"]
+
+    """
+
+    #: Number of bins per spectrum
+    nbins = Int()
+
+    #: Maximum number of peaks per spectrum
+    k = Int(5)
+
+    #: Minimum prominence of a peak (in the units of the spectra)
+    min_prominence = Float(0.0)
+
+    #: Minimum distance (bins) between peaks
+    min_spacing = Int(1)
+
+    #: Half-width (bins) of the window in which prominences are measured
+    wlen = Int(64)
+
+    #: Sub-bin interpolation
+    interpolation = Enum("parabolic", "gaussian", "none")
+
+    #: Frequency of each bin (defaults to the bin number)
+    freqs = Value()
+
+    #: Peaks of the spectra of the last update (N, k) PEAK_DTYPE
+    peaks = Value()
+
+    def __init__(self, nbins, k=5, min_prominence=0.0, min_spacing=1, freqs=None, **kwargs):
+        """Initialize the detector
+
+        Parameters
+        ----------
+        nbins : int
+            Number of bins per spectrum
+
+        k : int
+            Maximum number of peaks per spectrum
+
+        min_prominence : float
+            Minimum prominence of a peak
+
+        min_spacing : int
+            Minimum distance (bins) between peaks
+
+        freqs : numpy.ndarray
+            Frequency of each bin (see frequency_axis)
+
+        """
+        super(PeakDetector, self).__init__(**kwargs)
+        self.nbins = nbins
+        self.k = k
+        self.min_prominence = min_prominence
+        self.min_spacing = max(1, min_spacing)
+        self.freqs = np.arange(nbins, dtype=np.float64) if freqs is None else np.asarray(freqs, dtype=np.float64)
+        if len(self.freqs) != nbins:
+            raise ValueError("freqs must have {0} values".format(nbins))
+
+    def reset(self):
+        """Discard the peaks of the last update"""
+        self.peaks = None
+
+    def _update(self, block):
+        self.peaks = self.find(block)
+        return self.peaks
+
+    def find(self, data):
+        """Find the peaks of a spectrum (nbins,) or block of spectra (N, nbins)
+
+        Returns
+        -------
+        peaks : numpy.ndarray
+            (k,) or (N, k) PEAK_DTYPE array, strongest peak first
+        """
+        data = np.asarray(data, dtype=np.float64)
+        x = data[np.newaxis] if data.ndim == 1 else data
+        N, B = x.shape
+        if B != self.nbins:
+            raise ValueError("Expected spectra of {0} bins, got {1}".format(self.nbins, B))
+
+        peaks = np.empty((N, self.k), dtype=PEAK_DTYPE)
+        peaks["index"] = -1
+        for name in ("bin", "frequency", "height", "prominence"):
+            peaks[name] = np.nan
+        if B < 3 or self.k < 1:
+            return peaks[0] if data.ndim == 1 else peaks
+
+        #: Local maxima (plateaus count once, at their first bin), in blocks of S bins
+        S = 64
+        nblocks = -(-B // S)
+        heights = np.full((N, nblocks * S), -np.inf)
+        inner = x[:, 1:-1]
+        is_peak = (inner > x[:, :-2]) & (inner >= x[:, 2:])
+        np.copyto(heights[:, 1 : B - 1], inner, where=is_peak)
+
+        #: Widen the candidate set for spectra with fewer than k accepted peaks
+        M = min(B, max(4 * self.k, self.k + 16))
+        rows = np.arange(N)
+        found = np.zeros((N, self.k), dtype=bool)
+        index = np.ones((N, self.k), dtype=np.intp)
+        prominence = np.full((N, self.k), np.nan)
+        while rows.size:
+            f, i, p, more = self._select(x[rows], heights[rows], M)
+            found[rows], index[rows], prominence[rows] = f, i, p
+            rows = rows[(f.sum(axis=1) < self.k) & more]
+            if M == B:
+                break
+            M = min(B, 2 * M)
+        index_safe = np.where(found, index, 1)
+
+        delta, value = self._interpolate(x, index_safe)
+        position = index_safe + delta
+
+        peaks["index"] = np.where(found, index, -1)
+        peaks["bin"] = np.where(found, position, np.nan)
+        peaks["frequency"] = np.where(found, np.interp(position, np.arange(B), self.freqs), np.nan)
+        peaks["height"] = np.where(found, value, np.nan)
+        peaks["prominence"] = np.where(found, prominence, np.nan)
+        return peaks[0] if data.ndim == 1 else peaks
+
+    def _select(self, x, heights, M):
+        """Accept up to k peaks among the M highest local maxima
+
+        Returns
+        -------
+        found, index, prominence : numpy.ndarray
+            (N, k) acceptance mask, bin index and prominence of the accepted peaks
+        more : numpy.ndarray
+            (N,) True where all M candidates were local maxima, so a wider set may hold more
+        """
+        N, B = x.shape
+        S = 64
+        nblocks = heights.shape[1] // S
+
+        #: The M highest peaks lie in the M blocks with the highest maxima
+        blocks = heights.reshape(N, nblocks, S)
+        if nblocks > M:
+            top = np.argpartition(blocks.max(axis=2), nblocks - M, axis=1)[:, nblocks - M :]
+            index = (top[:, :, np.newaxis] * S + np.arange(S)).reshape(N, -1)
+        else:
+            index = np.broadcast_to(np.arange(nblocks * S), (N, nblocks * S))
+
+        #: Highest candidates, in decreasing height
+        values = np.take_along_axis(heights, index, axis=1)
+        cand = np.take_along_axis(index, np.argpartition(values, values.shape[1] - M, axis=1)[:, -M:], axis=1)
+        order = np.argsort(-np.take_along_axis(heights, cand, axis=1), axis=1, kind="stable")
+        cand = np.take_along_axis(cand, order, axis=1)
+        height = np.take_along_axis(heights, cand, axis=1)
+        valid = np.isfinite(height)
+        more = valid.all(axis=1)
+
+        prominence = self._prominence(x, cand, height)
+        valid &= prominence >= self.min_prominence
+
+        #: Suppress candidates near higher accepted peaks
+        accepted = np.zeros_like(valid)
+        for j in range(M):
+            ok = valid[:, j] & (accepted[:, :j].sum(axis=1) < self.k)
+            if j:
+                near = np.abs(cand[:, :j] - cand[:, j : j + 1]) < self.min_spacing
+                ok &= ~(near & accepted[:, :j]).any(axis=1)
+            accepted[:, j] = ok
+
+        #: First k accepted candidates of each spectrum
+        rank = np.where(accepted, np.arange(M), M + np.arange(M))
+        first = np.argsort(rank, axis=1, kind="stable")[:, : self.k]
+        found = np.take_along_axis(accepted, first, axis=1)
+        index = np.take_along_axis(cand, first, axis=1)
+        prominence = np.take_along_axis(prominence, first, axis=1)
+        return found, index, prominence, more
+
+    def _prominence(self, x, cand, height):
+        """Prominence of candidate peaks, within wlen bins on each side"""
+        N, B = x.shape
+        offsets = np.arange(1, max(1, self.wlen) + 1)
+        bases = []
+        for sign in (-1, 1):
+            idx = np.clip(cand[:, :, np.newaxis] + sign * offsets, 0, B - 1)
+            values = np.take_along_axis(x, idx.reshape(N, -1), axis=1).reshape(idx.shape)
+
+            #: Lowest value before the first higher value (or the window edge)
+            higher = values > height[:, :, np.newaxis]
+            stop = np.where(higher.any(axis=2), higher.argmax(axis=2), len(offsets))
+            lowest = np.minimum.accumulate(values, axis=2)
+            bases.append(np.take_along_axis(lowest, np.maximum(stop - 1, 0)[:, :, np.newaxis], axis=2)[:, :, 0])
+
+        return height - np.maximum(bases[0], bases[1])
+
+    def _interpolate(self, x, index):
+        """Sub-bin offset and height of peaks at index (N, k)"""
+        a, b, c = [np.take_along_axis(x, index + d, axis=1) for d in (-1, 0, 1)]
+        if self.interpolation == "none":
+            return np.zeros(b.shape), b
+
+        gaussian = self.interpolation == "gaussian"
+        if gaussian:
+            a, b, c = [np.log(np.maximum(v, 1e-300)) for v in (a, b, c)]
+
+        denom = a - 2 * b + c
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta = np.where(denom < 0, 0.5 * (a - c) / denom, 0.0)
+        delta = np.clip(delta, -0.5, 0.5)
+        value = b - 0.25 * (a - c) * delta
+        return delta, np.exp(value) if gaussian else value
+
+
+class BandPower(ProcessingStage):
+    """Integrated power in named frequency bands
+
+    The band table is converted once to bin ranges of the frequency axis:
+    a band [start, stop) holds the bins whose frequency f satisfies
+    start <= f < stop.  The power of every band is then computed from one
+    cumulative sum of each spectrum,
+
+        power = prefix[stop_bin] - prefix[start_bin]
+
+    so the cost does not depend on the number or width of the bands, and
+    bands may overlap.  Spectra must be in linear units (raw or FS, not dB).
+    The prefix sums are float64; the error of a band is relative to the
+    power of all bins below it, which is negligible unless a weak band lies
+    above a much stronger part of the spectrum.
+
+    Each spectrum gives one (nbands,) row of band powers.  The rows can be
+    logged as a compact time series of their own, with attrs() as the
+    acquisition attributes:
+
+        bands = BandPower(freqs, [("gps", 1.574e9, 1.577e9), ("dc", -1e6, 1e6)])
+        logfile.create_acquisition(bands.nbands, acq_id=1, attrs=bands.attrs())
+        logfile.append(bands.update(fftdata), rows)
+
+    """
+
+    #: Band names
+    names = List()
+
+    #: Band edges (start, stop) in Hz (nbands, 2)
+    edges = Value()
+
+    #: Bin ranges (start, stop) of the bands (nbands, 2)
+    bin_ranges = Value()
+
+    #: Sum or mean of the band bins
+    mode = Enum("sum", "mean")
+
+    #: Band powers of the last spectrum (nbands,)
+    power = Value()
+
+    #: Number of spectra processed since the last reset
+    total = Int()
+
+    #: Number of bins per spectrum
+    nbins = Int()
+
+    #: Cumulative sums (N, nbins + 1) of the last block, with a leading zero column
+    _prefix = Value()
+
+    _start = Value()
+    _stop = Value()
+    _width = Value()
+
+    nbands = property(lambda self: len(self.names))
+
+    def __init__(self, freqs, bands, mode="sum"):
+        """Initialize the band table
+
+        Parameters
+        ----------
+        freqs : numpy.ndarray
+            Frequency of each bin, in increasing order (see frequency_axis)
+
+        bands : list of (name, start, stop) or dict {name: (start, stop)}
+            Band edges in Hz
+
+        mode : str
+            "sum" integrates the power of the band bins, "mean" averages it
+
+        """
+        freqs = np.asarray(freqs, dtype=np.float64)
+        if np.any(np.diff(freqs) <= 0):
+            raise ValueError("The frequency axis must be increasing")
+        if isinstance(bands, dict):
+            bands = [(name, start, stop) for name, (start, stop) in bands.items()]
+
+        names = [str(name) for name, start, stop in bands]
+        if len(set(names)) != len(names):
+            raise ValueError("Duplicate band names")
+        edges = np.array([(start, stop) for name, start, stop in bands], dtype=np.float64).reshape(-1, 2)
+        ranges = np.searchsorted(freqs, edges, side="left")
+        empty = np.flatnonzero(ranges[:, 1] <= ranges[:, 0])
+        if len(empty):
+            raise ValueError("Bands {0} hold no bins".format([names[i] for i in empty]))
+
+        super(BandPower, self).__init__(names=names, edges=edges, bin_ranges=ranges, mode=mode, nbins=len(freqs))
+        self._start = np.ascontiguousarray(ranges[:, 0])
+        self._stop = np.ascontiguousarray(ranges[:, 1])
+        self._width = (self._stop - self._start).astype(np.float64)
+        self.power = np.empty(self.nbands)
+        self.reset()
+
+    def attrs(self):
+        """Attributes describing the bands, stored with a logged band power series"""
+        return {
+            "band_names": list(self.names),
+            "band_edges": self.edges,
+            "bin_ranges": self.bin_ranges,
+            "band_mode": self.mode,
+        }
+
+    def reset(self):
+        """Discard the spectra processed so far"""
+        self.total = 0
+        self.power.fill(np.nan)
+
+    def _update(self, block):
+        """Return the band powers (N, nbands) of a block of spectra"""
+        N, nbins = block.shape
+        if nbins != self.nbins:
+            raise ValueError("Expected {0} bins, got {1}".format(self.nbins, nbins))
+
+        if self._prefix is None or len(self._prefix) < N:
+            self._prefix = np.zeros((N, nbins + 1))
+        prefix = self._prefix[:N]
+        np.cumsum(block, axis=1, out=prefix[:, 1:])
+
+        result = prefix[:, self._stop]
+        result -= prefix[:, self._start]
+        if self.mode == "mean":
+            result /= self._width
+
+        self.power[:] = result[-1]
+        self.total += N
+        return result
+
+
+class ReferenceCalibration(ProcessingStage):
+    """Calibration of spectra with averaged reference spectra
+
+    Reference spectra are kept per state (e.g. "off", "hot", "cold"), and
+    each incoming spectrum is calibrated with them:
+
+        difference : sig - ref
+        ratio      : (sig - ref) / ref       (ON/OFF switching)
+        yfactor    : antenna temperature from hot and cold load references,
+                     T = t_cold + (sig - cold) * (t_hot - t_cold) / (hot - cold)
+
+    with ref the spectrum of reference_state.  Every mode reduces to
+    per-bin coefficients, out = sig * gain + offset, which are computed
+    once when a reference changes, so calibrating a spectrum is a single
+    multiply and add.  Spectra must be in linear units (raw or FS).
+
+    References are averaged by recording spectra into a state, either from
+    the live acquisition or from a logged acquisition:
+
+        cal = ReferenceCalibration(nbins, "ratio", reference_state="off")
+        cal.record("off")           # following updates average the OFF spectra
+        ...
+        cal.finish()                # the average becomes the "off" reference
+        ...
+        calibrated = cal.update(fftdata)
+
+    or given directly with set_reference.  A new reference and its
+    coefficients are swapped in with one assignment, so references can be
+    replaced from another thread while spectra are being calibrated; each
+    block is calibrated with one consistent set of coefficients.  Spectra
+    are passed through unchanged (and counted in `recorded`) while they are
+    being recorded.
+
+    """
+
+    #: Number of bins per spectrum
+    nbins = Int()
+
+    #: Calibration
+    mode = Enum("ratio", "difference", "yfactor")
+
+    #: State whose spectrum is the reference (difference and ratio modes)
+    reference_state = Str("off")
+
+    #: Physical temperatures (K) of the hot and cold loads (yfactor mode)
+    t_hot = Float(290.0)
+    t_cold = Float(77.0)
+
+    #: Averaged reference spectra by state (read-only arrays; replaced, not modified)
+    references = Dict()
+
+    #: State being recorded ("" when calibrating)
+    recording = Str()
+
+    #: Number of spectra averaged into the state being recorded
+    recorded = Int()
+
+    #: Calibrated spectrum of the last update (nbins,)
+    calibrated = Value()
+
+    #: Per-bin (gain, offset) of the current references, or None
+    _coeffs = Value()
+
+    #: Average of the state being recorded
+    _average = Typed(SpectrumStats)
+
+    def __init__(self, nbins, mode="ratio", **kwargs):
+        """Initialize the calibration
+
+        Parameters
+        ----------
+        nbins : int
+            Number of bins per spectrum
+
+        mode : str
+            "ratio", "difference" or "yfactor"
+
+        kwargs :
+            reference_state, t_hot, t_cold
+
+        """
+        super(ReferenceCalibration, self).__init__(nbins=nbins, mode=mode, **kwargs)
+        self.calibrated = np.full(nbins, np.nan)
+
+    @property
+    def ready(self):
+        """True if the references required by the mode are available"""
+        return self._coeffs is not None
+
+    def reset(self):
+        """Discard the references and any reference being recorded"""
+        with self.lock:
+            self.recording = ""
+            self._average = None
+            self.references = {}
+            self._coeffs = None
+            self.calibrated.fill(np.nan)
+
+    def record(self, state):
+        """Average the following spectra into the reference of a state"""
+        with self.lock:
+            self.recording = state
+            self.recorded = 0
+            self._average = SpectrumStats(self.nbins)
+
+    def finish(self):
+        """Stop recording and make the average the reference of the state
+
+        Returns the averaged reference, or None if no spectrum was recorded.
+        """
+        with self.lock:
+            state, average = self.recording, self._average
+            self.recording = ""
+            self._average = None
+        if average is None or average.count == 0:
+            return None
+        self.set_reference(state, average.mean)
+        return self.references[state]
+
+    def set_reference(self, state, spectrum):
+        """Set the reference spectrum of a state and swap in new coefficients"""
+        spectrum = np.array(spectrum, dtype=np.float64)
+        if spectrum.shape != (self.nbins,):
+            raise ValueError("Expected a reference of {0} bins, got {1}".format(self.nbins, spectrum.shape))
+        spectrum.flags.writeable = False
+        references = dict(self.references)
+        references[state] = spectrum
+        coeffs = self._coefficients(references)
+        self.references = references
+        self._coeffs = coeffs
+
+    def _coefficients(self, references):
+        """Return the per-bin (gain, offset) for a set of references, or None"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if self.mode == "yfactor":
+                hot, cold = references.get("hot"), references.get("cold")
+                if hot is None or cold is None:
+                    return None
+                gain = (self.t_hot - self.t_cold) / (hot - cold)
+                return gain, self.t_cold - cold * gain
+
+            ref = references.get(self.reference_state)
+            if ref is None:
+                return None
+            if self.mode == "difference":
+                return np.ones(self.nbins), -ref
+            return 1.0 / ref, np.full(self.nbins, -1.0)
+
+    def receiver_temperature(self):
+        """Return the per-bin receiver noise temperature (K) from the hot and cold references
+
+        Trx = (t_hot - Y * t_cold) / (Y - 1), with Y = hot / cold
+        """
+        references = self.references
+        hot, cold = references["hot"], references["cold"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            Y = hot / cold
+            return (self.t_hot - Y * self.t_cold) / (Y - 1.0)
+
+    def apply(self, data, out=None):
+        """Calibrate a spectrum (nbins,) or spectra (N, nbins) with the current references
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            Spectra in linear units
+
+        out : numpy.ndarray
+            Output array of the same shape (may be data).  Allocated if None.
+
+        Returns
+        -------
+        out : numpy.ndarray
+        """
+        coeffs = self._coeffs
+        if coeffs is None:
+            raise RuntimeError("The references required for {0} calibration are not set".format(self.mode))
+        data = np.asarray(data)
+        if data.shape[-1] != self.nbins:
+            raise ValueError("Expected {0} bins, got {1}".format(self.nbins, data.shape[-1]))
+        if out is None:
+            out = np.empty(data.shape)
+        gain, offset = coeffs
+        np.multiply(data, gain, out=out)
+        np.add(out, offset, out=out)
+        return out
+
+    @observe("mode", "reference_state", "t_hot", "t_cold")
+    def _settings_changed(self, change):
+        """Recompute the coefficients when the mode or its parameters change"""
+        if change["type"] == "update":
+            self._coeffs = self._coefficients(self.references)
+
+    def _update(self, block):
+        """Record or calibrate a block of spectra
+
+        Returns the calibrated block (N, nbins), or None while recording or
+        if the references are not set.
+        """
+        if block.shape[1] != self.nbins:
+            raise ValueError("Expected {0} bins, got {1}".format(self.nbins, block.shape[1]))
+        if self.recording:
+            self._average.update(block)
+            self.recorded = self._average.count
+            return None
+        if self._coeffs is None:
+            return None
+        result = self.apply(block)
+        self.calibrated[:] = result[-1]
+        return result
+
+
+class RFIFlagger(ProcessingStage):
+    """Flagging of interference and outliers against a robust running baseline
+
+    The baseline of each bin is the median of the last `length` spectra,
+    and its spread the median absolute deviation (MAD) scaled to the
+    standard deviation of Gaussian noise (sigma = 1.4826 * MAD).  A bin is
+    flagged if it deviates from the baseline by more than threshold * sigma
+    (above it only, if sided is "upper").  The comparison is vectorized over
+    the bins of a whole block.
+
+    The baseline is recomputed every `refresh` spectra rather than for
+    each spectrum, which divides its cost (two medians over the window)
+    by refresh.  Spectra are flagged against the baseline in effect when
+    they arrive, and nothing is flagged before the first baseline.
+
+    The flags of each spectrum are packed 8 bins per byte (numpy.packbits,
+    see unpack_flags), nbytes = ceil(nbins / 8), which is 1/64 of the size
+    of a float64 spectrum.  They can be logged at full rate as an
+    acquisition of their own:
+
+        logfile.create_acquisition(flagger.nbytes, acq_id=1, dtype="uint8", attrs=flagger.attrs())
+        logfile.append(flagger.update(fftdata), rows)
+
+    Each block and its flags are passed on to the stages in targets, which
+    exclude the flagged bins (see ProcessingStage.accepts_flags):
+
+        stats = SpectrumStats(nbins)
+        flagger = RFIFlagger(nbins, targets=[stats])
+        core.stages.append(flagger)
+
+    """
+
+    #: Number of bins per spectrum
+    nbins = Int()
+
+    #: Number of spectra in the baseline window
+    length = Int(64)
+
+    #: Number of spectra between baseline updates
+    refresh = Int(16)
+
+    #: Flagging threshold, in robust standard deviations
+    threshold = Float(5.0)
+
+    #: Flag deviations in both directions, or only above the baseline
+    sided = Enum("both", "upper")
+
+    #: Stages updated with each block and its flags
+    targets = List()
+
+    #: Baseline median and robust standard deviation of each bin (NaN before the first baseline)
+    median = Value()
+    sigma = Value()
+
+    #: Packed flags (N, nbytes) of the last update
+    flags = Value()
+
+    #: Fraction of the bins of the last spectrum that were flagged
+    fraction = Float()
+
+    #: Number of spectra in the baseline window
+    count = Int()
+
+    #: Number of spectra processed since the last reset
+    total = Int()
+
+    #: Number of spectra since the last baseline update
+    _since = Int()
+
+    #: Last spectra (ring), scratch deviations and flagging limit
+    _ring = Value()
+    _dev = Value()
+    _limit = Value()
+
+    nbytes = property(lambda self: (self.nbins + 7) // 8)
+
+    def __init__(self, nbins, length=64, refresh=16, threshold=5.0, **kwargs):
+        """Initialize the flagger
+
+        Parameters
+        ----------
+        nbins : int
+            Number of bins per spectrum
+
+        length : int
+            Number of spectra in the baseline window
+
+        refresh : int
+            Number of spectra between baseline updates
+
+        threshold : float
+            Flagging threshold, in robust standard deviations
+
+        kwargs :
+            sided, targets
+
+        """
+        if length < 1 or refresh < 1:
+            raise ValueError("length and refresh must be at least 1")
+        super(RFIFlagger, self).__init__(nbins=nbins, length=length, refresh=refresh, threshold=threshold, **kwargs)
+        self._ring = np.empty((length, nbins))
+        self._dev = np.empty((length, nbins))
+        self.median, self.sigma, self._limit = np.empty((3, nbins))
+        self.reset()
+
+    @property
+    def ready(self):
+        """True once the first baseline has been computed"""
+        return self.total >= self.refresh
+
+    def attrs(self):
+        """Attributes describing the flags, stored with a logged flag series"""
+        return {
+            "flag_nbins": self.nbins,
+            "flag_length": self.length,
+            "flag_refresh": self.refresh,
+            "flag_threshold": self.threshold,
+            "flag_sided": self.sided,
+        }
+
+    def reset(self):
+        """Discard the baseline and the spectra processed so far"""
+        self.count = 0
+        self.total = 0
+        self._since = 0
+        self.fraction = 0.0
+        self.median.fill(np.nan)
+        self.sigma.fill(np.nan)
+
+    def _update_baseline(self):
+        """Recompute the median and robust standard deviation of the window"""
+        ring, dev = self._ring[: self.count], self._dev[: self.count]
+        np.median(ring, axis=0, out=self.median)
+        np.subtract(ring, self.median, out=dev)
+        np.abs(dev, out=dev)
+        np.median(dev, axis=0, out=self.sigma, overwrite_input=True)
+        self.sigma *= 1.4826
+        np.multiply(self.sigma, self.threshold, out=self._limit)
+        self._since = 0
+
+    def _update(self, block):
+        """Flag a block of spectra and return the packed flags (N, nbytes)"""
+        N, nbins = block.shape
+        if nbins != self.nbins:
+            raise ValueError("Expected {0} bins, got {1}".format(self.nbins, nbins))
+
+        flags = np.zeros(block.shape, dtype=np.bool_)
+        if self.ready:
+            dev = np.subtract(block, self.median)
+            if self.sided == "both":
+                np.abs(dev, out=dev)
+            np.greater(dev, self._limit, out=flags)
+
+        #: Add the block to the window
+        L = self.length
+        for i in range(max(0, N - L), N):
+            self._ring[(self.total + i) % L] = block[i]
+        self.total += N
+        self.count = min(L, self.count + N)
+        self._since += N
+        if self._since >= self.refresh:
+            self._update_baseline()
+
+        self.flags = np.packbits(flags, axis=1)
+        self.fraction = float(np.count_nonzero(flags[-1])) / nbins
+        for stage in self.targets:
+            stage.update(block, flags)
+        return self.flags
+
+
+class RollingQuantile(ProcessingStage):
+    """Per-bin quantiles of the last `length` spectra
+
+    Tracks, for example, the running median or 10th percentile of each bin
+    (noise floor), updated with each spectrum:
+
+        histogram : approximate (the default).  Values are counted in
+                    `levels` levels between lo and hi (in dB if scale is
+                    "log", for power spectra).  The level and rank of each
+                    tracked quantile are kept, and move by a few levels per
+                    spectrum, so the cost per spectrum is O(bins) and does
+                    not depend on W.  The error is within one level.  Values
+                    outside [lo, hi] are counted in the first or last level.
+                    Memory: uint16 counts (nbins, levels) and a uint16
+                    window.
+        sorted    : exact, for any q and any units, at a cost of
+                    O(bins sqrt(W)) per spectrum.  Each bin keeps its window
+                    in sorted order, in blocks of S values (the power of 2
+                    >= sqrt(W)), each stored as a ring.  The rank of the
+                    removed and of the added value is found from the first
+                    value of each block and a count within one block.  The
+                    values between the two ranks move by one place within
+                    the two end blocks, and the blocks in between are
+                    rotated by one place (one value each).  Quantiles
+                    interpolate linearly between order statistics, as
+                    numpy.percentile does.  Memory: two float64 windows.
+
+    Example, a noise floor over the last 256 power spectra, and the exact
+    median of spectra in dBm:
+
+        floor = RollingQuantile(nbins, 256, quantiles=(0.1, 0.5))
+        floor.update_from_log(acq)
+        floor.values[0], floor.values[1]
+
+        median = RollingQuantile(nbins, 64, method="sorted")
+
+    """
+
+    #: Number of bins per spectrum
+    nbins = Int()
+
+    #: Number of spectra in the window
+    length = Int()
+
+    #: Tracked quantiles, in [0, 1]
+    quantiles = Value()
+
+    #: Algorithm
+    method = Enum("histogram", "sorted")
+
+    #: Histogram: value range, number of levels and scale
+    lo = Float()
+    hi = Float()
+    levels = Int(256)
+    scale = Enum("log", "linear")
+
+    #: Quantiles (len(quantiles), nbins) of the window after the last update
+    values = Value()
+
+    #: Number of spectra in the window
+    count = Int()
+
+    #: Number of spectra processed since the last reset
+    total = Int()
+
+    #: Last spectra (float64, or levels for the histogram method)
+    _ring = Value()
+
+    #: Sorted method: sorted window (nbins, nblocks * block), padded with +inf, in blocks of
+    #: `block` values stored as rings, and the position and value of the first value of each block
+    _sorted = Value()
+    _head = Value()
+    _fronts = Value()
+    _block = Int()
+
+    #: Histogram method: counts (nbins, levels), and level and count of values below it for each quantile
+    _counts = Value()
+    _level = Value()
+    _below = Value()
+
+    _rows = Value()
+
+    def __init__(self, nbins, length, quantiles=(0.5,), method="histogram", lo=-150.0, hi=10.0, **kwargs):
+        """Initialize the window
+
+        Parameters
+        ----------
+        nbins : int
+            Number of bins per spectrum
+
+        length : int
+            Number of spectra in the window
+
+        quantiles : sequence of float
+            Quantiles to track, in [0, 1]
+
+        method : str
+            "histogram" or "sorted" (exact)
+
+        lo, hi : float
+            Histogram range (dB for the log scale)
+
+        kwargs :
+            levels, scale
+
+        """
+        quantiles = np.atleast_1d(np.asarray(quantiles, dtype=np.float64))
+        if np.any(quantiles < 0.0) or np.any(quantiles > 1.0):
+            raise ValueError("Quantiles must be in [0, 1]")
+        if length < 1:
+            raise ValueError("length must be at least 1")
+        super(RollingQuantile, self).__init__(
+            nbins=nbins, length=length, quantiles=quantiles, method=method, lo=lo, hi=hi, **kwargs
+        )
+        if method == "histogram":
+            if not hi > lo or not 2 <= self.levels <= 65535 or length > 65535:
+                raise ValueError("Invalid histogram range, levels or length")
+            self._ring = np.zeros((length, nbins), dtype=np.uint16)
+            self._counts = np.zeros((nbins, self.levels), dtype=np.uint16)
+            self._level = np.zeros((len(quantiles), nbins), dtype=np.int64)
+            self._below = np.zeros((len(quantiles), nbins), dtype=np.int64)
+        else:
+            self._ring = np.empty((length, nbins))
+            self._block = 1 << int(np.ceil(np.log2(length) / 2))
+            nblocks = -(-length // self._block)
+            self._sorted = np.empty((nbins, nblocks * self._block))
+            self._head = np.zeros((nbins, nblocks), dtype=np.intp)
+            self._fronts = np.empty((nbins, nblocks))
+        self._rows = np.arange(nbins)
+        self.values = np.empty((len(quantiles), nbins))
+        self.reset()
+
+    def reset(self):
+        """Discard the spectra processed so far"""
+        self.count = 0
+        self.total = 0
+        self.values.fill(np.nan)
+        if self.method == "histogram":
+            self._counts.fill(0)
+            self._level.fill(0)
+            self._below.fill(0)
+        else:
+            self._sorted.fill(np.inf)
+            self._head.fill(0)
+            self._fronts.fill(np.inf)
+
+    def quantile(self, q):
+        """Return the per-bin quantile q of the window (sorted method: any q)"""
+        if self.method == "histogram":
+            index = np.flatnonzero(self.quantiles == q)
+            if len(index) == 0:
+                raise ValueError("The histogram method only provides the tracked quantiles")
+            return self._histogram_value(index[0])
+        if self.count == 0:
+            return np.full(self.nbins, np.nan)
+        pos = q * (self.count - 1)
+        i = int(np.floor(pos))
+        frac = pos - i
+        flat = self._sorted.reshape(-1)
+        result = flat[self._index(self._rows, i)]
+        if frac > 0.0:
+            result *= 1.0 - frac
+            result += frac * flat[self._index(self._rows, i + 1)]
+        return result
+
+    def _update(self, block):
+        """Add a block of spectra to the window"""
+        if block.shape[1] != self.nbins:
+            raise ValueError("Expected {0} bins, got {1}".format(self.nbins, block.shape[1]))
+        add = self._add_sorted if self.method == "sorted" else self._add_histogram
+        for x in block:
+            add(x)
+            self.total += 1
+
+        for i, q in enumerate(self.quantiles):
+            self.values[i] = self.quantile(q) if self.method == "sorted" else self._histogram_value(i)
+        return self.values
+
+    def _index(self, rows, rank):
+        """Return the flat index in the sorted window of the value of each rank of rows"""
+        S = self._block
+        shift = S.bit_length() - 1
+        block = rows * self._head.shape[1] + (rank >> shift)
+        return (block << shift) + ((self._head.reshape(-1)[block] + rank) & (S - 1))
+
+    def _search(self, x):
+        """Return the first rank of each row of the sorted window whose value is >= x
+
+        x is (nbins,) or (n, nbins).  The block is the last one whose first value is
+        < x; the rank within it is the number of its values < x.
+        """
+        S = self._block
+        x = np.asarray(x)[..., np.newaxis]
+        block = np.maximum(np.count_nonzero(self._fronts < x, axis=-1) - 1, 0)
+        values = self._sorted.reshape(self.nbins, -1, S)[self._rows, block]
+        return block * S + np.count_nonzero(values < x, axis=-1)
+
+    def _ranges(self, rows, starts, counts):
+        """Return the rows and values of the concatenated ranges [start, start + count) of rows"""
+        owner = np.repeat(rows, counts)
+        values = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        values += np.arange(len(values))
+        return owner, values
+
+    def _add_sorted(self, x):
+        """Replace the oldest value of each sorted row with x"""
+        W, S, rows = self.length, self._block, self._rows
+        flat = self._sorted.reshape(-1)
+        k = self.total % W
+
+        #: Rank of the removed value (the +inf padding while the window fills)
+        old = self._ring[k] if self.count == W else np.full(self.nbins, np.inf)
+        a, b = self._search(np.stack((old, x)))
+        self._ring[k] = x
+        self.count = min(W, self.count + 1)
+
+        #: Remove rank a and insert x at rank c: the values between move one place
+        #: towards rank a.  Within the blocks of ranks a and c they are moved one by
+        #: one; the blocks in between are rotated, passing one value along.
+        up = b > a
+        c = np.where(up, b - 1, b)
+        step = np.where(up, 1, -1)
+        ia, ic = a // S, c // S
+        low, high = np.minimum(ia, ic), np.maximum(ia, ic)
+        first = np.where(up, a, c + 1)
+        last = np.where(up, c, a + 1)
+        split = np.where(low == high, last, np.stack(((low + 1) * S, high * S)))
+        begin = np.concatenate((first, split[1]))
+        owner, rank = self._ranges(np.tile(rows, 2), begin, np.maximum(np.concatenate((split[0], last)) - begin, 0))
+
+        blocks, block = self._ranges(rows, low + 1, np.maximum(high - low - 1, 0))
+        ring = np.where(up[blocks], block * S, (block + 1) * S - 1)
+
+        owner = np.concatenate((owner, blocks))
+        dest = np.concatenate((rank, ring))
+        src = dest + np.concatenate((step[owner[: len(rank)]], step[blocks] * S))
+        flat[self._index(owner, dest)] = flat[self._index(owner, src)]
+        flat[self._index(rows, c)] = x
+        self._head[blocks, block] = (self._head[blocks, block] + step[blocks]) & (S - 1)
+
+        owner, block = self._ranges(rows, low, high - low + 1)
+        self._fronts[owner, block] = flat[self._index(owner, block * S)]
+
+    def _to_level(self, x):
+        """Return the histogram level of each value of x"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            y = 10.0 * np.log10(x) if self.scale == "log" else np.asarray(x, dtype=np.float64)
+        y = (y - self.lo) * (self.levels / (self.hi - self.lo))
+        np.nan_to_num(y, copy=False, nan=0.0)
+        return np.clip(y, 0, self.levels - 1).astype(np.uint16)
+
+    def _add_histogram(self, x):
+        """Replace the oldest value of each histogram with x, and move the tracked quantiles"""
+        W, counts, rows = self.length, self._counts, self._rows
+        k = self.total % W
+        new = self._to_level(x).astype(np.int64)
+        full = self.count == W
+        if full:
+            old = self._ring[k].astype(np.int64)
+            counts[rows, old] -= 1
+        counts[rows, new] += 1
+        self._ring[k] = new
+        self.count = min(W, self.count + 1)
+
+        for i, q in enumerate(self.quantiles):
+            level, below = self._level[i], self._below[i]
+            below += new < level
+            if full:
+                below -= old < level
+
+            #: Rank of the quantile; the invariant is below <= rank < below + counts[level]
+            rank = int(np.floor(q * (self.count - 1)))
+            down = np.flatnonzero(below > rank)
+            while len(down):
+                level[down] -= 1
+                below[down] -= counts[down, level[down]]
+                down = down[below[down] > rank]
+            up = np.flatnonzero(below + counts[rows, level] <= rank)
+            while len(up):
+                below[up] += counts[up, level[up]]
+                level[up] += 1
+                up = up[below[up] + counts[up, level[up]] <= rank]
+
+    def _histogram_value(self, i):
+        """Return the value of tracked quantile i, interpolated within its level"""
+        if self.count == 0:
+            return np.full(self.nbins, np.nan)
+        level, below = self._level[i], self._below[i]
+        rank = np.floor(self.quantiles[i] * (self.count - 1))
+        n = self._counts[self._rows, level]
+        y = self.lo + (level + (rank - below + 0.5) / np.maximum(n, 1)) * ((self.hi - self.lo) / self.levels)
+        return 10.0 ** (y / 10.0) if self.scale == "log" else y
+
+
+class AllanVariance(ProcessingStage):
+    """Streaming per-bin Allan variance at octave-spaced averaging times
+
+    The Allan variance at tau = 2**m spectra is half the mean squared
+    difference of consecutive (non-overlapping) averages of 2**m spectra.
+    Level m keeps, for each bin, the last average of 2**m spectra, an
+    average waiting for its partner to form the next level, and the sum of
+    squared differences.  A block of spectra is reduced level by level with
+    pairwise means, so the cost per spectrum is O(bins) amortized and the
+    memory is O(bins log T) for T spectra.  The result does not depend on
+    how the spectra are split into blocks, so the live acquisition and a
+    log read in chunks give the same variances.
+
+    The input can be spectra or, for the stability of bands, the band
+    powers of BandPower:
+
+        allan = AllanVariance(acq.shape[1], tau0=0.1)
+        allan.update_from_log(acq)
+        taus, avar = allan.taus, allan.variance()
+
+    """
+
+    #: Number of bins per spectrum
+    nbins = Int()
+
+    #: Time between spectra (s)
+    tau0 = Float(1.0)
+
+    #: Number of spectra processed since the last reset
+    total = Int()
+
+    #: Per level: last average, average waiting for its partner (or None),
+    #: sum of squared differences and number of differences
+    _prev = List()
+    _pending = List()
+    _sum = List()
+    _count = List()
+
+    def __init__(self, nbins, tau0=1.0):
+        """Initialize the accumulator
+
+        Parameters
+        ----------
+        nbins : int
+            Number of bins (or bands) per spectrum
+
+        tau0 : float
+            Time between spectra (s)
+
+        """
+        super(AllanVariance, self).__init__(nbins=nbins, tau0=tau0)
+        self.reset()
+
+    def reset(self):
+        """Discard the spectra processed so far"""
+        self.total = 0
+        self._prev = []
+        self._pending = []
+        self._sum = []
+        self._count = []
+
+    @property
+    def levels(self):
+        """Number of averaging times with at least one difference"""
+        return sum(1 for n in self._count if n > 0)
+
+    @property
+    def taus(self):
+        """Averaging times (s) of the variances"""
+        return self.tau0 * 2.0 ** np.arange(self.levels)
+
+    @property
+    def counts(self):
+        """Number of differences averaged at each averaging time"""
+        return np.array(self._count[: self.levels], dtype=np.int64)
+
+    def variance(self):
+        """Return the Allan variance (levels, nbins) at each averaging time"""
+        levels = self.levels
+        if levels == 0:
+            return np.empty((0, self.nbins))
+        return np.array(self._sum[:levels]) / (2.0 * self.counts[:, np.newaxis])
+
+    def deviation(self):
+        """Return the Allan deviation (levels, nbins)"""
+        return np.sqrt(self.variance())
+
+    def _update(self, block):
+        """Add a block of spectra (N, nbins)"""
+        if block.shape[1] != self.nbins:
+            raise ValueError("Expected {0} bins, got {1}".format(self.nbins, block.shape[1]))
+        self.total += len(block)
+
+        y = np.asarray(block, dtype=np.float64)
+        m = 0
+        while len(y):
+            if m == len(self._prev):
+                self._prev.append(None)
+                self._pending.append(None)
+                self._sum.append(np.zeros(self.nbins))
+                self._count.append(0)
+
+            #: Differences of consecutive averages at this level
+            seq = y if self._prev[m] is None else np.concatenate([self._prev[m][np.newaxis], y])
+            if len(seq) > 1:
+                d = np.diff(seq, axis=0)
+                self._sum[m] += np.einsum("ij,ij->j", d, d)
+                self._count[m] += len(d)
+            self._prev[m] = y[-1].copy()
+
+            #: Pairs of averages form the averages of the next level
+            if self._pending[m] is not None:
+                y = np.concatenate([self._pending[m][np.newaxis], y])
+            npairs = len(y) // 2
+            self._pending[m] = y[-1].copy() if len(y) % 2 else None
+            y = y[: 2 * npairs].reshape(npairs, 2, self.nbins).mean(axis=1)
+            m += 1
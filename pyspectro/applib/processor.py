@@ -148,13 +148,22 @@ class CommandThread(Atom):
                 )
             )
 
-    def _get_cmd(self):
-        """Check for new command without blocking
+    def _get_cmd(self, timeout=0):
+        """Check for new command
 
         Get command from queue.  Return empty string if queue is empty.
+
+        Parameters
+        ----------
+        timeout : float or None
+            Seconds to wait for a command.  The default (0) does not block.
+            None blocks until a command is received.
         """
         try:
-            cmd = self._command.get(False)
+            if timeout == 0:
+                cmd = self._command.get(False)
+            else:
+                cmd = self._command.get(True, timeout)
 
         except:
             cmd = ""
@@ -0,0 +1,423 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, DSPlogic, Inc.  All Rights Reserved.
+#
+# RESTRICTED RIGHTS
+# Use of this software is permitted only with a software license agreement.
+#
+# Details of the software license agreement are in the file LICENSE.txt,
+# distributed with this software.
+# -----------------------------------------------------------------------------
+
+"""Raw memory-mapped spectrum logs
+
+A raw log is a directory holding a JSON header and, for each acquisition,
+two preallocated .npy files that are written through memory maps:
+
+    header.json                  : file and acquisition metadata
+    acq00000001.fftdata.npy      : (capacity, nbins) float32 spectra
+    acq00000001.meta.npy         : (capacity,) rows table (datalogger.ROW_DTYPE)
+
+Acquisitions logged in DDR memory order store (capacity, 2, nbins/2)
+memory contents instead, and record layout = "ddr", Nfft and complexData
+in their header entry.
+
+The number of valid rows of each acquisition is stored in the header,
+which is replaced atomically after the rows have been flushed.  When the
+file is closed the .npy files are truncated to the valid rows.
+
+Raw logs are written by SpectrumDataLogger with backend="raw", read with
+RawLogReader and converted to the HDF5 layout with convert_rawlog_to_hdf5.
+
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+from atom.api import Atom, Bool, Dict, Float, Int, List, Str, Value
+
+from .datalogger import LOG_FILE_SUFFIX, ROW_DTYPE, Hdf5LogFile, LogAcquisition, _fft_view
+
+logger = logging.getLogger(__name__)
+
+#: Suffix shared by all raw log files (directories)
+RAW_LOG_SUFFIX = "-pyspectro_acq_data.rawlog"
+
+#: Format identifier stored in the header
+RAW_LOG_FORMAT = "pyspectro-rawlog"
+
+HEADER_NAME = "header.json"
+
+#: Header entry keys that describe the raw files rather than the acquisition
+_ENTRY_KEYS = ("name", "acq_id", "segment", "nbins", "count", "stop_time", "fftdata", "meta", "layout")
+
+
+def _truncate_npy(path, rows):
+    """Truncate a .npy file to its first `rows` rows
+
+    The header is rewritten in place (padded to its original length)
+    and the file is cut after the last row.
+    """
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            prefix = 10
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            prefix = 12
+        offset = f.tell()
+
+        header = {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": fortran_order,
+            "shape": (rows,) + tuple(shape[1:]),
+        }
+        text = repr(header).ljust(offset - prefix - 1) + "\n"
+        f.seek(prefix)
+        f.write(text.encode("latin1"))
+
+    row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize
+    os.truncate(path, offset + rows * row_bytes)
+
+
+class RawLogFile(Atom):
+    """A spectrum log file in raw memory-mapped format
+
+    This class has the same interface as Hdf5LogFile, so that it can be
+    used by SpectrumDataLogger as an alternative backend.  Space for
+    `capacity` measurements is preallocated for each acquisition.
+
+    """
+
+    #: Full path of the log (a directory)
+    path = Str()
+
+    #: Number of acquisitions in the file
+    n_acq = Int(0)
+
+    #: Time (time.monotonic) the file was created
+    created = Float()
+
+    #: Number of measurements in the current acquisition
+    count = Int(0)
+
+    #: Measurements preallocated per acquisition
+    capacity = Int()
+
+    #: Time (time.time) the last measurements were appended
+    stop_time = Float()
+
+    #: Name of the current acquisition
+    acq_name = property(lambda self: "acq{0:08d}".format(self.n_acq))
+
+    #: Raw files are never written in SWMR mode
+    swmr = Bool(False)
+
+    #: Another acquisition can always be added
+    accepts_acquisition = property(lambda self: True)
+
+    #: Number of measurements that can still be appended to the current acquisition
+    free_rows = property(lambda self: self.capacity - self.count)
+
+    _header = Dict()
+    _fftdata = Value()
+    _meta = Value()
+    _nbytes = Int(0)
+
+    def __init__(self, path, session="", sequence=0, capacity=4096):
+        """Create a raw log file
+
+        Parameters
+        ----------
+        path : str
+            Path of the log directory.  An existing log will not be overwritten.
+
+        session : str
+            Logger session timestamp
+
+        sequence : int
+            File sequence number within the session
+
+        capacity : int
+            Number of measurements preallocated per acquisition
+
+        """
+        self.path = path
+        self.capacity = capacity
+        self.created = time.monotonic()
+        os.makedirs(path)
+        self._header = {
+            "format": RAW_LOG_FORMAT,
+            "version": 2,
+            "session": session,
+            "sequence": sequence,
+            "complete": False,
+            "acquisitions": [],
+        }
+        self._write_header()
+
+    @property
+    def nbytes(self):
+        """Preallocated size of the file in bytes"""
+        return self._nbytes
+
+    def _write_header(self):
+        """Atomically replace the header"""
+        fullfile = os.path.join(self.path, HEADER_NAME)
+        with open(fullfile + ".tmp", "w") as f:
+            json.dump(self._header, f, indent=1)
+        os.replace(fullfile + ".tmp", fullfile)
+
+    def _close_maps(self):
+        """Flush and release the memory maps of the current acquisition"""
+        if self._fftdata is not None:
+            self._fftdata.flush()
+            self._meta.flush()
+            self._fftdata = None
+            self._meta = None
+
+    def create_acquisition(
+        self,
+        nbins,
+        acq_id,
+        segment=0,
+        chunk_rows=1,
+        dtype="float32",
+        layout=None,
+        attrs=None,
+        pyramid=None,
+        compression=None,
+    ):
+        """Preallocate the files for a new acquisition
+
+        Spectra are always stored as float32.  Pyramids and compression are
+        not supported.  See Hdf5LogFile.create_acquisition for the other
+        parameters.
+        """
+        if pyramid is not None or compression is not None:
+            raise ValueError("Raw logs do not support pyramids or compression")
+
+        self._close_maps()
+
+        self.n_acq += 1
+        self.count = 0
+
+        name = self.acq_name
+        entry = {
+            "name": name,
+            "acq_id": acq_id,
+            "segment": segment,
+            "nbins": nbins,
+            "count": 0,
+            "fftdata": name + ".fftdata.npy",
+            "meta": name + ".meta.npy",
+        }
+
+        row_shape = (nbins,)
+        if layout is not None:
+            row_shape = (2, nbins // 2)
+            entry.update(layout="ddr", Nfft=layout["Nfft"], complexData=layout["complexData"])
+        for key, value in (attrs or {}).items():
+            entry[key] = value.tolist() if isinstance(value, np.ndarray) else value
+
+        self._fftdata = np.lib.format.open_memmap(
+            os.path.join(self.path, entry["fftdata"]), mode="w+", dtype="<f4", shape=(self.capacity,) + row_shape
+        )
+        self._meta = np.lib.format.open_memmap(
+            os.path.join(self.path, entry["meta"]), mode="w+", dtype=ROW_DTYPE, shape=(self.capacity,)
+        )
+        self._nbytes += self._fftdata.nbytes + self._meta.nbytes
+
+        self._header["acquisitions"].append(entry)
+        self._write_header()
+
+        logger.debug("Created acquisition %s in %s" % (name, self.path))
+
+    def append(self, fftdata, rows, stop_time=None):
+        """Append a batch of measurements to the current acquisition
+
+        Rows are copied into the memory maps before the count in the header
+        is updated, so the count is recoverable if the process crashes.
+        Pages written through a memory map are kept by the operating system
+        when the process exits, so the maps are only synced to disk when the
+        acquisition ends.
+        """
+        n = len(rows)
+        i0 = self.count
+        i1 = i0 + n
+        if i1 > self.capacity:
+            raise ValueError("Raw log acquisition is full (capacity %s)" % self.capacity)
+
+        self._fftdata[i0:i1] = fftdata
+        self._meta[i0:i1] = rows
+
+        self.count = i1
+        self.stop_time = time.time() if stop_time is None else stop_time
+        self._header["acquisitions"][-1]["count"] = i1
+        self._header["acquisitions"][-1]["stop_time"] = self.stop_time
+        self._write_header()
+
+    def close(self):
+        """Truncate the acquisitions to their valid rows and mark the file complete"""
+        if self._header.get("complete", True):
+            return
+
+        self._close_maps()
+
+        for entry in self._header["acquisitions"]:
+            _truncate_npy(os.path.join(self.path, entry["fftdata"]), entry["count"])
+            _truncate_npy(os.path.join(self.path, entry["meta"]), entry["count"])
+
+        self._header["complete"] = True
+        self._write_header()
+
+        logger.debug("Closed %s" % self.path)
+
+
+class RawLogAcquisition(LogAcquisition):
+    """One acquisition in a raw log
+
+    The datasets are read-only memory maps of the .npy files, so slicing
+    returns views of the file without copying.
+    """
+
+    _entry = Dict()
+
+    attrs = property(lambda self: self._entry)
+
+    def __init__(self, path, entry):
+        """Initialize from a raw log header entry"""
+        self._entry = entry
+        self.name = entry["name"]
+        self.acq_id = entry["acq_id"]
+        self.segment = entry["segment"]
+
+        count = entry["count"]
+        fftdata = np.load(os.path.join(path, entry["fftdata"]), mmap_mode="r")
+        meta = np.load(os.path.join(path, entry["meta"]), mmap_mode="r")
+
+        self.fftdata = _fft_view(fftdata, count, entry)
+        self.msrmnt_count = self.fftdata.count
+        self._set_rows(meta, count, entry)
+
+    def refresh(self):
+        """Do nothing
+
+        A raw log is read once it is closed, so there are no new rows to read.
+        """
+
+
+class RawLogReader(Atom):
+    """Raw spectrum log reader
+
+    Memory maps the acquisitions of a raw log.  The reader has the same
+    interface as SpectrumDataReader:
+
+        with RawLogReader(path) as reader:
+            for acq in reader.acquisitions:
+                spectra = acq[:]      # (msrmnt_count, nbins) float32 view
+
+    """
+
+    #: List of acquisitions (RawLogAcquisition)
+    acquisitions = property(lambda self: self._acquisitions)
+
+    #: Header contents
+    header = property(lambda self: self._header)
+
+    _filepath = Str()
+    _header = Dict()
+    _acquisitions = List()
+
+    def __init__(self, file):
+        """Initialize the reader
+
+        Parameters
+        ----------
+        file: str
+            Path of the raw log directory
+
+        """
+        self._filepath = file
+        with open(os.path.join(file, HEADER_NAME)) as f:
+            self._header = json.load(f)
+
+        if self._header.get("format") != RAW_LOG_FORMAT:
+            raise ValueError("%s is not a raw spectrum log" % file)
+
+        self._acquisitions = [RawLogAcquisition(file, entry) for entry in self._header["acquisitions"]]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, dtype, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._acquisitions)
+
+    def __getitem__(self, idx):
+        return self._acquisitions[idx]
+
+    def close(self):
+        """Release the memory maps"""
+        self._acquisitions = []
+
+
+def convert_rawlog_to_hdf5(file, dest=None, dtype="float64", rows=4096):
+    """Convert a raw log to the HDF5 log layout
+
+    Parameters
+    ----------
+    file : str
+        Path of the raw log directory
+
+    dest : str
+        Path of the HDF5 file to create.  Defaults to the raw log path with
+        the HDF5 log suffix.
+
+    dtype : str
+        Data type of the converted spectra.  The HDF5 logger writes float64.
+
+    rows : int
+        Number of measurements converted at a time
+
+    Returns
+    -------
+    dest : str
+        Path of the HDF5 file
+    """
+    if dest is None:
+        dest = file[: -len(RAW_LOG_SUFFIX)] if file.endswith(RAW_LOG_SUFFIX) else file
+        dest += LOG_FILE_SUFFIX
+
+    with RawLogReader(file) as reader:
+        header = reader.header
+        out = Hdf5LogFile(dest, header.get("session", ""), header.get("sequence", 0))
+        try:
+            for acq in reader.acquisitions:
+                nbins = acq.shape[1]
+                chunk_rows = max(1, (1 << 20) // (np.dtype(dtype).itemsize * nbins))
+                attrs = {key: value for key, value in acq.attrs.items() if key not in _ENTRY_KEYS}
+                out.create_acquisition(nbins, acq.acq_id, acq.segment, chunk_rows, dtype, attrs=attrs)
+                for i0 in range(0, len(acq), rows):
+                    i1 = min(i0 + rows, len(acq))
+                    out.append(
+                        np.asarray(acq[i0:i1], dtype=dtype), acq.rows[i0:i1], stop_time=acq.attrs.get("stop_time")
+                    )
+        finally:
+            out.close()
+
+    logger.info("Converted %s to %s" % (file, dest))
+    return dest
+
+
+if __name__ == "__main__":
+
+    #: Convert raw logs given on the command line
+    for arg in sys.argv[1:]:
+        convert_rawlog_to_hdf5(arg)
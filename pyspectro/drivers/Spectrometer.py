@@ -631,7 +631,7 @@ class MemoryConverter(Atom):
                 self._ddra_indices[k * 8 : (k + 1) * 8] = bitrev_indices[2 * k * 8 + np.arange(8)]
                 self._ddrb_indices[k * 8 : (k + 1) * 8] = bitrev_indices[(2 * k + 1) * 8 + np.arange(8)]
 
-    def process(self, data_ddra, data_ddrb):
+    def process(self, data_ddra, data_ddrb, out=None):
         """Convert memory data to FFT format
 
         Parameters
@@ -642,17 +642,23 @@ class MemoryConverter(Atom):
                 Nfft/2 (fft of complex data)
                 Nfft/4 (fft of real data)
 
+            A batch of measurements can be converted at once by passing
+            (N, length) arrays.
+
+        out : numpy.array
+            Optional output array (length Nfft or Nfft/2, or (N, length))
 
         """
-        if self.complexData:
-            result = np.empty((self.Nfft,), dtype=np.float64)
+        nbins = self.Nfft if self.complexData else self.Nfft // 2
 
+        if out is None:
+            result = np.empty(np.shape(data_ddra)[:-1] + (nbins,), dtype=np.float64)
         else:
-            result = np.empty((self.Nfft // 2,), dtype=np.float64)
+            result = out
 
         #: Assign memory data to FFT bins
-        result[self._ddra_indices] = data_ddra
-        result[self._ddrb_indices] = data_ddrb
+        result[..., self._ddra_indices] = data_ddra
+        result[..., self._ddrb_indices] = data_ddrb
 
         return result
 
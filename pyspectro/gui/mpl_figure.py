@@ -173,7 +173,7 @@ class MplFigure(Atom):
 
 
 # from pyspectro.common.helpers import scalePlotData
-from pyspectro.applib.processing import convert_raw_to_fs, convert_fs_to_dbfs, convert_fs_to_dBm
+from pyspectro.applib.processing import frequency_axis, get_converter
 
 
 class SpectrumFigure(MplFigure):
@@ -190,6 +190,9 @@ class SpectrumFigure(MplFigure):
 
     voltageRange = Enum(1.0, 2.0)
 
+    #: Converted data of the last redraw
+    _ydata_out = Value()
+
     def __init__(self, *args, **kwargs):
 
         super(SpectrumFigure, self).__init__(*args, **kwargs)
@@ -211,37 +214,32 @@ class SpectrumFigure(MplFigure):
     def update_xrange(self):
         """Set frequency range (in MHz)"""
 
-        if self.complexData:
+        self.xdata = frequency_axis(self.Nfft, self.complexData, self.sampleRate) / 1.0e6
 
-            self.xdata = self.sampleRate * (np.arange(self.Nfft) - self.Nfft / 2.0) / float(self.Nfft) / 1.0e6
+        if self.complexData:
 
             self.xrange = (-self.sampleRate / 2.0 / 1.0e6, +self.sampleRate / 2.0 / 1.0e6)
 
         else:
 
-            self.xdata = self.sampleRate * np.arange(self.Nfft / 2.0) / float(self.Nfft) / 1.0e6
-
             self.xrange = (0, self.sampleRate / 2.0 / 1.0e6)
 
     def format_data(self):
 
-        ydata = self.ydata
+        ydata = np.asarray(self.ydata)
 
-        fft_fs = convert_raw_to_fs(ydata, self.numAverages, self.complexData)
+        #: The FFT size follows the data, as in convert_raw_to_fs
+        Nfft = ydata.shape[-1] if self.complexData else 2 * ydata.shape[-1]
+        convert = get_converter(
+            Nfft, self.complexData, self.numAverages, self.voltageRange, self.units, sampleRate=self.sampleRate
+        )
 
-        if self.units == "FS":
-            return self.xdata, fft_fs
+        #: Converted in place into the buffer of the previous redraw
+        out = self._ydata_out
+        if out is None or out.shape != ydata.shape:
+            out = self._ydata_out = np.empty(ydata.shape)
 
-        elif self.units == "dB-FS":
-            fft_dbfs = convert_fs_to_dbfs(fft_fs, self.complexData)
-            return self.xdata, fft_dbfs
-
-        elif self.units == "dBm":
-            fft_dbfs = convert_fs_to_dBm(fft_fs, self.complexData, self.voltageRange)
-            return self.xdata, fft_dbfs
-
-        else:
-            raise Exception("Units not yet supported")
+        return self.xdata, convert(ydata, out=out)
 
 
 if __name__ == "__main__":
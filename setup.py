@@ -28,5 +28,6 @@ setup(
     author_email='inforequest@dsplogic.com',
     url='http://www.dsplogic.com',
     license='Licensed with restricted rights.  See LICENSE.txt for details',
-    entry_points={'console_scripts': ['pyspectro = pyspectro.__main__:main']}
+    entry_points={'console_scripts': ['pyspectro = pyspectro.__main__:main',
+                                        'pyspectro-logmerge = pyspectro.applib.logmerge:main']}
 )
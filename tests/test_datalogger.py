@@ -0,0 +1,706 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, DSPlogic, Inc.  All Rights Reserved.
+#
+# RESTRICTED RIGHTS
+# Use of this software is permitted only with a software license agreement.
+#
+# Details of the software license agreement are in the file LICENSE.txt,
+# distributed with this software.
+# -----------------------------------------------------------------------------
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from pyspectro.applib.acq_control import AcquisitionDataBuffer, AcquisitionStats
+from pyspectro.applib.datalogger import (
+    ROW_FLAG_DROPPED,
+    Hdf5LogFile,
+    LogBlockCache,
+    SpectrumDataLogger,
+    SpectrumDataReader,
+    list_log_files,
+    make_rows,
+)
+from pyspectro.applib.logcatalog import CATALOG_NAME, LogCatalog, rebuild_catalog, scan_log_file
+from pyspectro.applib.logcompression import (
+    available_compressions,
+    calibrate_compression,
+    calibrate_compression_process,
+    compression_options,
+)
+from pyspectro.applib.logmerge import MERGE_JOURNAL_NAME, merge_logs
+from pyspectro.applib.rawlog import RAW_LOG_SUFFIX, RawLogFile, RawLogReader, convert_rawlog_to_hdf5
+from pyspectro.drivers.Spectrometer import MemoryConverter
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(relativeCreated)5d %(name)-15s %(levelname)-8s %(message)s")
+
+Nfft = 64
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+
+        self.buf = AcquisitionDataBuffer()
+        self.buf.stats = AcquisitionStats()
+        self.buf.numAverages = 1024
+
+        self.log = SpectrumDataLogger(Nfft, False, self.buf, directory=self.tmpdir)
+
+    def tearDown(self):
+
+        self.log.terminate()
+        shutil.rmtree(self.tmpdir)
+
+    def store(self, k):
+        """Load measurement k into the buffer and log it"""
+        with self.buf.lock:
+            self.buf.fftdata = np.arange(Nfft // 2, dtype=np.float64) + k
+            self.buf.stats.Nmsr_total = k + 1
+            self.buf.time_monotonic_ns = time.monotonic_ns()
+            self.buf.time_utc_ns = time.time_ns()
+
+        self.log.send_command("store")
+        self.assertTrue(self.log.store_done.wait(5.0))
+        self.log.store_done.clear()
+
+    def read_files(self):
+        return [SpectrumDataReader(f) for f in list_log_files(self.tmpdir)]
+
+    def testBatchedWrites(self):
+
+        self.log.flush_rows = 4
+        self.log.flush_interval = 60.0
+        self.log.initialize(thread_name="Logger")
+        self.log.send_command("start")
+
+        for k in range(10):
+            self.store(k)
+
+        #: Two full batches written, two measurements staged
+        self.assertEqual(self.log._logfile.count, 8)
+
+        self.log.send_command("stop")
+        self.log.terminate()
+
+        (reader,) = self.read_files()
+        (acq,) = reader.acquisitions
+        self.assertEqual(acq["msrmnt_count"], 10)
+        self.assertEqual(list(acq["msrmnt_idx"][0:10]), list(range(1, 11)))
+        np.testing.assert_array_equal(acq["fftdata"][:, 0], np.arange(10))
+
+    def testFlushInterval(self):
+
+        self.log.flush_rows = 100
+        self.log.flush_interval = 0.1
+        self.log.initialize(thread_name="Logger")
+        self.log.send_command("start")
+
+        self.store(0)
+        self.assertEqual(self.log._logfile.count, 0)
+
+        time.sleep(0.5)
+        self.assertEqual(self.log._logfile.count, 1)
+
+        self.log.send_command("stop")
+
+    def testMultipleAcquisitionsPerFile(self):
+
+        self.log.rotation.max_acquisitions = 2
+        self.log.initialize(thread_name="Logger")
+
+        for n in range(3):
+            self.log.send_command("start")
+            for k in range(n + 1):
+                self.store(k)
+            self.log.send_command("stop")
+
+        self.log.terminate()
+
+        readers = self.read_files()
+        self.assertEqual(len(readers), 2)
+        self.assertEqual([len(r.acquisitions) for r in readers], [2, 1])
+        counts = [acq["msrmnt_count"] for r in readers for acq in r.acquisitions]
+        self.assertEqual(counts, [1, 2, 3])
+        acq_ids = [acq["acq_id"] for r in readers for acq in r.acquisitions]
+        self.assertEqual(acq_ids, [1, 2, 3])
+
+    def testRotateBySize(self):
+
+        self.log.max_measurements_per_acq = 0
+        self.log.flush_rows = 4
+        self.log.rotation.max_bytes = 4096
+        self.log.initialize(thread_name="Logger")
+        self.log.send_command("start")
+
+        for k in range(40):
+            self.store(k)
+
+        self.log.send_command("stop")
+        self.log.terminate()
+
+        readers = self.read_files()
+        self.assertGreater(len(readers), 1)
+
+        #: The acquisition is continued across files without gaps
+        segments = [acq for r in readers for acq in r.acquisitions]
+        self.assertEqual([acq["segment"] for acq in segments], list(range(len(segments))))
+        msrmnt_idx = np.concatenate([acq["msrmnt_idx"][0 : acq["msrmnt_count"]] for acq in segments])
+        np.testing.assert_array_equal(msrmnt_idx, np.arange(1, 41))
+
+        for r in readers:
+            self.assertTrue(r._file.attrs["complete"])
+
+    def testRowTable(self):
+
+        self.log.settings = {"SampleRate": 3.2e9, "SerialNumber": "MY00090383"}
+        self.log.initialize(thread_name="Logger")
+        self.log.send_command("start")
+
+        t0 = time.time_ns()
+        for k in range(6):
+            if k == 3:
+                self.buf.stats.Nmsr_drop += 2
+            self.store(k)
+
+        self.log.send_command("stop")
+        self.log.terminate()
+
+        (path,) = list_log_files(self.tmpdir)
+        with SpectrumDataReader(path) as reader:
+            (acq,) = reader.acquisitions
+            group = acq._group
+            self.assertEqual(sorted(group.keys()), ["fftdata", "row_index", "rows"])
+
+            #: Settings are stored once per acquisition
+            self.assertEqual(acq.attrs["SerialNumber"], "MY00090383")
+            self.assertEqual(acq.attrs["Nfft"], Nfft)
+            self.assertEqual(acq.attrs["numAverages"], 1024)
+            np.testing.assert_array_equal(acq.num_averages[:], [1024] * 6)
+
+            np.testing.assert_array_equal(acq.msrmnt_idx[:], np.arange(1, 7))
+            np.testing.assert_array_equal(acq.rows[:]["msrmt_num"], np.arange(1, 7))
+            self.assertTrue(np.all(np.diff(acq.time_monotonic_ns[:]) > 0))
+            self.assertTrue(np.all(acq.time_utc_ns[:] >= t0))
+            np.testing.assert_array_equal(acq.flags[:] & ROW_FLAG_DROPPED, [0, 0, 0, 1, 0, 0])
+
+    def testLazyReader(self):
+
+        self.log.max_measurements_per_acq = 0
+        self.log.flush_rows = 3
+        self.log.initialize(thread_name="Logger")
+        self.log.send_command("start")
+
+        for k in range(10):
+            self.store(k)
+
+        self.log.send_command("stop")
+        self.log.terminate()
+
+        expected = np.arange(Nfft // 2, dtype=np.float64) + np.arange(10)[:, np.newaxis]
+
+        (path,) = list_log_files(self.tmpdir)
+        with SpectrumDataReader(path) as reader:
+            acq = reader.acquisitions[0]
+            self.assertEqual(acq.shape, expected.shape)
+            self.assertEqual(len(acq), 10)
+
+            for key in [3, -1, slice(2, 8), slice(None, None, -3), [7, 1, 1], expected[:, 0] > 4]:
+                np.testing.assert_array_equal(acq[key], expected[key])
+            np.testing.assert_array_equal(acq[2:5, 4:9], expected[2:5, 4:9])
+            np.testing.assert_array_equal(acq[[0, 5], [1, 2]], expected[[0, 5], [1, 2]])
+            np.testing.assert_array_equal(acq[..., 3], expected[..., 3])
+            np.testing.assert_array_equal(np.asarray(acq), expected)
+            np.testing.assert_array_equal(acq["fftdata"][0:10, :], expected)
+
+            blocks = list(acq.iter_chunks(4))
+            self.assertEqual([len(b) for b in blocks], [4, 4, 2])
+            np.testing.assert_array_equal(np.concatenate(blocks), expected)
+
+            with self.assertRaises(IndexError):
+                acq[10]
+
+        self.assertEqual(reader.acquisitions, [])
+
+    def testBlockCache(self):
+
+        n = 100
+        expected = np.arange(n, dtype=np.float64)[:, np.newaxis] + np.arange(Nfft // 2)
+        path = os.path.join(self.tmpdir, "cache.hdf5")
+        logfile = Hdf5LogFile(path)
+        logfile.create_acquisition(Nfft // 2, acq_id=1, chunk_rows=8, compression="gzip")
+        logfile.append(expected, make_rows(np.arange(n)))
+        logfile.close()
+
+        #: Blocks of 8 rows (2 KiB), at most 4 cached
+        cache = LogBlockCache(max_bytes=8192, block_bytes=2048)
+        with SpectrumDataReader(path, cache=cache) as reader:
+            acq = reader.acquisitions[0]
+
+            np.testing.assert_array_equal(acq[0:8], expected[0:8])
+            np.testing.assert_array_equal(acq[8:16], expected[8:16])
+            self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+            #: The next block was read ahead
+            deadline = time.monotonic() + 5.0
+            while cache.prefetched < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(cache.prefetched, 1)
+            np.testing.assert_array_equal(acq[16:24, 2:5], expected[16:24, 2:5])
+            np.testing.assert_array_equal(acq[9], expected[9])
+            self.assertEqual(cache.misses, 2)
+
+            #: Reads spanning blocks, and reads that bypass the cache
+            for key in [slice(5, 40), -1, slice(None, None, -3), [7, 1, 1], expected[:, 0] > 90]:
+                np.testing.assert_array_equal(acq[key], expected[key])
+            self.assertLessEqual(cache.nbytes, cache.max_bytes)
+
+            #: Results are copies of the cached blocks
+            acq[0:4][:] = -1
+            np.testing.assert_array_equal(acq[0:4], expected[0:4])
+
+        self.assertEqual(cache.nbytes, 0)
+        cache.close()
+
+    def testFollowSwmr(self):
+
+        self.log.swmr = True
+        self.log.max_measurements_per_acq = 0
+        self.log.flush_rows = 2
+        self.log.initialize(thread_name="Logger")
+        self.log.send_command("start")
+
+        for k in range(4):
+            self.store(k)
+
+        (path,) = list_log_files(self.tmpdir)
+        reader = SpectrumDataReader(path, swmr=True)
+        follower = reader.follow(poll_interval=0.01, timeout=5.0)
+
+        def take(n):
+            #: Rows may arrive in more than one block
+            blocks = []
+            while sum(len(b) for b in blocks) < n:
+                blocks.append(next(follower))
+            return np.concatenate(blocks)
+
+        np.testing.assert_array_equal(take(4)[:, 0], np.arange(4))
+
+        for k in range(4, 6):
+            self.store(k)
+
+        np.testing.assert_array_equal(take(2)[:, 0], [4, 5])
+
+        #: Stopping the acquisition closes the file and ends the follower
+        self.log.send_command("stop")
+        self.assertEqual(list(follower), [])
+        reader.close()
+
+        self.log.terminate()
+
+        with SpectrumDataReader(path) as reader:
+            self.assertTrue(reader._file.attrs["complete"])
+            self.assertEqual(reader.acquisitions[0].msrmnt_count, 6)
+
+    def testRawBackend(self):
+
+        self.log.backend = "raw"
+        self.log.max_measurements_per_acq = 0
+        self.log.raw_capacity = 8
+        self.log.flush_rows = 3
+        self.log.initialize(thread_name="Logger")
+        self.log.send_command("start")
+
+        for k in range(20):
+            self.store(k)
+
+        self.log.send_command("stop")
+        self.log.terminate()
+
+        paths = sorted(glob.glob(os.path.join(self.tmpdir, "*" + RAW_LOG_SUFFIX)))
+        self.assertEqual(len(paths), 3)
+
+        spectra = []
+        for path in paths:
+            with RawLogReader(path) as reader:
+                self.assertTrue(reader.header["complete"])
+                (acq,) = reader.acquisitions
+                self.assertEqual(acq.dtype, np.float32)
+                spectra.append(acq[:, 0])
+
+                #: Files are truncated to the measurements written
+                fftdata = np.load(os.path.join(path, acq.attrs["fftdata"]), mmap_mode="r")
+                self.assertEqual(fftdata.shape, acq.shape)
+
+                #: A closed raw log has nothing new to read
+                acq.refresh()
+                self.assertEqual(acq.shape, fftdata.shape)
+
+            with SpectrumDataReader(convert_rawlog_to_hdf5(path)) as reader:
+                (acq,) = reader.acquisitions
+                np.testing.assert_array_equal(acq[:, 0], spectra[-1])
+                self.assertEqual(acq.num_averages[0], 1024)
+
+        np.testing.assert_array_equal(np.concatenate(spectra), np.arange(20))
+
+    def testSeek(self):
+
+        n = 1000
+        spectra = np.arange(n, dtype=np.float64)[:, np.newaxis] + np.zeros(Nfft // 2)
+        t0 = 1.6e9
+        rows = make_rows(5 + 2 * np.arange(n), utc_ns=int(t0 * 1e9) + 1000000 * np.arange(n))
+
+        hdf5_path = os.path.join(self.tmpdir, "seek.hdf5")
+        raw_path = os.path.join(self.tmpdir, "seek" + RAW_LOG_SUFFIX)
+        for logfile in [Hdf5LogFile(hdf5_path), RawLogFile(raw_path, capacity=n)]:
+            logfile.create_acquisition(Nfft // 2, acq_id=1)
+            for i0 in range(0, n, 37):
+                logfile.append(spectra[i0 : i0 + 37], rows[i0 : i0 + 37])
+            logfile.close()
+
+        with SpectrumDataReader(hdf5_path) as reader, RawLogReader(raw_path) as raw_reader:
+            self.assertEqual(len(reader.acquisitions[0]._group["row_index"]), 4)
+
+            for acq in [reader.acquisitions[0], raw_reader.acquisitions[0]]:
+                for i in [0, 1, 255, 256, 257, 511, 512, 999]:
+                    self.assertEqual(acq.find_msrmt(5 + 2 * i), i)
+                    self.assertEqual(acq.find_time(t0 + (i - 0.5) * 1e-3), i)
+                for missing in [4, 6, 2005]:
+                    with self.assertRaises(KeyError):
+                        acq.find_msrmt(missing)
+                self.assertEqual(acq.find_time(t0 + 2.0), n)
+
+                self.assertEqual(acq.time_slice(t0 + 0.0995, t0 + 0.2995), slice(100, 300))
+                np.testing.assert_array_equal(acq.read_range(t0 + 0.0995, t0 + 0.2995)[:, 0], np.arange(100, 300))
+                self.assertEqual(len(acq.read_range(t0 + 0.3, t0 + 0.1)), 0)
+
+            self.assertEqual(reader.find_time(t0 + 0.4995), (0, 500))
+            self.assertIsNone(reader.find_time(t0 + 2.0))
+
+    def testCompression(self):
+
+        #: Noisy spectra with a smooth baseline
+        rng = np.random.default_rng(1)
+        sample = 1e-6 * (1 + np.arange(Nfft // 2)) + rng.normal(0, 1e-9, (64, Nfft // 2))
+
+        name, results = calibrate_compression(sample)
+        self.assertEqual([r["name"] for r in results], ["none"] + available_compressions())
+        self.assertGreater(dict((r["name"], r["ratio"]) for r in results)["gzip"], 1.0)
+        self.assertEqual(name, max(results, key=lambda r: r["ratio"])["name"])
+
+        #: No filter keeps up: the fastest is chosen
+        name, results = calibrate_compression(sample, rate=1e12)
+        self.assertEqual(name, max(results, key=lambda r: r["mb_per_s"])["name"])
+
+        with self.assertRaises(ValueError):
+            compression_options("bzip")
+
+        name, results = calibrate_compression_process(sample)
+        self.assertEqual([r["name"] for r in results], ["none"] + available_compressions())
+
+        #: A long acquisition starts uncompressed while the calibration runs, then
+        #: continues in a new segment with the calibrated filter
+        self.log.compression = "auto"
+        self.log._auto_compression = ""
+        self.log.max_measurements_per_acq = 0
+        self.log.flush_rows = 4
+        self.log.initialize(thread_name="Logger")
+        self.log.send_command("start")
+        n = 0
+        while self.log._segment == 0 and n < 1000:
+            self.store(n)
+            n += 1
+            time.sleep(0.01)
+        for k in range(8):
+            self.store(n + k)
+        self.log.send_command("stop")
+
+        #: The next acquisition starts with the calibrated filter
+        self.log.send_command("start")
+        for k in range(4):
+            self.store(k)
+        self.log.send_command("stop")
+        self.log.terminate()
+
+        groups = []
+        for path in list_log_files(self.tmpdir):
+            with SpectrumDataReader(path) as reader:
+                groups += [(dict(acq.attrs), acq[:, 0]) for acq in reader.acquisitions]
+        first = [(attrs, data) for attrs, data in groups if attrs["acq_id"] == 1]
+        (attrs, data), (next_attrs, next_data) = first
+        self.assertEqual((attrs["segment"], next_attrs["segment"]), (0, 1))
+        self.assertNotIn("compression", attrs)
+        chosen = attrs["auto_compression"]
+        self.assertIn(chosen, available_compressions())
+        self.assertEqual(next_attrs["compression"], chosen)
+        np.testing.assert_array_equal(np.concatenate([data, next_data]), np.arange(n + 8))
+
+        attrs, data = groups[-1]
+        self.assertEqual((attrs["acq_id"], attrs["compression"]), (2, chosen))
+        np.testing.assert_array_equal(data, np.arange(4))
+
+    def testPreallocation(self):
+
+        path = os.path.join(self.tmpdir, "prealloc.hdf5")
+        spectra = np.arange(10, dtype=np.float64)[:, np.newaxis] + np.zeros(Nfft // 2)
+        logfile = Hdf5LogFile(path)
+        logfile.create_acquisition(Nfft // 2, acq_id=1, preallocate_rows=100000)
+        logfile.append(spectra, make_rows(np.arange(10)))
+
+        #: Space is reserved on disk, but HDF5 does not see it
+        self.assertGreater(os.path.getsize(path), 100000 * 8 * Nfft // 2)
+        self.assertLess(logfile.nbytes, 1 << 20)
+        logfile.close()
+
+        #: Unused space is released on close
+        self.assertLess(os.path.getsize(path), 1 << 20)
+        with SpectrumDataReader(path) as reader:
+            np.testing.assert_array_equal(reader.acquisitions[0][:], spectra)
+
+        self.log.preallocate_duration = 60.0
+        self.log.settings = {"SampleRate": 1e9, "numAverages": 1024}
+        self.log.initialize(thread_name="Logger")
+        self.log.send_command("start")
+        for k in range(5):
+            self.store(k)
+        self.log.send_command("stop")
+        self.log.terminate()
+
+        #: 60 s at 15 kHz is about 230 MB
+        (path,) = list_log_files(self.tmpdir)
+        self.assertLess(os.path.getsize(path), 4 << 20)
+        with SpectrumDataReader(path) as reader:
+            np.testing.assert_array_equal(reader.acquisitions[0][:, 0], np.arange(5))
+
+    def testReduction(self):
+
+        expected = np.arange(Nfft // 2, dtype=np.float64) + np.arange(10)[:, np.newaxis]
+
+        for reduction in ["decimate", "mean", "max"]:
+            self.log.reduction = reduction
+            self.log.reduction_factor = 3
+            self.log.bin_ranges = [(2, 5), (10, 12)]
+            self.log.initialize(thread_name="Logger")
+            self.log.send_command("start")
+
+            for k in range(10):
+                self.store(k)
+
+            self.log.send_command("stop")
+            self.log.terminate()
+
+        bins = [2, 3, 4, 10, 11]
+        blocks = expected[:9].reshape(3, 3, -1)[:, :, bins]
+        results = {
+            "decimate": (blocks[:, 0], [1, 4, 7, 10]),
+            "mean": (blocks.mean(axis=1), [3, 6, 9]),
+            "max": (blocks.max(axis=1), [3, 6, 9]),
+        }
+
+        for path in list_log_files(self.tmpdir):
+            with SpectrumDataReader(path) as reader:
+                (acq,) = reader.acquisitions
+                data, msrmt_num = results[acq.attrs["reduction"]]
+                if acq.attrs["reduction"] == "decimate":
+                    #: The last measurement starts a block and is stored
+                    data = np.vstack([data, expected[9, bins]])
+                self.assertEqual(acq.attrs["reduction_factor"], 3)
+                np.testing.assert_array_equal(acq.bin_index, bins)
+                np.testing.assert_allclose(acq[:], data)
+                np.testing.assert_array_equal(acq.msrmnt_idx[:], msrmt_num)
+
+        #: Logs of selected bins (array attribute bin_ranges) are cataloged
+        self.assertEqual(rebuild_catalog(self.tmpdir, max_workers=1), 3)
+        with LogCatalog(os.path.join(self.tmpdir, CATALOG_NAME)) as catalog:
+            self.assertEqual(len(catalog.find()), 3)
+        for path in list_log_files(self.tmpdir):
+            (entry,) = scan_log_file(path)
+            with SpectrumDataReader(path) as reader:
+                self.assertEqual(entry["rows"], len(reader.acquisitions[0]))
+
+    def testCatalog(self):
+
+        self.log.catalog = True
+        self.log.flush_rows = 2
+        self.log.rotation.max_acquisitions = 2
+        self.log.settings = {"SampleRate": 3.2e9, "numAverages": 1024, "SerialNumber": "MY00090383"}
+        self.log.initialize(thread_name="Logger")
+
+        tstart = time.time()
+        for backend, n in [("hdf5", 3), ("hdf5", 5), ("raw", 4)]:
+            self.log.backend = backend
+            self.log.send_command("start")
+            for k in range(n):
+                self.store(k)
+            self.log.send_command("stop")
+            if backend == "raw":
+                self.log.settings = {}
+
+        self.log.terminate()
+        tstop = time.time()
+
+        path = os.path.join(self.tmpdir, CATALOG_NAME)
+        with LogCatalog(path) as catalog:
+            entries = catalog.find(t0=tstart, t1=tstop, serial="MY00090383", num_averages=1024)
+            self.assertEqual([e["rows"] for e in entries], [3, 5, 4])
+            self.assertEqual([e["grp"] for e in entries], ["acq00000001", "acq00000002", "acq00000001"])
+            self.assertTrue(all(e["nfft"] == Nfft and e["complex_data"] == 0 for e in entries))
+            self.assertTrue(all(tstart <= e["start_time"] <= e["stop_time"] <= tstop for e in entries))
+            self.assertEqual(catalog.find(t1=tstart - 1), [])
+            self.assertEqual(catalog.find(serial="other"), [])
+
+        #: The rebuilt catalog matches the one written by the logger
+        os.remove(path)
+        self.assertEqual(rebuild_catalog(self.tmpdir, max_workers=2), 3)
+        with LogCatalog(path) as catalog:
+            self.assertEqual(catalog.find(), entries)
+
+    def testPyramid(self):
+
+        self.log.max_measurements_per_acq = 0
+        self.log.flush_rows = 5
+        self.log.pyramid_levels = 3
+        self.log.pyramid_time_factor = 2
+        self.log.pyramid_freq_factor = 2
+        self.log.initialize(thread_name="Logger")
+        self.log.send_command("start")
+
+        n = 37
+        spectra = np.random.default_rng(1).random((n, Nfft // 2))
+        for k in range(n):
+            with self.buf.lock:
+                self.buf.fftdata = spectra[k]
+                self.buf.stats.Nmsr_total = k + 1
+            self.log.send_command("store")
+            self.assertTrue(self.log.store_done.wait(5.0))
+            self.log.store_done.clear()
+
+        self.log.send_command("stop")
+        self.log.terminate()
+
+        (path,) = list_log_files(self.tmpdir)
+        with SpectrumDataReader(path) as reader:
+            (acq,) = reader.acquisitions
+            self.assertEqual([len(level) for level in acq.pyramid], [18, 9, 4])
+
+            for level in acq.pyramid:
+                tf = level.time_factor
+                ff = level.freq_factor
+                rows = len(level) * tf
+                blocks = spectra[:rows].reshape(len(level), tf, Nfft // 2 // ff, ff)
+                np.testing.assert_allclose(level.mean[:], blocks.mean(axis=(1, 3)))
+                np.testing.assert_array_equal(level.min[:], blocks.min(axis=(1, 3)))
+                np.testing.assert_array_equal(level.max[:], blocks.max(axis=(1, 3)))
+
+            result = acq.overview(max_rows=40)
+            self.assertEqual(result["level"], 0)
+            np.testing.assert_array_equal(result["mean"], spectra)
+
+            result = acq.overview(3, 30, max_rows=4)
+            self.assertEqual(result["level"], 3)
+            np.testing.assert_array_equal(result["rows"], [0, 8, 16, 24])
+            np.testing.assert_array_equal(result["max"], acq.pyramid[2].max[:])
+
+    def testMerge(self):
+
+        self.log.max_measurements_per_acq = 0
+        self.log.flush_rows = 4
+        self.log.rotation.max_bytes = 4096
+        self.log.pyramid_levels = 1
+        self.log.initialize(thread_name="Logger")
+        for n in [40, 3]:
+            self.log.send_command("start")
+            for k in range(n):
+                self.store(k)
+            self.log.send_command("stop")
+        self.log.terminate()
+
+        files = list_log_files(self.tmpdir)
+        dest = os.path.join(self.tmpdir, "merged")
+
+        #: Interrupted after the first job
+        merge_logs(self.tmpdir, dest, target_mb=1e-9, files=files[:1], max_workers=1)
+        merge_logs(self.tmpdir, dest, target_mb=1000, dtype="float32", compression="gzip", max_workers=2)
+
+        merged = list_log_files(dest)
+        self.assertEqual(len(merged), 2)
+
+        with SpectrumDataReader(merged[1]) as reader:
+            self.assertEqual([acq.segment for acq in reader.acquisitions], [1, 0])
+            acq = reader.acquisitions[0]
+            self.assertEqual(acq.dtype, np.float32)
+            self.assertEqual(acq.fftdata._dset.compression, "gzip")
+
+            #: The remaining segments of the first acquisition are joined
+            first = SpectrumDataReader(merged[0]).acquisitions[0]
+            spectra = np.concatenate([first[:, 0], acq[:, 0]])
+            np.testing.assert_array_equal(spectra, np.arange(40))
+            self.assertEqual(len(acq.pyramid[0]), len(acq) // 4)
+            np.testing.assert_array_equal(reader.acquisitions[1].msrmnt_idx[:], [1, 2, 3])
+
+            #: Settings of FFT-order acquisitions are kept
+            self.assertEqual(acq.attrs["Nfft"], Nfft)
+            self.assertEqual(acq.attrs["complexData"], False)
+
+        entries = scan_log_file(merged[1])
+        self.assertEqual([(e["nfft"], e["complex_data"]) for e in entries], [(Nfft, 0)] * 2)
+
+        #: Nothing left to merge
+        merge_logs(self.tmpdir, dest)
+        self.assertEqual(list_log_files(dest), merged)
+        self.assertTrue(os.path.exists(os.path.join(dest, MERGE_JOURNAL_NAME)))
+
+    def testDdrOrder(self):
+
+        converter = MemoryConverter(Nfft, False)
+        self.buf.converter = converter
+
+        expected = np.random.default_rng(0).random((5, Nfft // 2)).astype(np.float32)
+
+        for backend in ["hdf5", "raw"]:
+            self.log.backend = backend
+            self.log.store_ddr_data = True
+            self.log.initialize(thread_name="Logger")
+            self.log.send_command("start")
+
+            for k in range(len(expected)):
+                with self.buf.lock:
+                    self.buf.data_ddra = expected[k, converter._ddra_indices]
+                    self.buf.data_ddrb = expected[k, converter._ddrb_indices]
+                    self.buf.fftdata = None
+                    self.buf.stats.Nmsr_total = k + 1
+
+                    #: The buffer converts on demand
+                    np.testing.assert_array_equal(self.buf.fftdata, expected[k])
+
+                self.log.send_command("store")
+                self.assertTrue(self.log.store_done.wait(5.0))
+                self.log.store_done.clear()
+
+            self.log.send_command("stop")
+            self.log.terminate()
+
+        (path,) = list_log_files(self.tmpdir)
+        with SpectrumDataReader(path) as reader:
+            (acq,) = reader.acquisitions
+            self.assertEqual(acq.attrs["layout"], "ddr")
+            self.assertEqual(acq.shape, expected.shape)
+            np.testing.assert_array_equal(acq[:], expected)
+            np.testing.assert_array_equal(acq[[4, 1], 3:7], expected[[4, 1], 3:7])
+            np.testing.assert_array_equal(np.concatenate(list(acq.iter_chunks(2))), expected)
+
+        (path,) = glob.glob(os.path.join(self.tmpdir, "*" + RAW_LOG_SUFFIX))
+        with RawLogReader(path) as reader:
+            np.testing.assert_array_equal(reader.acquisitions[0][-1], expected[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,608 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, DSPlogic, Inc.  All Rights Reserved.
+#
+# RESTRICTED RIGHTS
+# Use of this software is permitted only with a software license agreement.
+#
+# Details of the software license agreement are in the file LICENSE.txt,
+# distributed with this software.
+# -----------------------------------------------------------------------------
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+
+from pyspectro.applib.acq_control import AcquisitionDataBuffer
+from pyspectro.applib.datalogger import Hdf5LogFile, SpectrumDataReader, make_rows
+from pyspectro.applib.processing import (
+    AllanVariance,
+    BandPower,
+    PeakDetector,
+    ReferenceCalibration,
+    RFIFlagger,
+    RollingQuantile,
+    SpectrumStats,
+    convert_fs_to_dBm,
+    convert_fs_to_dbfs,
+    clear_calibration_cache,
+    convert_raw_to_fs,
+    frequency_axis,
+    get_converter,
+    rebin,
+    rebin_edges,
+    response_correction,
+    response_file_name,
+    unpack_flags,
+)
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(relativeCreated)5d %(name)-15s %(levelname)-8s %(message)s")
+
+nbins = 32
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+
+        self.rng = np.random.default_rng(0)
+        self.spectra = self.rng.random((50, nbins))
+
+    def testCumulativeStats(self):
+
+        stats = SpectrumStats(nbins)
+        stats.update(self.spectra[0])
+        stats.update(self.spectra[1:20])
+        for x in self.spectra[20:]:
+            stats.update(x)
+
+        self.assertEqual(stats.count, 50)
+        np.testing.assert_allclose(stats.mean, self.spectra.mean(axis=0))
+        np.testing.assert_allclose(stats.variance(), self.spectra.var(axis=0))
+        np.testing.assert_allclose(stats.variance(ddof=1), self.spectra.var(axis=0, ddof=1))
+        np.testing.assert_array_equal(stats.min, self.spectra.min(axis=0))
+        np.testing.assert_array_equal(stats.max, self.spectra.max(axis=0))
+
+        stats.reset()
+        stats.update(self.spectra[:3])
+        np.testing.assert_allclose(stats.mean, self.spectra[:3].mean(axis=0))
+
+        with self.assertRaises(ValueError):
+            stats.update(np.zeros(nbins + 1))
+
+    def testSlidingStats(self):
+
+        N = 7
+        stats = SpectrumStats(nbins, "sliding", length=N)
+        for k, x in enumerate(self.spectra):
+            stats.update(x)
+            window = self.spectra[max(0, k + 1 - N) : k + 1]
+            self.assertEqual(stats.count, len(window))
+            np.testing.assert_allclose(stats.mean, window.mean(axis=0))
+            np.testing.assert_allclose(stats.variance(), window.var(axis=0), atol=1e-12)
+            np.testing.assert_array_equal(stats.min, window.min(axis=0))
+            np.testing.assert_array_equal(stats.max, window.max(axis=0))
+
+    def testExponentialStats(self):
+
+        alpha = 0.2
+        stats = SpectrumStats(nbins, "exponential", alpha=alpha)
+        stats.update(self.spectra)
+
+        mean = self.spectra[0].copy()
+        var = np.zeros(nbins)
+        for x in self.spectra[1:]:
+            diff = x - mean
+            mean += alpha * diff
+            var = (1 - alpha) * (var + alpha * diff**2)
+
+        np.testing.assert_allclose(stats.mean, mean)
+        np.testing.assert_allclose(stats.variance(), var)
+        np.testing.assert_array_equal(stats.max, self.spectra.max(axis=0))
+
+    def testStatsSources(self):
+
+        #: Live acquisition buffer
+        buf = AcquisitionDataBuffer()
+        stats = SpectrumStats(nbins)
+        for x in self.spectra:
+            with buf.lock:
+                buf.fftdata = x
+            stats.update_from_buffer(buf)
+        np.testing.assert_allclose(stats.mean, self.spectra.mean(axis=0))
+
+        #: Logged acquisition
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "stats.hdf5")
+            logfile = Hdf5LogFile(path)
+            logfile.create_acquisition(nbins, acq_id=1, chunk_rows=8)
+            logfile.append(self.spectra, make_rows(np.arange(len(self.spectra))))
+            logfile.close()
+
+            with SpectrumDataReader(path) as reader:
+                stats = SpectrumStats(nbins, "sliding", length=10)
+                stats.update_from_log(reader.acquisitions[0], rows=8)
+            np.testing.assert_allclose(stats.mean, self.spectra[-10:].mean(axis=0))
+            np.testing.assert_array_equal(stats.min, self.spectra[-10:].min(axis=0))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testPeakDetector(self):
+
+        B = 1024
+        freqs = frequency_axis(2 * B, False, 2.0e9)
+        bins = np.arange(B)
+
+        def gaussian(center, height, width=2.0):
+            return height * np.exp(-0.5 * ((bins - center) / width) ** 2)
+
+        #: Peaks at fractional bins, a shoulder bump and two close peaks
+        spectrum = 1e-3 + gaussian(100.3, 1.0) + gaussian(400.7, 0.5) + gaussian(700.0, 0.25)
+        spectrum += gaussian(108.0, 0.05) + gaussian(900.0, 0.2) + gaussian(906.0, 0.15)
+
+        detector = PeakDetector(B, k=4, min_prominence=0.01, min_spacing=10, freqs=freqs, interpolation="gaussian")
+        peaks = detector.find(spectrum)
+        self.assertEqual(peaks.shape, (4,))
+        np.testing.assert_array_equal(peaks["index"], [100, 401, 700, 900])
+        np.testing.assert_allclose(peaks["bin"][:3], [100.3, 400.7, 700.0], atol=0.02)
+        np.testing.assert_allclose(peaks["height"][:3], [1.0, 0.5, 0.25], rtol=1e-2)
+        np.testing.assert_allclose(peaks["frequency"], np.interp(peaks["bin"], bins, freqs))
+        self.assertLess(peaks["prominence"][0], 1.0)
+
+        #: Without spacing the close peak is found; the shoulder bump is not prominent
+        detector = PeakDetector(B, k=6, min_prominence=0.01, interpolation="none")
+        peaks = detector.find(spectrum)
+        np.testing.assert_array_equal(peaks["index"], [100, 401, 700, 900, 906, -1])
+        self.assertTrue(np.isnan(peaks["bin"][-1]))
+        self.assertEqual(peaks["height"][0], spectrum[100])
+
+        detector.min_prominence = 0.0
+        self.assertIn(108, detector.find(spectrum)["index"])
+
+        #: Blocks give the same result as single spectra
+        block = np.array([spectrum, spectrum[::-1], np.zeros(B)])
+        peaks = detector.update(block)
+        self.assertEqual(peaks.shape, (3, 6))
+        for row, x in zip(peaks, block):
+            for name in peaks.dtype.names:
+                np.testing.assert_array_equal(row[name], detector.find(x)[name])
+        np.testing.assert_array_equal(peaks[2]["index"], -1)
+
+        #: An isolated peak below a plateau of ripples with low prominence
+        plateau = np.zeros(4096)
+        plateau[1000:1200] = 10.0 + 0.01 * (np.arange(200) % 2)
+        plateau[3000] = 5.0
+        detector = PeakDetector(4096, k=1, min_prominence=1.0, interpolation="none")
+        np.testing.assert_array_equal(detector.find(plateau)["index"], [3000])
+        peaks = detector.find(np.array([plateau, np.zeros(4096), spectrum[:1] * np.ones(4096)]))
+        np.testing.assert_array_equal(peaks["index"][:, 0], [3000, -1, -1])
+
+    def testConverter(self):
+
+        raw = self.rng.random((4, 64)) * 1e9 + 1.0
+        for complexData in [True, False]:
+            Nfft = 64 if complexData else 128
+            fs = convert_raw_to_fs(raw, 1024, complexData)
+            expected = {
+                "FS": fs,
+                "dB-FS": convert_fs_to_dbfs(fs, complexData),
+                "dBm": convert_fs_to_dBm(fs, complexData, 2.0),
+            }
+            for units, result in expected.items():
+                convert = get_converter(Nfft, complexData, 1024, 2.0, units)
+                self.assertIs(convert, get_converter(Nfft, complexData, 1024, 2.0, units))
+                np.testing.assert_allclose(convert(raw), result, rtol=1e-12)
+                np.testing.assert_allclose(convert(raw[0]), result[0], rtol=1e-12)
+
+                out = convert.empty(len(raw))
+                self.assertIs(convert(raw, out=out), out)
+                np.testing.assert_allclose(out, result, rtol=1e-12)
+
+                out = get_converter(Nfft, complexData, 1024, 2.0, units, np.float32).empty()
+                get_converter(Nfft, complexData, 1024, 2.0, units, np.float32)(raw[1], out=out)
+                self.assertEqual(out.dtype, np.float32)
+                np.testing.assert_allclose(out, result[1], rtol=1e-5)
+
+        convert = get_converter(64, True, 1024)
+        with self.assertRaises(ValueError):
+            convert(np.ones(32))
+        with self.assertRaises(ValueError):
+            convert(raw, out=convert.empty())
+
+    def testBandPower(self):
+
+        freqs = frequency_axis(64, True, 64.0e6)
+        table = [("low", -32e6, -20e6), ("mid", -1.5e6, 2e6), ("wide", -10e6, 31.5e6), ("overlap", 0.0, 5e6)]
+        bands = BandPower(freqs, table)
+        self.assertEqual(bands.nbands, 4)
+        np.testing.assert_array_equal(bands.bin_ranges, [[0, 12], [31, 34], [22, 64], [32, 37]])
+
+        power = bands.update(self.rng.random((5, 64)))
+        self.assertEqual(power.shape, (5, 4))
+
+        spectra = self.rng.random((10, 64))
+        power = bands.update(spectra)
+        for i, (start, stop) in enumerate(bands.bin_ranges):
+            np.testing.assert_allclose(power[:, i], spectra[:, start:stop].sum(axis=1), rtol=1e-12)
+        np.testing.assert_array_equal(bands.power, power[-1])
+        self.assertEqual(bands.total, 15)
+
+        bands = BandPower(freqs, {"mid": (-1.5e6, 2e6)}, mode="mean")
+        np.testing.assert_allclose(bands.update(spectra[0]), [[spectra[0, 31:34].mean()]])
+
+        with self.assertRaises(ValueError):
+            BandPower(freqs, [("none", 1.1e6, 1.2e6)])
+        with self.assertRaises(ValueError):
+            bands.update(np.zeros(32))
+
+        #: Band powers logged as their own time series
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "bands.hdf5")
+            bands = BandPower(freqs, table)
+            logfile = Hdf5LogFile(path)
+            logfile.create_acquisition(bands.nbands, acq_id=1, chunk_rows=64, attrs=bands.attrs())
+            logfile.append(bands.update(spectra), make_rows(np.arange(len(spectra))))
+            logfile.close()
+
+            with SpectrumDataReader(path) as reader:
+                acq = reader.acquisitions[0]
+                np.testing.assert_allclose(acq[:], bands.update(spectra))
+                self.assertEqual(list(acq.attrs["band_names"]), ["low", "mid", "wide", "overlap"])
+                np.testing.assert_array_equal(acq.attrs["bin_ranges"], bands.bin_ranges)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testRebin(self):
+
+        spectra = self.rng.random((6, 100))
+        spectra[2, 37] = 50.0
+        for nout in [100, 25, 7, 33, 1]:
+            edges, counts = rebin_edges(100, nout)
+            self.assertIs(edges, rebin_edges(100, nout)[0])
+            self.assertEqual(edges[-1], 100)
+            blocks = [spectra[:, a:b] for a, b in zip(edges[:-1], edges[1:])]
+
+            expected = {
+                "mean": np.stack([b.mean(axis=1) for b in blocks], axis=1),
+                "max": np.stack([b.max(axis=1) for b in blocks], axis=1),
+                "min": np.stack([b.min(axis=1) for b in blocks], axis=1),
+            }
+            expected["minmax"] = np.stack([expected["min"], expected["max"]], axis=2)
+
+            for mode, result in expected.items():
+                np.testing.assert_allclose(rebin(spectra, nout, mode), result, rtol=1e-12)
+                np.testing.assert_allclose(rebin(spectra[2], nout, mode), result[2], rtol=1e-12)
+                out = np.empty(result.shape, np.float32)
+                self.assertIs(rebin(spectra, nout, mode, out=out), out)
+                np.testing.assert_allclose(out, result, rtol=1e-6)
+
+            #: The spur survives max rebinning
+            self.assertEqual(rebin(spectra[2], nout, "max").max(), 50.0)
+
+        np.testing.assert_array_equal(rebin(np.arange(10), 5), [0.5, 2.5, 4.5, 6.5, 8.5])
+
+        with self.assertRaises(ValueError):
+            rebin(spectra, 200)
+        with self.assertRaises(ValueError):
+            rebin(spectra, 10, "median")
+        with self.assertRaises(ValueError):
+            rebin(spectra, 10, out=np.empty(10))
+
+    def testReferenceCalibration(self):
+
+        off = 1.0 + self.spectra[:10]
+        on = 2.0 + self.spectra[10:20]
+
+        cal = ReferenceCalibration(nbins)
+        self.assertFalse(cal.ready)
+        self.assertIsNone(cal.update(on[0]))
+        with self.assertRaises(RuntimeError):
+            cal.apply(on)
+
+        #: Record an averaged OFF reference
+        cal.record("off")
+        self.assertIsNone(cal.update(off[:4]))
+        cal.update(off[4:])
+        self.assertEqual(cal.recorded, 10)
+        ref = cal.finish()
+        np.testing.assert_allclose(ref, off.mean(axis=0))
+        self.assertTrue(cal.ready)
+        with self.assertRaises(ValueError):
+            ref[0] = 0.0
+
+        result = cal.update(on)
+        np.testing.assert_allclose(result, (on - ref) / ref)
+        np.testing.assert_allclose(cal.calibrated, result[-1])
+
+        cal.mode = "difference"
+        np.testing.assert_allclose(cal.apply(on[0]), on[0] - ref)
+        out = on.copy()
+        self.assertIs(cal.apply(out, out=out), out)
+        np.testing.assert_allclose(out, on - ref)
+
+        #: A new reference replaces the old one
+        cal.set_reference("off", np.ones(nbins))
+        np.testing.assert_allclose(cal.apply(on), on - 1.0)
+
+        #: Y-factor calibration with hot and cold loads
+        cold = np.full(nbins, 2.0)
+        hot = self.rng.uniform(4.0, 6.0, nbins)
+        cal = ReferenceCalibration(nbins, "yfactor", t_hot=300.0, t_cold=80.0)
+        cal.set_reference("cold", cold)
+        self.assertFalse(cal.ready)
+        cal.set_reference("hot", hot)
+        np.testing.assert_allclose(cal.apply(hot), np.full(nbins, 300.0))
+        np.testing.assert_allclose(cal.apply(cold), np.full(nbins, 80.0))
+        Y = hot / cold
+        np.testing.assert_allclose(cal.receiver_temperature(), (300.0 - Y * 80.0) / (Y - 1.0))
+
+        cal.t_cold = 20.0
+        np.testing.assert_allclose(cal.apply(cold), np.full(nbins, 20.0))
+
+        with self.assertRaises(ValueError):
+            cal.set_reference("hot", np.ones(nbins + 1))
+
+    def testResponseCorrection(self):
+
+        raw = self.rng.random((3, 64)) * 1e9 + 1.0
+        bins = frequency_axis(128, False, 128.0e6)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(response_file_name(128, False, 128.0e6), "response_128_real_128MHz.csv")
+            self.assertIsNone(response_correction(128, False, 128.0e6, tmpdir))
+
+            path = os.path.join(tmpdir, response_file_name(128, False, 128.0e6))
+            with open(path, "w") as f:
+                f.write("# frequency (Hz), correction (dB)\n10e6, 1.0\n40e6, 3.0\n")
+            clear_calibration_cache()
+
+            correction_db = np.interp(bins, [10e6, 40e6], [1.0, 3.0])
+            correction = response_correction(128, False, 128.0e6, tmpdir)
+            np.testing.assert_allclose(10.0 * np.log10(correction), correction_db)
+            self.assertIs(correction, response_correction(128, False, 128.0e6, tmpdir))
+
+            fs = convert_raw_to_fs(raw, 16, False)
+            convert = get_converter(128, False, 16, units="dBm", sampleRate=128.0e6, directory=tmpdir)
+            self.assertIs(convert, get_converter(128, False, 16, sampleRate=128.0e6, directory=tmpdir))
+            np.testing.assert_allclose(convert(raw), convert_fs_to_dBm(fs, False) + correction_db, rtol=1e-12)
+
+            convert = get_converter(128, False, 16, units="FS", sampleRate=128.0e6, directory=tmpdir)
+            np.testing.assert_allclose(convert(raw), fs * correction, rtol=1e-12)
+
+            #: Other sample rates and converters without a sample rate are not corrected
+            self.assertIsNone(get_converter(128, False, 16, sampleRate=64.0e6, directory=tmpdir).correction)
+            self.assertIsNone(get_converter(128, False, 16).correction)
+        finally:
+            clear_calibration_cache()
+            shutil.rmtree(tmpdir)
+
+    def testStatsFlags(self):
+
+        flags = self.rng.random(self.spectra.shape) < 0.3
+        flags[:, 0] = True
+        flags[5:, 1] = True
+        masked = np.where(flags, np.nan, self.spectra)
+
+        stats = SpectrumStats(nbins)
+        stats.update(self.spectra[:10], flags[:10])
+        stats.update(self.spectra[10:], np.packbits(flags[10:], axis=1))
+        np.testing.assert_array_equal(stats.counts, (~flags).sum(axis=0))
+        self.assertEqual(stats.count, 50)
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            np.testing.assert_allclose(stats.mean, np.nanmean(masked, axis=0))
+            np.testing.assert_allclose(stats.variance(), np.nanvar(masked, axis=0))
+            np.testing.assert_array_equal(stats.min, np.nanmin(masked, axis=0))
+            np.testing.assert_array_equal(stats.max, np.nanmax(masked, axis=0))
+
+        #: Unflagged spectra after flagged ones
+        stats = SpectrumStats(nbins)
+        stats.update(self.spectra[:5])
+        stats.update(self.spectra[5:20], flags[5:20])
+        stats.update(self.spectra[20:])
+        expected = masked.copy()
+        expected[:5] = self.spectra[:5]
+        expected[20:] = self.spectra[20:]
+        np.testing.assert_allclose(stats.mean, np.nanmean(expected, axis=0))
+        np.testing.assert_allclose(stats.variance(ddof=1), np.nanvar(expected, axis=0, ddof=1))
+
+        N = 7
+        stats = SpectrumStats(nbins, "sliding", length=N)
+        expected = masked.copy()
+        expected[:3] = self.spectra[:3]
+        for k, x in enumerate(self.spectra):
+            stats.update(x, flags[k] if k >= 3 else None)
+            window = expected[max(0, k + 1 - N) : k + 1]
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                np.testing.assert_allclose(stats.mean, np.nanmean(window, axis=0), atol=1e-12)
+                np.testing.assert_allclose(stats.variance(), np.nanvar(window, axis=0), atol=1e-12)
+                np.testing.assert_array_equal(stats.min, np.nanmin(window, axis=0))
+                np.testing.assert_array_equal(stats.max, np.nanmax(window, axis=0))
+            np.testing.assert_array_equal(stats.counts, np.sum(~np.isnan(window), axis=0))
+
+        alpha = 0.2
+        stats = SpectrumStats(nbins, "exponential", alpha=alpha)
+        stats.update(self.spectra, flags)
+        for b in range(2, nbins):
+            x = self.spectra[~flags[:, b], b]
+            mean, var = x[0], 0.0
+            for value in x[1:]:
+                diff = value - mean
+                mean += alpha * diff
+                var = (1 - alpha) * (var + alpha * diff**2)
+            self.assertAlmostEqual(stats.mean[b], mean)
+            self.assertAlmostEqual(stats.variance()[b], var)
+        self.assertTrue(np.isnan(stats.mean[0]))
+
+        with self.assertRaises(ValueError):
+            PeakDetector(nbins).update(self.spectra, flags)
+
+    def testRFIFlagger(self):
+
+        B = 256
+        noise = 10.0 + self.rng.standard_normal((200, B))
+        rfi = np.zeros(noise.shape, dtype=bool)
+        rfi[100:, 50] = True
+        rfi[150, 10:20] = True
+        rfi[120:130, 200] = True
+        data = noise + 20.0 * rfi
+
+        stats = SpectrumStats(B)
+        flagger = RFIFlagger(B, length=32, refresh=8, threshold=6.0, targets=[stats])
+        self.assertEqual(flagger.nbytes, 32)
+        packed = [flagger.update(data[:5]), flagger.update(data[5])]
+        self.assertFalse(flagger.ready)
+        packed.append(flagger.update(data[6:40]))
+        self.assertTrue(flagger.ready)
+
+        #: Baseline of the window at the last refresh
+        window = data[8:40]
+        np.testing.assert_allclose(flagger.median, np.median(window, axis=0))
+        np.testing.assert_allclose(
+            flagger.sigma, 1.4826 * np.median(np.abs(window - np.median(window, axis=0)), axis=0)
+        )
+
+        for i0 in range(40, 200, 10):
+            packed.append(flagger.update(data[i0 : i0 + 10]))
+        packed = np.concatenate(packed)
+        self.assertEqual(packed.shape, (200, 32))
+        self.assertEqual(packed.dtype, np.uint8)
+        flags = unpack_flags(packed, B)
+        self.assertFalse(flags[:8].any())
+
+        #: Persistent RFI is flagged until it dominates the baseline window
+        self.assertTrue(flags[100:110, 50].all())
+        self.assertTrue(flags[150, 10:20].all())
+        self.assertTrue(flags[120:130, 200].all())
+        self.assertLess(np.count_nonzero(flags & ~rfi), 10)
+
+        #: Flagged bins are excluded from the statistics
+        np.testing.assert_array_equal(stats.counts, (~flags).sum(axis=0))
+        self.assertLess(stats.max[10:20].max(), 20.0)
+
+        flagger.sided = "upper"
+        flagger.update(np.full(B, -100.0))
+        self.assertEqual(flagger.fraction, 0.0)
+        flagger.sided = "both"
+        flagger.update(np.full(B, -100.0))
+        self.assertEqual(flagger.fraction, 1.0)
+
+        #: Flags logged as their own series
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "flags.hdf5")
+            logfile = Hdf5LogFile(path)
+            logfile.create_acquisition(flagger.nbytes, acq_id=1, dtype="uint8", attrs=flagger.attrs())
+            logfile.append(packed, make_rows(np.arange(len(packed))))
+            logfile.close()
+
+            with SpectrumDataReader(path) as reader:
+                acq = reader.acquisitions[0]
+                np.testing.assert_array_equal(unpack_flags(acq[:], acq.attrs["flag_nbins"]), flags)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testRollingQuantile(self):
+
+        W = 9
+        q = [0.0, 0.1, 0.5, 0.9, 1.0]
+        data = self.rng.random((40, nbins))
+        data[:, :4] = np.round(data[:, :4] * 4)
+
+        rq = RollingQuantile(nbins, W, quantiles=q, method="sorted")
+        self.assertTrue(np.isnan(rq.values).all())
+        for k in range(0, 40, 3):
+            values = rq.update(data[k : k + 3])
+            window = data[: k + 3][-W:]
+            self.assertEqual(rq.count, len(window))
+            np.testing.assert_allclose(values, np.percentile(window, np.multiply(q, 100), axis=0))
+        np.testing.assert_allclose(rq.quantile(0.25), np.percentile(data[-W:], 25, axis=0))
+
+        #: Exact for windows that are not a whole number of blocks, and each spectrum
+        #: moves O(sqrt(W)) stored values per bin, not O(W)
+        for W in (5, 1024):
+            rq = RollingQuantile(4, W, quantiles=(0.1, 0.5), method="sorted")
+            data = self.rng.random((W + 64, 4))
+            rq.update(data[:W])
+            moved = 0
+            for x in data[W:]:
+                before = rq._sorted.copy()
+                values = rq.update(x)
+                moved = max(moved, np.count_nonzero(rq._sorted != before, axis=1).max())
+            np.testing.assert_allclose(values, np.percentile(data[-W:], [10, 50], axis=0))
+            self.assertLessEqual(moved, 4 * np.sqrt(W) + 1)
+
+        #: Histogram of power spectra: within one level (0.1 dB) of the order statistic
+        power = 10.0 ** (self.rng.standard_normal((200, nbins)) - 5.0)
+        rq = RollingQuantile(nbins, 32, quantiles=(0.1, 0.5), lo=-100.0, hi=-20.0, levels=800)
+        self.assertEqual(rq.method, "histogram")
+        for k in range(0, 200, 7):
+            rq.update(power[k : k + 7])
+            window = power[: k + 7][-32:]
+            expected = np.percentile(window, [10, 50], axis=0, method="lower")
+            np.testing.assert_allclose(10.0 * np.log10(rq.values / expected), 0.0, atol=0.1)
+        np.testing.assert_allclose(rq.quantile(0.5), rq.values[1])
+        with self.assertRaises(ValueError):
+            rq.quantile(0.25)
+
+        rq = RollingQuantile(nbins, 16, method="histogram", scale="linear", lo=0.0, hi=1.0, levels=1000)
+        rq.update(self.spectra)
+        expected = np.percentile(self.spectra[-16:], 50, axis=0, method="lower")
+        np.testing.assert_allclose(rq.values[0], expected, atol=1e-3)
+
+        with self.assertRaises(ValueError):
+            RollingQuantile(nbins, 16, quantiles=(1.5,))
+
+    def testAllanVariance(self):
+
+        T = 203
+        data = self.rng.standard_normal((T, nbins)) + np.linspace(0.0, 1.0, T)[:, np.newaxis]
+
+        allan = AllanVariance(nbins, tau0=0.5)
+        for x in data:
+            allan.update(x)
+        self.assertEqual(allan.levels, 7)
+        np.testing.assert_allclose(allan.taus, 0.5 * 2.0 ** np.arange(7))
+
+        for m in range(allan.levels):
+            K = T // 2**m
+            averages = data[: K * 2**m].reshape(K, 2**m, nbins).mean(axis=1)
+            self.assertEqual(allan.counts[m], K - 1)
+            np.testing.assert_allclose(allan.variance()[m], np.mean(np.diff(averages, axis=0) ** 2, axis=0) / 2)
+        np.testing.assert_allclose(allan.deviation(), np.sqrt(allan.variance()))
+
+        #: Blocks of any size give the same result
+        chunked = AllanVariance(nbins, tau0=0.5)
+        bounds = [0, 1, 4, 5, 40, 41, 128, T]
+        for i0, i1 in zip(bounds[:-1], bounds[1:]):
+            chunked.update(data[i0:i1])
+        np.testing.assert_allclose(chunked.variance(), allan.variance())
+
+        #: Logged acquisition, read in chunks
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "allan.hdf5")
+            logfile = Hdf5LogFile(path)
+            logfile.create_acquisition(nbins, acq_id=1, chunk_rows=16)
+            logfile.append(data, make_rows(np.arange(T)))
+            logfile.close()
+
+            logged = AllanVariance(nbins, tau0=0.5)
+            with SpectrumDataReader(path) as reader:
+                logged.update_from_log(reader.acquisitions[0], rows=24)
+            np.testing.assert_allclose(logged.variance(), allan.variance())
+        finally:
+            shutil.rmtree(tmpdir)
+
+        allan.reset()
+        self.assertEqual(allan.variance().shape, (0, nbins))
+
+
+if __name__ == "__main__":
+    unittest.main()